@@ -0,0 +1,372 @@
+"""
+Differential fuzzing of kano against kubesv.
+
+Seeded clusters of varying size and shape are generated in the subset of manifests both engines read alike:
+labeled namespaces, matchLabels and In/NotIn/Exists/DoesNotExist matchExpressions (also on keys no object has),
+OR-ed peers with or without namespaceSelector, every pod labeled User.
+Clusters are built by both engines in a process pool and compared on the reachability matrix and the kano queries.
+A mismatching cluster is shrunk (policies, rules, peers, pods, labels) to a minimal reproducer.
+
+    python fuzz.py --seeds 50 --sizes 10,100,1000 --workers 4 --out mismatches
+"""
+import argparse
+import itertools
+import os
+import random
+import sys
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import Any, Dict, List, Optional, Tuple
+
+import kano.algorithm as kano
+import kubesv.kubesv.postprocess as ksv
+
+from kano.model import ReachabilityMatrix
+from kano.parser import ConfigParser
+from kubesv.kubesv.constraint import build
+from kubesv.kubesv.exposure import edge_rows
+from kubesv.kubesv.parser import from_dicts
+
+USER = "User"
+
+# (namespace manifests, pod manifests, policy manifests)
+Case = Tuple[List[dict], List[dict], List[dict]]
+# (check_self_ingress_traffic, check_select_by_no_policy)
+Flags = Tuple[bool, bool]
+
+
+@dataclass
+class Shape:
+    n_pod: int
+    n_pol: int
+    n_key: int
+    n_value: int
+    n_user: int
+    # at most that many labels besides User, per pod and per selector
+    pod_labels: int
+    select_labels: int
+    rules: int
+    n_ns: int
+    # at most that many peers per rule
+    peers: int
+    # probability of matchExpressions in a selector
+    expressions: float
+
+
+def random_shape(r: random.Random, n_pod: int) -> Shape:
+    return Shape(n_pod,
+        n_pol=max(1, int(n_pod * r.choice([0.05, 0.2, 0.5, 1.0]))),
+        n_key=r.randint(1, 6),
+        n_value=r.randint(1, 10),
+        n_user=r.randint(1, 5),
+        pod_labels=r.randint(0, 4),
+        select_labels=r.randint(0, 3),
+        rules=r.randint(1, 3),
+        n_ns=r.randint(1, 3),
+        peers=r.randint(1, 3),
+        expressions=r.choice([0.0, 0.3, 0.7]))
+
+
+def generate(seed: int, n_pod: int) -> Tuple[Case, Flags]:
+    r = random.Random(seed * 1000003 + n_pod)
+    shape = random_shape(r, n_pod)
+    keys = ["key" + str(i) for i in range(shape.n_key)]
+    values = ["value" + str(i) for i in range(shape.n_value)]
+    users = ["user" + str(i) for i in range(shape.n_user)]
+
+    names = ["default"] + ["ns" + str(i) for i in range(1, shape.n_ns)]
+
+    namespaces = []
+    for name in names:
+        labels = {}
+        for _ in range(r.randint(0, 2)):
+            labels[r.choice(keys)] = r.choice(values)
+        namespaces.append({"apiVersion": "v1", "kind": "Namespace", "metadata": {"name": name, "labels": labels}})
+
+    pods = []
+    for i in range(shape.n_pod):
+        labels = {USER: r.choice(users)}
+        for _ in range(r.randint(0, shape.pod_labels)):
+            labels[r.choice(keys)] = r.choice(values)
+        pods.append({"apiVersion": "v1", "kind": "Pod",
+            "metadata": {"name": "pod" + str(i), "namespace": r.choice(names), "labels": labels}})
+
+    def selector(objects: List[dict]) -> dict:
+        # mostly the labels of an object, so that selectors do match
+        labels = dict(r.choice(objects)["metadata"]["labels"]) if r.random() < 0.8 else \
+            {key: r.choice(values) for key in keys}
+        labels = dict(r.sample(sorted(labels.items()), min(len(labels), r.randint(0, shape.select_labels + 1))))
+        result: Dict[str, Any] = {"matchLabels": labels}
+        if r.random() < shape.expressions:
+            present = sorted({key for o in objects for key in o["metadata"]["labels"]}) or keys
+            expressions = []
+            for _ in range(r.randint(1, 2)):
+                operator = r.choice(["In", "NotIn", "Exists", "DoesNotExist"])
+                expression = {"key": r.choice(present) if r.random() < 0.8 else r.choice(keys), "operator": operator}
+                if operator in ("In", "NotIn"):
+                    expression["values"] = r.sample(values, min(len(values), r.randint(1, 3)))
+                expressions.append(expression)
+            result["matchExpressions"] = expressions
+        return result
+
+    def peer() -> dict:
+        data = {}
+        if r.random() < 0.5:
+            data["namespaceSelector"] = selector(namespaces) if r.random() < 0.7 else {}
+        if "namespaceSelector" not in data or r.random() < 0.7:
+            data["podSelector"] = selector(pods)
+        return data
+
+    policies = []
+    for i in range(shape.n_pol):
+        types = r.choice([["Ingress"], ["Egress"], ["Ingress", "Egress"]])
+        spec: Dict[str, Any] = {"podSelector": selector(pods), "policyTypes": types}
+        for direction in types:
+            peer_key = "from" if direction == "Ingress" else "to"
+            spec[direction.lower()] = [{peer_key: [peer() for _ in range(r.randint(1, shape.peers))]}
+                for _ in range(r.randint(1, shape.rules))]
+        policies.append({"apiVersion": "networking.k8s.io/v1", "kind": "NetworkPolicy",
+            "metadata": {"name": "policy" + str(i), "namespace": r.choice(names)}, "spec": spec})
+
+    return (namespaces, pods, policies), (r.random() < 0.5, r.random() < 0.5)
+
+
+def run_kano(case: Case, flags: Flags) -> Tuple[Dict[str, Any], float]:
+    cp = ConfigParser()
+    for data in case[0] + case[1] + case[2]:
+        cp.create_object(data)
+    start = perf_counter()
+    matrix = ReachabilityMatrix.build_matrix(cp.containers, cp.policies,
+        check_self_ingress_traffic=flags[0],
+        check_select_by_no_policy=flags[1],
+        namespaces=cp.namespaces)
+    results = {
+        "edges": [matrix.getrow(i) for i in range(matrix.container_size)],
+        "all_reachable": set(kano.all_reachable(matrix)),
+        "all_isolated": set(kano.all_isolated(matrix)),
+        "user_crosscheck": set(kano.user_crosscheck(matrix, cp.containers, USER)),
+    }
+    return results, perf_counter() - start
+
+
+def run_kubesv(case: Case, flags: Flags, mode: str) -> Tuple[Dict[str, Any], float]:
+    namespaces, pods, policies = (from_dicts(manifests, lite=True) for manifests in case)
+    start = perf_counter()
+    gi = build(pods, policies, namespaces,
+        check_self_ingress_traffic=flags[0],
+        check_select_by_no_policy=flags[1],
+        mode=mode)
+    results = {
+        "edges": edge_rows(gi),
+        "all_reachable": set(ksv.all_reachable_native(gi)[1]),
+        "all_isolated": set(ksv.all_isolated_native(gi)[1]),
+        "user_crosscheck": set(ksv.user_crosscheck(gi, USER)[1]),
+    }
+    return results, perf_counter() - start
+
+
+def compare(kano_results: Dict[str, Any], ksv_results: Dict[str, Any]) -> List[str]:
+    mismatches = []
+    for name, expected in kano_results.items():
+        got = ksv_results[name]
+        if name == "edges":
+            pairs = [(i, j) for i, row in enumerate(expected) for j in (row ^ got[i]).search(1)]
+            if pairs:
+                mismatches.append("edges: {} pairs differ, e.g. {} (kano {})".format(len(pairs), pairs[:5],
+                    [expected[i][j] for i, j in pairs[:5]]))
+        elif expected != got:
+            mismatches.append("{}: only kano {}, only kubesv {}".format(name, sorted(expected - got), sorted(got - expected)))
+    return mismatches
+
+
+def mismatches_of(case: Case, flags: Flags, mode: str) -> List[str]:
+    return compare(run_kano(case, flags)[0], run_kubesv(case, flags, mode)[0])
+
+
+def candidates(case: Case):
+    """
+    Smaller cases: less policies, rules, peers, pods or labels
+    """
+    namespaces, pods, policies = case
+    # chunks first, halving down to single items
+    for items, rebuild in ((policies, lambda ps: (namespaces, pods, ps)), (pods, lambda ps: (namespaces, ps, policies))):
+        size = len(items) // 2
+        while size >= 1:
+            for start in range(0, len(items), size):
+                smaller = items[:start] + items[start + size:]
+                if items is not pods or smaller:
+                    yield rebuild(smaller)
+            size //= 2
+
+    for i, policy in enumerate(policies):
+        def replaced(new_policy: dict) -> Case:
+            return namespaces, pods, policies[:i] + [new_policy] + policies[i + 1:]
+
+        spec = policy["spec"]
+        for direction in spec["policyTypes"]:
+            rules = spec[direction.lower()]
+            if len(rules) > 1:
+                for k in range(len(rules)):
+                    yield replaced(with_spec(policy, **{direction.lower(): rules[:k] + rules[k + 1:]}))
+            elif len(spec["policyTypes"]) > 1:
+                other = [d for d in spec["policyTypes"] if d != direction]
+                smaller = {k: v for k, v in spec.items() if k != direction.lower()}
+                smaller["policyTypes"] = other
+                yield replaced(dict(policy, spec=smaller))
+            peer_key = "from" if direction == "Ingress" else "to"
+            for k, rule in enumerate(rules):
+                for p in range(len(rule[peer_key]) if len(rule[peer_key]) > 1 else 0):
+                    peers = rule[peer_key][:p] + rule[peer_key][p + 1:]
+                    yield replaced(with_spec_at(policy, (direction.lower(), k, peer_key), peers))
+        for path in selector_paths(spec):
+            selector = selector_at(spec, path)
+            for key in selector.get("matchLabels") or {}:
+                labels = {k: v for k, v in selector["matchLabels"].items() if k != key}
+                yield replaced(with_spec_at(policy, path, dict(selector, matchLabels=labels)))
+            expressions = selector.get("matchExpressions") or []
+            for k in range(len(expressions)):
+                yield replaced(with_spec_at(policy, path, dict(selector, matchExpressions=expressions[:k] + expressions[k + 1:])))
+
+    for objects, rebuild in ((pods, lambda os: (namespaces, os, policies)), (namespaces, lambda os: (os, pods, policies))):
+        for i, data in enumerate(objects):
+            for key in data["metadata"]["labels"]:
+                if key != USER:
+                    labels = {k: v for k, v in data["metadata"]["labels"].items() if k != key}
+                    yield rebuild(objects[:i] + [dict(data, metadata=dict(data["metadata"], labels=labels))] + objects[i + 1:])
+
+
+def with_spec(policy: dict, **fields) -> dict:
+    return dict(policy, spec=dict(policy["spec"], **fields))
+
+
+def selector_paths(spec: dict) -> List[tuple]:
+    paths: List[tuple] = [("podSelector",)]
+    for direction in spec["policyTypes"]:
+        peer_key = "from" if direction == "Ingress" else "to"
+        for k, rule in enumerate(spec[direction.lower()]):
+            for p, peer in enumerate(rule[peer_key]):
+                paths.extend((direction.lower(), k, peer_key, p, kind) for kind in ("podSelector", "namespaceSelector")
+                    if kind in peer)
+    return paths
+
+
+def selector_at(data, path: tuple):
+    for step in path:
+        data = data[step]
+    return data
+
+
+def with_spec_at(policy: dict, path: tuple, value) -> dict:
+    """
+    The policy with the value at path of its spec replaced
+    """
+    def replace(data, path):
+        if not path:
+            return value
+        if isinstance(data, list):
+            return data[:path[0]] + [replace(data[path[0]], path[1:])] + data[path[0] + 1:]
+        return dict(data, **{path[0]: replace(data[path[0]], path[1:])})
+    return dict(policy, spec=replace(policy["spec"], path))
+
+
+def shrink(case: Case, flags: Flags, mode: str) -> Tuple[Case, List[str]]:
+    """
+    Greedily take the first smaller case still mismatching on one of the same results, until none is
+    """
+    mismatches = mismatches_of(case, flags, mode)
+    names = {mismatch.split(":")[0] for mismatch in mismatches}
+    progress = True
+    while progress:
+        progress = False
+        for smaller in candidates(case):
+            smaller_mismatches = mismatches_of(smaller, flags, mode)
+            if any(mismatch.split(":")[0] in names for mismatch in smaller_mismatches):
+                case, mismatches, progress = smaller, smaller_mismatches, True
+                break
+    return case, mismatches
+
+
+@dataclass
+class Outcome:
+    seed: int
+    n_pod: int
+    flags: Flags
+    kano_time: float
+    kubesv_time: float
+    mismatches: List[str] = field(default_factory=list)
+    # shrunk reproducer of the mismatches
+    reproducer: Optional[Case] = None
+
+
+def fuzz_one(task: Tuple[int, int, str, bool]) -> Outcome:
+    seed, n_pod, mode, shrinking = task
+    case, flags = generate(seed, n_pod)
+    kano_results, kano_time = run_kano(case, flags)
+    ksv_results, kubesv_time = run_kubesv(case, flags, mode)
+    outcome = Outcome(seed, n_pod, flags, kano_time, kubesv_time, compare(kano_results, ksv_results))
+    if outcome.mismatches:
+        if shrinking:
+            outcome.reproducer, outcome.mismatches = shrink(case, flags, mode)
+        else:
+            outcome.reproducer = case
+    return outcome
+
+
+def write_reproducer(directory: str, outcome: Outcome) -> str:
+    import yaml
+    os.makedirs(directory, exist_ok=True)
+    filename = os.path.join(directory, "mismatch-seed{}-pods{}.yml".format(outcome.seed, outcome.n_pod))
+    with open(filename, "w") as f:
+        f.write("# check_self_ingress_traffic={}, check_select_by_no_policy={}\n".format(*outcome.flags))
+        for mismatch in outcome.mismatches:
+            f.write("# {}\n".format(mismatch))
+        namespaces, pods, policies = outcome.reproducer
+        yaml.safe_dump_all(namespaces + pods + policies, f, sort_keys=False)
+    return filename
+
+
+def timing_table(outcomes: List[Outcome]) -> str:
+    lines = ["{:>8} {:>6} {:>12} {:>12} {:>10}".format("pods", "cases", "kano (ms)", "kubesv (ms)", "mismatches")]
+    for n_pod, group in itertools.groupby(sorted(outcomes, key=lambda o: o.n_pod), key=lambda o: o.n_pod):
+        group = list(group)
+        lines.append("{:>8} {:>6} {:>12.2f} {:>12.2f} {:>10}".format(n_pod, len(group),
+            1000 * sum(o.kano_time for o in group) / len(group),
+            1000 * sum(o.kubesv_time for o in group) / len(group),
+            sum(1 for o in group if o.mismatches)))
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    arg_parser = argparse.ArgumentParser(description="differential fuzzing of kano against kubesv")
+    arg_parser.add_argument("--seeds", type=int, default=20, help="clusters per size")
+    arg_parser.add_argument("--first-seed", type=int, default=0)
+    arg_parser.add_argument("--sizes", default="5,20,100,500", help="comma separated numbers of pods")
+    arg_parser.add_argument("--mode", default="z3", help="kubesv build mode (default: the z3 reference)")
+    arg_parser.add_argument("--workers", type=int, default=os.cpu_count())
+    arg_parser.add_argument("--no-shrink", action="store_true", help="report the mismatching clusters as generated")
+    arg_parser.add_argument("--out", default="mismatches", help="directory of the reproducers")
+    args = arg_parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    tasks = [(seed, n_pod, args.mode, not args.no_shrink)
+        for n_pod in sizes for seed in range(args.first_seed, args.first_seed + args.seeds)]
+    if args.workers is not None and args.workers > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            outcomes = list(executor.map(fuzz_one, tasks))
+    else:
+        outcomes = [fuzz_one(task) for task in tasks]
+
+    for outcome in outcomes:
+        if outcome.mismatches:
+            print("seed {} with {} pods, flags {}:".format(outcome.seed, outcome.n_pod, outcome.flags))
+            for mismatch in outcome.mismatches:
+                print("  " + mismatch)
+            print("  reproducer: " + write_reproducer(args.out, outcome))
+    print(timing_table(outcomes))
+    return 1 if any(outcome.mismatches for outcome in outcomes) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,3 +1,9 @@
+from bisect import bisect_right
+from dataclasses import dataclass
+from itertools import permutations, product
+from typing import DefaultDict, Dict, Iterator, List, Set, Tuple
+from bitarray import bitarray
+from bitarray.util import any_and, count_and, subset, zeros
 from .model import *
 
 
@@ -24,6 +30,64 @@ def user_hashmap(containers: List[Container], label: str) -> Dict[str, bitarray]
     return user_map
 
 
+NONE, SOME, ALL = "none", "some", "all"
+
+
+@dataclass
+class QuotientMatrix:
+    groups: List[str]
+    # group index -> member containers
+    members: List[bitarray]
+    # flags[a][b]: NONE, SOME or ALL of the pairs (member of a, other member of b) are connected
+    flags: List[List[str]]
+
+    def __getitem__(self, key: Tuple[str, str]) -> str:
+        src, dst = key
+        return self.flags[self.groups.index(src)][self.groups.index(dst)]
+
+    def format(self) -> str:
+        names = [group or "<none>" for group in self.groups]
+        width = max([len(name) for name in names] + [len(ALL)])
+        lines = [" " * width + " " + " ".join(name.rjust(width) for name in names)]
+        for name, row in zip(names, self.flags):
+            lines.append(name.rjust(width) + " " + " ".join(flag.rjust(width) for flag in row))
+        return "\n".join(lines)
+
+
+def group_quotient(matrix: ReachabilityMatrix, containers: List[Container], label: str) -> QuotientMatrix:
+    """
+    Group-by-group reachability of the containers grouped by their value of label (see user_hashmap).
+    The boolean products of the group indicators with the matrix (the OR and the AND of the rows of each group)
+    are compared with the indicator of each group, pairs of a container with itself are left out.
+    """
+    user_map = user_hashmap(containers, label)
+    groups = sorted(user_map)
+    members = [user_map[group] for group in groups]
+    n = matrix.container_size
+
+    flags = []
+    for src in members:
+        reached_by_some, reached_by_all = zeros(n), ~zeros(n)
+        for i in src.search(bitarray('1')):
+            row = matrix.getrow(i).copy()
+            row[i] = False
+            reached_by_some |= row
+            row[i] = True
+            reached_by_all &= row
+        n_src = src.count()
+        row_flags = []
+        for dst in members:
+            n_pairs = n_src * dst.count() - count_and(src, dst)
+            if n_pairs == 0 or not any_and(reached_by_some, dst):
+                row_flags.append(NONE)
+            elif subset(dst, reached_by_all):
+                row_flags.append(ALL)
+            else:
+                row_flags.append(SOME)
+        flags.append(row_flags)
+    return QuotientMatrix(groups, members, flags)
+
+
 def user_crosscheck(
         matrix: ReachabilityMatrix, 
         containers: List[Container],
@@ -55,30 +119,69 @@ def system_isolation(matrix: ReachabilityMatrix, idx: int) -> List[int]:
     return isolations
 
 
-def policy_shadow(matrix: ReachabilityMatrix, policies: List[Policy], containers: List[Container]) -> List[Tuple[int, int]]:
+def covered_pairs(sets: List[bitarray], segments=64) -> Set[Tuple[int, int]]:
     """
-    Policy shadow. 
-    The connections built by a policy are completely covered by another policy, then this policy may be redundant
-    FIXME: this algorithm doesn't seem to be sound (and also described wrongly with conflict!)
-    For Pa selects (0, 1), allows (2, 3) and Pb selects (1, 2), allows (3), it add a non-shadowed pair (Pa, Pb)
-    Otherwise, it assumes the select group won't have non-subset intersections
+    (i, j) with i != j if sets[i] is a subset of sets[j], all bitarrays have the same length.
+    Equal sets are grouped by their bytes, then each distinct set is only tested against the sets
+    with a larger popcount whose signature (the segments of the bitarray having a one) contains its own:
+    the candidates are the AND of the per-segment holder bitarrays, the subset test only runs on those.
+    Also used by kubesv (native.policy_shadow, stream).
     """
-    m = len(policies)
-    pols = set()
-    for i, container in enumerate(containers):
-        i_select = container.select_policies
-        for j in i_select:
-            for k in i_select:
-                pj = policies[j]
-                pk = policies[k]
+    return set(iter_covered_pairs(sets, segments))
 
-                if j == k:
-                    continue
-                j_allow = pj.working_allow_set
-                k_allow = pk.working_allow_set
-                if ((j_allow & k_allow) ^ k_allow).count() == 0:
-                    pols.add((j, k))
-    return pols
+
+def iter_covered_pairs(sets: List[bitarray], segments=64) -> Iterator[Tuple[int, int]]:
+    """
+    The pairs of covered_pairs as they are found, each once
+    """
+    groups: Dict[bytes, List[int]] = {}
+    for i, s in enumerate(sets):
+        groups.setdefault(s.tobytes(), []).append(i)
+    members = sorted(groups.values(), key=lambda group: sets[group[0]].count())
+    distinct = [sets[group[0]] for group in members]
+    counts = [s.count() for s in distinct]
+
+    for group in members:
+        if len(group) > 1:
+            yield from permutations(group, 2)
+    n = len(distinct)
+    length = len(distinct[0]) if distinct else 0
+    step = max(1, -(-length // segments))
+    starts = range(0, length, step)
+    # segment -> distinct sets having a one in it
+    holders = [zeros(n) for _ in starts]
+    signatures: List[List[int]] = []
+    for u, s in enumerate(distinct):
+        signature = [k for k, start in enumerate(starts) if s.find(1, start, start + step) >= 0]
+        for k in signature:
+            holders[k][u] = True
+        signatures.append(signature)
+
+    for u, s in enumerate(distinct):
+        # distinct sets with the same popcount do not contain each other
+        first = bisect_right(counts, counts[u])
+        if first == n:
+            continue
+        candidates = zeros(n)
+        candidates[first:] = True
+        for k in signatures[u]:
+            candidates &= holders[k]
+        for v in candidates.search(bitarray('1')):
+            if subset(s, distinct[v]):
+                yield from product(members[u], members[v])
+
+
+def policy_shadow(matrix: ReachabilityMatrix, policies: List[Policy], containers: List[Container]) -> Set[Tuple[int, int]]:
+    """
+    Policy shadow. 
+    The connections built by a policy are completely covered by another policy, then this policy may be redundant.
+    (j, k) if j and k have the same direction and the containers selected/allowed by j are selected/allowed by k,
+    so every connection j builds (and every container it isolates) is also built by k.
+    Requires the policy sets of build_matrix.
+    """
+    direction = {True: bitarray('10'), False: bitarray('01')}
+    return covered_pairs([direction[policy.is_ingress()] + policy.working_select_set + policy.working_allow_set
+        for policy in policies])
 
 
 def policy_conflict(matrix: ReachabilityMatrix, policies: List[Policy], containers: List[Container]) -> List[Tuple[int, int]]:
@@ -0,0 +1,244 @@
+"""
+Reachability diff between two cluster snapshots, e.g. before and after a rollout.
+
+Containers are matched by name, policies by name and occurrence (the parser names all rules of a policy alike).
+The policy sets of unchanged policies are reused from the old snapshot,
+only the containers with new or changed labels are evaluated again.
+
+ReachabilityMatrix.assemble (without granted) does not depend on the policy order:
+    matrix[i][j] = in[i][j] & out[i][j]
+    in[i][j] = (check_select_by_no_policy and j is not isolated) or some ingress policy selects i and allows j
+    out[i][j] = (check_select_by_no_policy and i is not isolated) or some egress policy selects i and allows j
+a container being isolated by the ingress policies allowing it and the egress policies selecting it.
+So a policy change only touches its select set x allow set, evaluated on the new snapshot by rows or by columns,
+as well as the rows/columns of the new containers and of those whose isolation changed.
+The other entries are those of the old matrix.
+"""
+from array import array
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set, Tuple
+from bitarray import bitarray
+from bitarray.util import zeros
+from .model import *
+
+Snapshot = Tuple[List[Container], List[Policy]]
+
+
+def iter_ones(b: bitarray):
+    return b.search(bitarray('1'))
+
+
+def index_arrays(pairs: Set[Tuple[int, int]]) -> Tuple[array, array]:
+    ordered = sorted(pairs)
+    return array('q', (i for i, _ in ordered)), array('q', (j for _, j in ordered))
+
+
+@dataclass
+class ReachabilityDiff:
+    old_containers: List[Container]
+    new_containers: List[Container]
+    # (src, dst) of the pairs only connected in the new snapshot, indices of the new containers
+    added: Tuple[array, array]
+    # (src, dst) of the pairs only connected in the old snapshot, indices of the old containers
+    removed: Tuple[array, array]
+    # number of rows and columns evaluated on the new snapshot
+    rows: int = 0
+    columns: int = 0
+
+    def __bool__(self):
+        return len(self.added[0]) > 0 or len(self.removed[0]) > 0
+
+    def added_pairs(self) -> List[Tuple[str, str]]:
+        return [(self.new_containers[i].name, self.new_containers[j].name) for i, j in zip(*self.added)]
+
+    def removed_pairs(self) -> List[Tuple[str, str]]:
+        return [(self.old_containers[i].name, self.old_containers[j].name) for i, j in zip(*self.removed)]
+
+    def summary(self, label: str) -> Dict[Tuple[str, str], Tuple[int, int]]:
+        """
+        (src label value, dst label value) -> (added, removed) pair counts, "" for containers without the label
+        """
+        added = Counter((self.new_containers[i].getValueOrDefault(label, ""),
+            self.new_containers[j].getValueOrDefault(label, "")) for i, j in zip(*self.added))
+        removed = Counter((self.old_containers[i].getValueOrDefault(label, ""),
+            self.old_containers[j].getValueOrDefault(label, "")) for i, j in zip(*self.removed))
+        return {group: (added[group], removed[group]) for group in sorted(added.keys() | removed.keys())}
+
+
+def policy_keys(policies: List[Policy]) -> List[Tuple[str, int]]:
+    seen: Dict[str, int] = Counter()
+    keys = []
+    for policy in policies:
+        keys.append((policy.name, seen[policy.name]))
+        seen[policy.name] += 1
+    return keys
+
+
+def definition(policy: Policy):
+    # everything the policy sets depend on, besides the containers
+    return (policy.direction.direction, type(policy.matcher),
+        policy.selector.labels, policy.selector.peers, policy.selector.is_allow_all, policy.selector.is_deny_all,
+        policy.allow.labels, policy.allow.peers, policy.allow.is_allow_all, policy.allow.is_deny_all)
+
+
+def isolated(policies: List[Policy], n_container: int) -> bitarray:
+    iso = zeros(n_container)
+    for policy in policies:
+        iso |= policy.working_allow_set if policy.is_ingress() else policy.working_select_set
+    return iso
+
+
+def snapshot_diff(old: Snapshot, new: Snapshot,
+        old_matrix: Optional[ReachabilityMatrix] = None,
+        check_self_ingress_traffic=True,
+        check_select_by_no_policy=True,
+        namespaces: Optional[List[Namespace]] = None) -> ReachabilityDiff:
+    """
+    Pairs of containers gaining or losing connectivity from the old snapshot to the new one.
+    old_matrix: ReachabilityMatrix.build_matrix of the old snapshot with the same flags, built if None
+    namespaces: the namespaces of the namespace selectors, their labels being the same in both snapshots
+    The policies of the new snapshot get their policy sets (Policy.store_bcp), the new matrix is not built.
+    """
+    old_containers, old_policies = old
+    new_containers, new_policies = new
+    if old_matrix is None:
+        old_matrix = ReachabilityMatrix.build_matrix(old_containers, old_policies,
+            check_self_ingress_traffic=check_self_ingress_traffic,
+            check_select_by_no_policy=check_select_by_no_policy,
+            namespaces=namespaces)
+    n_old, n_new = len(old_containers), len(new_containers)
+
+    old_index = {container.name: i for i, container in enumerate(old_containers)}
+    # new index -> old index, -1 for the new containers, and back
+    to_old = array('q', (old_index.get(container.name, -1) for container in new_containers))
+    to_new = array('q', [-1]) * n_old
+    for i, o in enumerate(to_old):
+        if o >= 0:
+            to_new[o] = i
+    # the old containers keep their indices, usual when containers are only appended
+    same_order = n_old <= n_new and all(to_old[i] == i for i in range(n_old))
+
+    def remap(b: bitarray) -> bitarray:
+        """
+        Bitarray over the old containers to one over the new containers
+        """
+        if same_order:
+            return b + zeros(n_new - n_old)
+        result = zeros(n_new)
+        for o in iter_ones(b):
+            if to_new[o] >= 0:
+                result[to_new[o]] = True
+        return result
+
+    # policy sets of the new snapshot
+    old_keys = {k for container in old_containers for k in container.labels}
+    new_keys = {k for container in new_containers for k in container.labels}
+    changed_keys = old_keys ^ new_keys
+    relabeled = [i for i, container in enumerate(new_containers)
+        if to_old[i] < 0 or old_containers[to_old[i]].labels != container.labels or
+            old_containers[to_old[i]].namespace != container.namespace]
+    namespace_labels = {namespace.name: namespace.labels for namespace in namespaces or []}
+
+    iso = zeros(n_new)
+    added_containers = bitarray([o < 0 for o in to_old])
+    # rows and columns to evaluate on the new snapshot, always those of the new containers
+    rows, columns = added_containers.copy(), added_containers.copy()
+
+    def touch(select_set: bitarray, allow_set: bitarray):
+        # the entries a policy grants are in select_set x allow_set, all in its rows or all in its columns
+        nonlocal rows, columns
+        if select_set.count() <= allow_set.count():
+            rows |= select_set
+        else:
+            columns |= allow_set
+
+    old_by_key = dict(zip(policy_keys(old_policies), old_policies))
+    for key, policy in zip(policy_keys(new_policies), new_policies):
+        previous = old_by_key.pop(key, None)
+        if previous is not None:
+            previous_sets = remap(previous.working_select_set), remap(previous.working_allow_set)
+        if previous is not None and definition(previous) == definition(policy) and \
+                not changed_keys & (policy.selector.labels.keys() | policy.allow.labels.keys()):
+            select_set, allow_set = previous_sets[0].copy(), previous_sets[1].copy()
+            for i in relabeled:
+                select_set[i] = policy.selects(new_containers[i], new_keys, namespace_labels)
+                allow_set[i] = policy.allows(new_containers[i], new_keys, namespace_labels)
+        else:
+            select_set = bitarray([policy.selects(container, new_keys, namespace_labels) for container in new_containers])
+            allow_set = bitarray([policy.allows(container, new_keys, namespace_labels) for container in new_containers])
+        policy.store_bcp(select_set, allow_set)
+        iso |= allow_set if policy.is_ingress() else select_set
+
+        if previous is None:
+            touch(select_set, allow_set)
+        elif previous.is_ingress() != policy.is_ingress():
+            touch(*previous_sets)
+            touch(select_set, allow_set)
+        else:
+            # a container joining or leaving the select set changes its row, the allow set its column
+            rows |= previous_sets[0] ^ select_set
+            columns |= previous_sets[1] ^ allow_set
+    for previous in old_by_key.values():
+        touch(remap(previous.working_select_set), remap(previous.working_allow_set))
+
+    # the isolation of a container is in its row (out) and its column (in)
+    iso_changed = iso ^ remap(isolated(old_policies, n_old))
+    rows |= iso_changed
+    columns |= iso_changed
+
+    ingress = [policy for policy in new_policies if policy.is_ingress()]
+    egress = [policy for policy in new_policies if policy.is_egress()]
+
+    def new_row(i: int) -> bitarray:
+        in_row = ~iso if check_select_by_no_policy else zeros(n_new)
+        out_row = zeros(n_new)
+        if check_select_by_no_policy and not iso[i]:
+            out_row.setall(True)
+        for policy in ingress:
+            if policy.working_select_set[i]:
+                in_row |= policy.working_allow_set
+        for policy in egress:
+            if policy.working_select_set[i]:
+                out_row |= policy.working_allow_set
+        if check_self_ingress_traffic:
+            in_row[i] = True
+        return in_row & out_row
+
+    def new_col(j: int) -> bitarray:
+        in_col = zeros(n_new)
+        if check_select_by_no_policy and not iso[j]:
+            in_col.setall(True)
+        out_col = ~iso if check_select_by_no_policy else zeros(n_new)
+        for policy in ingress:
+            if policy.working_allow_set[j]:
+                in_col |= policy.working_select_set
+        for policy in egress:
+            if policy.working_allow_set[j]:
+                out_col |= policy.working_select_set
+        if check_self_ingress_traffic:
+            in_col[j] = True
+        return in_col & out_col
+
+    added: Set[Tuple[int, int]] = set()
+    removed: Set[Tuple[int, int]] = set()
+    for i in iter_ones(rows):
+        row = new_row(i)
+        o = to_old[i]
+        old_row = remap(old_matrix.getrow(o)) if o >= 0 else zeros(n_new)
+        added.update((i, j) for j in iter_ones(row & ~old_row))
+        removed.update((o, to_old[j]) for j in iter_ones(old_row & ~row))
+    for j in iter_ones(columns):
+        col = new_col(j)
+        o = to_old[j]
+        old_col = remap(old_matrix.getcol(o)) if o >= 0 else zeros(n_new)
+        added.update((i, j) for i in iter_ones(col & ~old_col))
+        removed.update((to_old[i], o) for i in iter_ones(old_col & ~col))
+    # containers only in the old snapshot lose all their connections
+    for o in range(n_old):
+        if to_new[o] < 0:
+            removed.update((o, j) for j in iter_ones(old_matrix.getrow(o)))
+            removed.update((i, o) for i in iter_ones(old_matrix.getcol(o)))
+
+    return ReachabilityDiff(old_containers, new_containers, index_arrays(added), index_arrays(removed),
+        rows=rows.count(), columns=columns.count())
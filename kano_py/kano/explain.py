@@ -0,0 +1,130 @@
+"""
+Edge explanations: the policies supporting each direction of a container pair, or why it is not connected.
+
+From ReachabilityMatrix.assemble (see also diff.py), matrix[src][dst] = in[src][dst] & out[src][dst] where
+    in: an ingress policy selects src and allows dst, or dst is not isolated (check_select_by_no_policy) or src == dst
+    out: an egress policy selects src and allows dst, or src is not isolated (check_select_by_no_policy)
+a container being isolated by the ingress policies allowing it and the egress policies selecting it.
+Container.select_policies/allow_policies are turned once into container -> policies bitarrays,
+then explaining a pair takes a few ANDs of policy bitarrays.
+"""
+from dataclasses import dataclass
+from typing import Callable, Iterable, List, Optional, Tuple
+from bitarray import bitarray
+from bitarray.util import zeros
+from .model import *
+
+SELF_TRAFFIC = "self traffic"
+NOT_ISOLATED = "not isolated"
+
+
+def iter_ones(b: bitarray):
+    return b.search(bitarray('1'))
+
+
+@dataclass
+class DirectionExplanation:
+    allowed: bool
+    # policies allowing the traffic in this direction
+    policies: List[int]
+    # policies isolating the container this direction is checked on (dst for in, src for out)
+    isolating: List[int]
+    # why the traffic is allowed without policy, e.g. SELF_TRAFFIC or NOT_ISOLATED
+    default: Optional[str] = None
+
+
+@dataclass
+class EdgeExplanation:
+    """
+    Also the explanation of a kubesv pod pair (kubesv.explain), the containers being pods there.
+    """
+    src: int
+    dst: int
+    ingress: DirectionExplanation
+    egress: DirectionExplanation
+
+    @property
+    def connected(self) -> bool:
+        return self.ingress.allowed and self.egress.allowed
+
+    def describe(self, name: Callable[[int], str], policy_name: Callable[[int], str]) -> str:
+        """
+        name, policy_name: the name of a container/policy index
+        """
+        def policy_names(pols: List[int]) -> str:
+            return ", ".join(policy_name(p) for p in pols)
+
+        lines = ["{} -> {}: {}".format(name(self.src), name(self.dst),
+            "connected" if self.connected else "not connected")]
+        for direction, explanation, idx in (("ingress", self.ingress, self.dst), ("egress", self.egress, self.src)):
+            if explanation.policies:
+                reason = "allowed by " + policy_names(explanation.policies)
+            elif explanation.default is not None:
+                reason = "allowed, " + explanation.default
+            elif explanation.isolating:
+                reason = "denied, {} is isolated by {}, none allowing it".format(name(idx),
+                    policy_names(explanation.isolating))
+            else:
+                reason = "denied, {} is isolated by no policy".format(name(idx))
+            lines.append("  {}: {}".format(direction, reason))
+        return "\n".join(lines)
+
+
+class EdgeExplainer:
+    def __init__(self, containers: List[Container], policies: List[Policy],
+            check_self_ingress_traffic=True,
+            check_select_by_no_policy=True):
+        """
+        Requires the policy sets of ReachabilityMatrix.build_matrix (Container.select_policies/allow_policies)
+        """
+        self.containers = containers
+        self.policies = policies
+        self.check_self_ingress_traffic = check_self_ingress_traffic
+        self.check_select_by_no_policy = check_select_by_no_policy
+
+        n_policy = len(policies)
+        self.ingress = bitarray([policy.is_ingress() for policy in policies])
+        self.egress = ~self.ingress
+        # container -> policies selecting/allowing it
+        self.selecting: List[bitarray] = []
+        self.allowing: List[bitarray] = []
+        for container in containers:
+            selecting, allowing = zeros(n_policy), zeros(n_policy)
+            for i in container.select_policies:
+                selecting[i] = True
+            for i in container.allow_policies:
+                allowing[i] = True
+            self.selecting.append(selecting)
+            self.allowing.append(allowing)
+
+    def isolating(self, idx: int) -> bitarray:
+        return (self.allowing[idx] & self.ingress) | (self.selecting[idx] & self.egress)
+
+    def explain(self, src: int, dst: int) -> EdgeExplanation:
+        supporting = self.selecting[src] & self.allowing[dst]
+
+        ingress = supporting & self.ingress
+        isolating_dst = self.isolating(dst)
+        ingress_default = None
+        if self.check_self_ingress_traffic and src == dst:
+            ingress_default = SELF_TRAFFIC
+        elif self.check_select_by_no_policy and not isolating_dst.any():
+            ingress_default = NOT_ISOLATED
+
+        egress = supporting & self.egress
+        isolating_src = self.isolating(src)
+        egress_default = None
+        if self.check_select_by_no_policy and not isolating_src.any():
+            egress_default = NOT_ISOLATED
+
+        return EdgeExplanation(src, dst,
+            DirectionExplanation(ingress.any() or ingress_default is not None,
+                list(iter_ones(ingress)), list(iter_ones(isolating_dst)), ingress_default),
+            DirectionExplanation(egress.any() or egress_default is not None,
+                list(iter_ones(egress)), list(iter_ones(isolating_src)), egress_default))
+
+    def explain_pairs(self, pairs: Iterable[Tuple[int, int]]) -> List[EdgeExplanation]:
+        return [self.explain(src, dst) for src, dst in pairs]
+
+    def describe(self, src: int, dst: int) -> str:
+        return self.explain(src, dst).describe(lambda i: self.containers[i].name, lambda p: self.policies[p].name)
@@ -1,13 +1,23 @@
 """
 Kubernetes configuration files models
 """
-from kubesv.kubesv.constraint import build
-from typing import *
-from typing_extensions import *
+from typing import Any, DefaultDict, Dict, FrozenSet, Iterator, List, Optional, Set, Tuple, TypeVar, Union
+from typing_extensions import Protocol
 from dataclasses import dataclass, field
+from bisect import bisect_left, bisect_right
 from bitarray import bitarray
+from bitarray.util import zeros
 from abc import abstractmethod
 
+MIN_PORT = 1
+MAX_PORT = 65535
+
+DEFAULT_NAMESPACE = "default"
+
+# matchExpressions operators
+IN, NOT_IN, EXISTS, DOES_NOT_EXIST = "In", "NotIn", "Exists", "DoesNotExist"
+OPERATORS = (IN, NOT_IN, EXISTS, DOES_NOT_EXIST)
+
 
 @dataclass
 class Container:
@@ -16,6 +26,7 @@ class Container:
 
     select_policies: List[int] = field(default_factory=list)
     allow_policies: List[int] = field(default_factory=list)
+    namespace: str = DEFAULT_NAMESPACE
 
     def getValueOrDefault(self, key: str, value: str):
         if key in self.labels:
@@ -26,9 +37,83 @@ class Container:
         return self.labels
 
 
+@dataclass
+class Namespace:
+    name: str
+    labels: Dict[str, str] = field(default_factory=dict)
+
+
+@dataclass
+class LabelExpression:
+    key: str
+    operator: str
+    # for In and NotIn
+    values: List[str] = field(default_factory=list)
+
+    def matches(self, labels: Dict[str, str]) -> bool:
+        if self.operator == EXISTS:
+            return self.key in labels
+        if self.operator == DOES_NOT_EXIST:
+            return self.key not in labels
+        found = self.key in labels and labels[self.key] in self.values
+        # NotIn also matches the objects without the key
+        return found if self.operator == IN else not found
+
+
+@dataclass
+class LabelSelector:
+    """
+    matchLabels and matchExpressions, all ANDed, the empty selector matches all objects
+    """
+    match_labels: Dict[str, str] = field(default_factory=dict)
+    match_expressions: List[LabelExpression] = field(default_factory=list)
+
+    def requirements(self) -> FrozenSet[Tuple[str, str, Tuple[str, ...]]]:
+        """
+        (key, operator, sorted values) requirements, matchLabels {k: v} as (k, In, (v,)),
+        equivalent selectors have the same requirements
+        """
+        reqs = {(k, IN, (v,)) for k, v in self.match_labels.items()}
+        reqs.update((e.key, e.operator, tuple(sorted(set(e.values))) if e.operator in (IN, NOT_IN) else ())
+            for e in self.match_expressions)
+        return frozenset(reqs)
+
+    def matches(self, labels: Dict[str, str]) -> bool:
+        return all(labels.get(k) == v for k, v in self.match_labels.items()) and \
+            all(e.matches(labels) for e in self.match_expressions)
+
+
+@dataclass
+class PolicyPeer:
+    """
+    The containers matching pod_selector (all if None) in the namespaces matching namespace_selector,
+    in namespace if namespace_selector is None. An ipBlock peer matches no container.
+    """
+    pod_selector: Optional[LabelSelector] = None
+    namespace_selector: Optional[LabelSelector] = None
+    namespace: str = DEFAULT_NAMESPACE
+    ip_block: bool = False
+
+    def matches(self, container: Container, namespace_labels: Dict[str, Dict[str, str]]) -> bool:
+        if self.ip_block:
+            return False
+        if self.namespace_selector is None:
+            if container.namespace != self.namespace:
+                return False
+        elif not self.namespace_selector.matches(namespace_labels.get(container.namespace, {})):
+            return False
+        return self.pod_selector is None or self.pod_selector.matches(container.labels)
+
+
+# all containers of all namespaces, e.g. a rule without from/to
+ANY_PEER = PolicyPeer(None, LabelSelector())
+
+
 @dataclass
 class PolicySelect:
     labels: Dict[str, str]
+    # OR-ed peers with the Kubernetes selector semantics (see SelectorIndex), None to match labels as kano does
+    peers: Optional[List[PolicyPeer]] = None
     is_allow_all = False
     is_deny_all = False
 
@@ -36,10 +121,97 @@ class PolicySelect:
 @dataclass
 class PolicyAllow:
     labels: Dict[str, str]
+    # see PolicySelect, an empty list matches no container
+    peers: Optional[List[PolicyPeer]] = None
     is_allow_all = False
     is_deny_all = False
 
 
+def index_labels(labels: List[Dict[str, str]]) -> Tuple[Dict[str, Dict[str, bitarray]], Dict[str, bitarray]]:
+    """
+    key -> value -> objects with it, key -> objects having the key
+    """
+    values: Dict[str, Dict[str, bitarray]] = {}
+    exists: Dict[str, bitarray] = {}
+    for i, object_labels in enumerate(labels):
+        for key, value in object_labels.items():
+            by_value = values.setdefault(key, {})
+            if value not in by_value:
+                by_value[value] = zeros(len(labels))
+            by_value[value][i] = True
+            if key not in exists:
+                exists[key] = zeros(len(labels))
+            exists[key][i] = True
+    return values, exists
+
+
+class SelectorIndex:
+    """
+    Label indices of the containers and of their namespaces, evaluating PolicyPeers with bitarray operations.
+    Namespaces without a Namespace object have no labels. Selector results are cached by their requirements.
+    """
+    def __init__(self, containers: List[Container], namespaces: Optional[List[Namespace]] = None):
+        self.n = len(containers)
+        self.values, self.exists = index_labels([container.labels for container in containers])
+        # namespace -> its containers
+        self.namespace_containers: Dict[str, bitarray] = {}
+        for i, container in enumerate(containers):
+            if container.namespace not in self.namespace_containers:
+                self.namespace_containers[container.namespace] = zeros(self.n)
+            self.namespace_containers[container.namespace][i] = True
+
+        namespace_labels = {namespace.name: namespace.labels for namespace in namespaces or []}
+        self.namespaces = sorted(namespace_labels.keys() | self.namespace_containers.keys())
+        self.namespace_values, self.namespace_exists = \
+            index_labels([namespace_labels.get(name, {}) for name in self.namespaces])
+        self.selectors: Dict[Tuple[bool, FrozenSet], bitarray] = {}
+
+    def select(self, selector: LabelSelector, is_namespace=False) -> bitarray:
+        """
+        The matching containers (namespaces), shared between equivalent selectors and must not be modified
+        """
+        key = (is_namespace, selector.requirements())
+        if key not in self.selectors:
+            values, exists, n = self.values, self.exists, self.n
+            if is_namespace:
+                values, exists, n = self.namespace_values, self.namespace_exists, len(self.namespaces)
+            selected = ~zeros(n)
+            for k, operator, vals in key[1]:
+                if operator in (EXISTS, DOES_NOT_EXIST):
+                    matched = exists.get(k, zeros(n))
+                else:
+                    matched = zeros(n)
+                    for v in vals:
+                        if v in values.get(k, {}):
+                            matched |= values[k][v]
+                if operator in (NOT_IN, DOES_NOT_EXIST):
+                    selected &= ~matched
+                else:
+                    selected &= matched
+            self.selectors[key] = selected
+        return self.selectors[key]
+
+    def peer(self, peer: PolicyPeer) -> bitarray:
+        if peer.ip_block:
+            return zeros(self.n)
+        if peer.namespace_selector is None:
+            selected = self.namespace_containers.get(peer.namespace, zeros(self.n)).copy()
+        else:
+            selected = zeros(self.n)
+            namespaces = self.select(peer.namespace_selector, is_namespace=True)
+            for k in namespaces.search(bitarray('1')):
+                selected |= self.namespace_containers.get(self.namespaces[k], zeros(self.n))
+        if peer.pod_selector is not None:
+            selected &= self.select(peer.pod_selector)
+        return selected
+
+    def peers(self, peers: List[PolicyPeer]) -> bitarray:
+        selected = zeros(self.n)
+        for peer in peers:
+            selected |= self.peer(peer)
+        return selected
+
+
 @dataclass
 class PolicyDirection:
     # true for ingression, false for egress
@@ -56,9 +228,121 @@ PolicyIngress = PolicyDirection(True)
 PolicyEgress = PolicyDirection(False)
 
 
+@dataclass
+class PolicyPort:
+    protocol: str = "TCP"
+    # None matches all ports, a name is not resolved (matches no numerical port)
+    port: Optional[Union[int, str]] = None
+    end_port: Optional[int] = None
+
+
 @dataclass
 class PolicyProtocol:
+    # flat [protocol, port, ...] pairs, e.g. ["TCP", "3306"]
     protocols: List[str]
+    ports: Optional[List[PolicyPort]] = None
+
+    def get_ports(self) -> List[PolicyPort]:
+        if self.ports is not None:
+            return self.ports
+        return [PolicyPort(self.protocols[i], self.protocols[i + 1]) for i in range(0, len(self.protocols) - 1, 2)]
+
+    def port_ranges(self) -> Optional[List[Tuple[str, int, int]]]:
+        """
+        (protocol, first, last) ranges, None if all ports are matched
+        """
+        ports = self.get_ports()
+        if not ports:
+            return None
+        ranges = []
+        for p in ports:
+            port = p.port
+            if isinstance(port, str) and port.isdigit():
+                port = int(port)
+            if port is None:
+                ranges.append((p.protocol, MIN_PORT, MAX_PORT))
+            elif isinstance(port, int):
+                ranges.append((p.protocol, port, p.end_port if p.end_port is not None else port))
+        return ranges
+
+
+class PortPartition:
+    """
+    The port space of each protocol cut into the intervals no policy port range splits.
+    Intervals covered by the same policies share a class, all ports of a class are allowed by the same policies.
+    Policies matching all ports are in every class and are left out.
+    Also the port partition of kubesv (kubesv.ports), where the ranges are those of the policy rules.
+    """
+    def __init__(self, policy_ranges: List[Optional[List[Tuple[str, int, int]]]]):
+        """
+        policy_ranges: policy (or rule) index -> (protocol, first, last) ranges, None if it matches all ports
+        """
+        cuts: Dict[str, set] = {}
+        for ranges in policy_ranges:
+            for protocol, first, last in ranges or []:
+                check_port(first)
+                check_port(last)
+                if first > last:
+                    raise ValueError("invalid port range {}-{}".format(first, last))
+                cuts.setdefault(protocol, {MIN_PORT}).update((first, last + 1))
+
+        # protocol -> sorted interval starts, the last interval ends at MAX_PORT
+        self.starts: Dict[str, List[int]] = {}
+        covers: Dict[str, List[set]] = {}
+        for protocol, points in cuts.items():
+            points.discard(MAX_PORT + 1)
+            self.starts[protocol] = sorted(points)
+            covers[protocol] = [set() for _ in points]
+        for i, ranges in enumerate(policy_ranges):
+            for protocol, first, last in ranges or []:
+                starts = self.starts[protocol]
+                for k in range(bisect_left(starts, first), bisect_left(starts, last + 1)):
+                    covers[protocol][k].add(i)
+
+        # class 0: ports no policy restricts to
+        self.classes: List[FrozenSet[int]] = [frozenset()]
+        class_map = {frozenset(): 0}
+        # protocol -> class index of each interval
+        self.interval_class: Dict[str, List[int]] = {}
+        for protocol in self.starts:
+            starts, classes = [], []
+            for start, cover in zip(self.starts[protocol], covers[protocol]):
+                cover = frozenset(cover)
+                if cover not in class_map:
+                    class_map[cover] = len(self.classes)
+                    self.classes.append(cover)
+                # adjacent intervals of the same class are merged
+                if classes and classes[-1] == class_map[cover]:
+                    continue
+                starts.append(start)
+                classes.append(class_map[cover])
+            self.starts[protocol] = starts
+            self.interval_class[protocol] = classes
+
+    @property
+    def n_classes(self) -> int:
+        return len(self.classes)
+
+    def class_of(self, protocol: str, port: int) -> int:
+        check_port(port)
+        if protocol not in self.starts:
+            return 0
+        return self.interval_class[protocol][bisect_right(self.starts[protocol], port) - 1]
+
+    def intervals(self) -> Iterator[Tuple[str, int, int, int]]:
+        """
+        All (protocol, first, last, class) intervals of the partition, protocols no policy mentions are omitted
+        """
+        for protocol, starts in self.starts.items():
+            classes = self.interval_class[protocol]
+            for i, start in enumerate(starts):
+                last = starts[i + 1] - 1 if i + 1 < len(starts) else MAX_PORT
+                yield protocol, start, last, classes[i]
+
+
+def check_port(port: int):
+    if not MIN_PORT <= port <= MAX_PORT:
+        raise ValueError("port {} out of range [{}, {}]".format(port, MIN_PORT, MAX_PORT))
 
 
 T = TypeVar('T')
@@ -115,6 +399,32 @@ class Policy:
                 return False
         return True
 
+    def selects(self, container: Container, keys: Set[str],
+            namespace_labels: Optional[Dict[str, Dict[str, str]]] = None) -> bool:
+        """
+        Whether the container is in the select set of build_policy_sets,
+        keys: the label keys of all containers (the other selector keys are ignored without peers)
+        namespace_labels: namespace -> labels, for the namespace selectors of the peers
+        """
+        selector = self.working_selector
+        if selector.is_allow_all or selector.is_deny_all:
+            return selector.is_allow_all
+        if selector.peers is not None:
+            return any(peer.matches(container, namespace_labels or {}) for peer in selector.peers)
+        return all(k in container.labels for k in selector.labels if k in keys) and self.select_policy(container)
+
+    def allows(self, container: Container, keys: Set[str],
+            namespace_labels: Optional[Dict[str, Dict[str, str]]] = None) -> bool:
+        """
+        Whether the container is in the allow set of build_policy_sets, see selects
+        """
+        allow = self.working_allow
+        if allow.is_allow_all or allow.is_deny_all:
+            return allow.is_allow_all
+        if allow.peers is not None:
+            return any(peer.matches(container, namespace_labels or {}) for peer in allow.peers)
+        return all(k in container.labels for k in allow.labels if k in keys) and self.allow_policy(container)
+
     def is_ingress(self):
         return self.direction.is_ingress()
 
@@ -125,48 +435,68 @@ class Policy:
         self.working_select_set = select_set
         self.working_allow_set = allow_set
 
+    def port_ranges(self) -> Optional[List[Tuple[str, int, int]]]:
+        if self.protocol is None:
+            return None
+        return self.protocol.port_ranges()
+
 
 class ReachabilityMatrix:
     @staticmethod
     def build_matrix(containers: List[Container], policies: List[Policy], 
             check_self_ingress_traffic=True, 
             check_select_by_no_policy=True,
-            build_transpose_matrix=False):
+            build_transpose_matrix=False,
+            namespaces: Optional[List[Namespace]] = None):
+        policy_sets = ReachabilityMatrix.build_policy_sets(containers, policies, namespaces)
+        return ReachabilityMatrix.assemble(len(containers), policies, policy_sets,
+            check_self_ingress_traffic=check_self_ingress_traffic,
+            check_select_by_no_policy=check_select_by_no_policy,
+            build_transpose_matrix=build_transpose_matrix)
+
+    @staticmethod
+    def build_policy_sets(containers: List[Container], policies: List[Policy],
+            namespaces: Optional[List[Namespace]] = None) -> List[Tuple[bitarray, bitarray]]:
+        """
+        (select_set, allow_set) of each policy, these do not depend on ports.
+        Selectors with peers (e.g. from ConfigParser) are evaluated on a SelectorIndex of the containers and namespaces,
+        the others by their labels, ignoring the keys no container has.
+        """
         n_container = len(containers)
         labelMap: Dict[str, bitarray] = DefaultDict(lambda: bitarray('0' * n_container))
-        have_seen = bitarray('0' * n_container)
-        in_matrix = [bitarray('1' * n_container) for _ in range(n_container)]
-        out_matrix = [bitarray('1' * n_container) for _ in range(n_container)]
-        if not check_select_by_no_policy:
-            in_matrix = [bitarray('0' * n_container) for _ in range(n_container)]
-            out_matrix = [bitarray('0' * n_container) for _ in range(n_container)]
-            have_seen = bitarray('1' * n_container)
+        index: Optional[SelectorIndex] = None
+        policy_sets = []
 
         for i, container in enumerate(containers):
             for key, value in container.labels.items():
                 labelMap[key][i] = True
 
-        for i, policy in enumerate(policies):
-            select_set = bitarray(n_container)
-            select_set.setall(True)
-            allow_set = bitarray(n_container)
-            allow_set.setall(True)
-
-            # work as all direction being egress
-            for k, v in policy.working_selector.labels.items():
-                if k in labelMap.keys():
-                    select_set &= labelMap[k]
-            for k, v in policy.working_allow.labels.items():
+        def label_set(labels: Dict[str, str], predicate) -> bitarray:
+            selected = bitarray(n_container)
+            selected.setall(True)
+            for k, v in labels.items():
                 if k in labelMap.keys():
-                    allow_set &= labelMap[k]
-            
+                    selected &= labelMap[k]
             # dealing with not matched values (needs a customized predicate)
-            for idx in range(n_container):
-                if select_set[idx] and not policy.select_policy(containers[idx]):
-                    select_set[idx] = False
-                if allow_set[idx] and not policy.allow_policy(containers[idx]):
-                    allow_set[idx] = False
-            
+            for idx in list(selected.search(bitarray('1'))):
+                if not predicate(containers[idx]):
+                    selected[idx] = False
+            return selected
+
+        for i, policy in enumerate(policies):
+            # work as all direction being egress
+            selector, allow = policy.working_selector, policy.working_allow
+            if index is None and (selector.peers is not None or allow.peers is not None):
+                index = SelectorIndex(containers, namespaces)
+            if selector.peers is not None:
+                select_set = index.peers(selector.peers)
+            else:
+                select_set = label_set(selector.labels, policy.select_policy)
+            if allow.peers is not None:
+                allow_set = index.peers(allow.peers)
+            else:
+                allow_set = label_set(allow.labels, policy.allow_policy)
+
             policy.store_bcp(select_set, allow_set)
 
             if policy.working_allow.is_allow_all:
@@ -179,6 +509,36 @@ class ReachabilityMatrix:
             elif policy.working_selector.is_deny_all:
                 select_set.setall(False)            
 
+            for idx in range(n_container):
+                if allow_set[idx]:
+                    containers[idx].allow_policies.append(i)
+            for idx in range(n_container):
+                if select_set[idx]:
+                    containers[idx].select_policies.append(i)
+            policy_sets.append((select_set, allow_set))
+
+        return policy_sets
+
+    @staticmethod
+    def assemble(n_container: int, policies: List[Policy], policy_sets: List[Tuple[bitarray, bitarray]],
+            check_self_ingress_traffic=True,
+            check_select_by_no_policy=True,
+            build_transpose_matrix=False,
+            granted: Optional[bitarray] = None):
+        """
+        Reachability matrix from the policy sets.
+        Policies not in granted (all if None) still isolate the containers they apply to, but allow nothing.
+        """
+        have_seen = bitarray('0' * n_container)
+        in_matrix = [bitarray('1' * n_container) for _ in range(n_container)]
+        out_matrix = [bitarray('1' * n_container) for _ in range(n_container)]
+        if not check_select_by_no_policy:
+            in_matrix = [bitarray('0' * n_container) for _ in range(n_container)]
+            out_matrix = [bitarray('0' * n_container) for _ in range(n_container)]
+            have_seen = bitarray('1' * n_container)
+
+        for i, policy in enumerate(policies):
+            select_set, allow_set = policy_sets[i]
             for idx in range(n_container):
                 if allow_set[idx]:
                     if policy.is_ingress() and not have_seen[idx]:
@@ -186,7 +546,6 @@ class ReachabilityMatrix:
                         for j in range(n_container):
                             in_matrix[j][idx] = False
                         have_seen[idx] = True
-                    containers[idx].allow_policies.append(i)
             for idx in range(n_container):
                 if select_set[idx]:
                     if policy.is_egress() and not have_seen[idx]:
@@ -194,11 +553,12 @@ class ReachabilityMatrix:
                         for j in range(n_container):
                             in_matrix[j][idx] = False
                         have_seen[idx] = True
+                    if granted is not None and not granted[i]:
+                        continue
                     if policy.is_ingress():   
                         in_matrix[idx] |= allow_set
                     else:
                         out_matrix[idx] |= allow_set
-                    containers[idx].select_policies.append(i)
 
         matrix = [bitarray('0' * n_container) for _ in range(n_container)]
         for i in range(n_container):
@@ -237,3 +597,42 @@ class ReachabilityMatrix:
         for i in range(self.container_size):
             value[i] = self.matrix[i][index]
         return value
+
+
+class PortReachabilityMatrix:
+    """
+    Port-aware reachability: one ReachabilityMatrix per class of the PortPartition, built on demand.
+    The policy sets are computed once and shared by all classes.
+    """
+    def __init__(self, containers: List[Container], policies: List[Policy],
+            check_self_ingress_traffic=True,
+            check_select_by_no_policy=True,
+            namespaces: Optional[List[Namespace]] = None):
+        self.container_size = len(containers)
+        self.policies = policies
+        self.check_self_ingress_traffic = check_self_ingress_traffic
+        self.check_select_by_no_policy = check_select_by_no_policy
+        self.policy_sets = ReachabilityMatrix.build_policy_sets(containers, policies, namespaces)
+
+        policy_ranges = [policy.port_ranges() for policy in policies]
+        self.partition = PortPartition(policy_ranges)
+        # policies matching all ports are granted in every class
+        self.all_ports = bitarray([ranges is None for ranges in policy_ranges])
+        self.matrices: Dict[int, ReachabilityMatrix] = {}
+
+    def matrix_of_class(self, port_class: int) -> ReachabilityMatrix:
+        if port_class not in self.matrices:
+            granted = self.all_ports.copy()
+            for i in self.partition.classes[port_class]:
+                granted[i] = True
+            self.matrices[port_class] = ReachabilityMatrix.assemble(self.container_size, self.policies, self.policy_sets,
+                check_self_ingress_traffic=self.check_self_ingress_traffic,
+                check_select_by_no_policy=self.check_select_by_no_policy,
+                granted=granted)
+        return self.matrices[port_class]
+
+    def matrix_on(self, protocol: str, port: int) -> ReachabilityMatrix:
+        return self.matrix_of_class(self.partition.class_of(protocol, port))
+
+    def can_reach(self, src: int, dst: int, protocol: str, port: int) -> bool:
+        return bool(self.matrix_on(protocol, port)[src, dst])
@@ -1,18 +1,24 @@
 from .model import *
 
-from yaml import load, dump
 import os
 
-try:
-    from yaml import CLoader as Loader, CDumper as Dumper
-except ImportError:
-    from yaml import Loader, Dumper
+
+def load(stream):
+    # NOTE: yaml is only imported once a file is actually parsed
+    import yaml
+    try:
+        from yaml import CLoader as Loader
+    except ImportError:
+        from yaml import Loader
+    return yaml.load(stream, Loader=Loader)
+
 
 class ConfigParser:
     def __init__(self, filepath=None):
         self.filepath = filepath
         self.containers = []
         self.policies = []
+        self.namespaces = []
 
     def parse(self, filepath=None): 
         if filepath == None:
@@ -25,7 +31,7 @@ class ConfigParser:
         if os.path.isfile(filepath):
             try:
                 with open(filepath) as f:
-                    data = load(f, Loader=Loader)
+                    data = load(f)
                     #print(data)
                     self.create_object(data)
 
@@ -40,7 +46,7 @@ class ConfigParser:
                         filename = os.path.join(subdir, file)
 
                         with open(filename) as f:
-                            data = load(f, Loader=Loader)
+                            data = load(f)
                             #print(data)
                             self.create_object(data)
             except:
@@ -50,42 +56,65 @@ class ConfigParser:
         return self.containers, self.policies
 
     def create_object(self, data):
+        metadata = data.get('metadata') or {}
+        namespace = metadata.get('namespace') or DEFAULT_NAMESPACE
         if data['kind'] == 'NetworkPolicy':
-            select = data['spec']['podSelector']['matchLabels']
-            if 'Ingress' in data['spec']['policyTypes']:
-                for ing in data['spec']['ingress']:
-                    allow = None
-                    ports = None
-                    for f in ing['from']:
-                        if 'podSelector' in f:
-                            allow = f['podSelector']['matchLabels']
-                        if 'ports' in f:
-                            ports = [f['ports']['protocol'], f['ports']['port']]
-                    new_policy = Policy(data['metadata']['name']+'-ingress', PolicySelect(select), PolicyAllow(allow), PolicyIngress, ports)
-                    self.policies.append(new_policy)
-
-            if 'Egress' in data['spec']['policyTypes']:
-                for eg in data['spec']['egress']:
-                    allow = None
-                    ports = None
-                    for t in eg['to']:
-                        if 'podSelector' in t:
-                            allow = t['podSelector']['matchLabels']
-                        if 'ports' in t:
-                            ports = [t['ports']['protocol'], t['ports']['port']]
-                    new_policy = Policy(data['metadata']['name']+'-egress', PolicySelect(select), PolicyAllow(allow), PolicyEgress, ports)
-                    self.policies.append(new_policy)
+            spec = data['spec']
+            pod_selector = spec.get('podSelector') or {}
+            select = PolicySelect(dict(pod_selector.get('matchLabels') or {}),
+                [PolicyPeer(self.create_selector(pod_selector), namespace=namespace)])
+            # Ingress is always a policy type unless policyTypes is given, Egress only with egress rules
+            types = spec.get('policyTypes') or ['Ingress'] + (['Egress'] if spec.get('egress') else [])
+            for policy_type, direction, peer_field in (('Ingress', PolicyIngress, 'from'), ('Egress', PolicyEgress, 'to')):
+                if policy_type not in types:
+                    continue
+                name = metadata['name'] + '-' + policy_type.lower()
+                rules = spec.get(policy_type.lower()) or []
+                if not rules:
+                    # the selected containers are isolated, nothing is allowed
+                    self.policies.append(Policy(name, select, PolicyAllow({}, []), direction, None))
+                for rule in rules:
+                    # a rule without peers matches all containers
+                    peers = [self.create_peer(peer, namespace) for peer in rule.get(peer_field) or []] or [ANY_PEER]
+                    ports = self.create_protocol(rule.get('ports'))
+                    self.policies.append(Policy(name, select, PolicyAllow({}, peers), direction, ports))
 
         elif data['kind'] == 'Pod':
-            labels = data['metadata']['labels']
+            labels = metadata.get('labels') or {}
             # XXX: use pod name as container name since they are the label owners
             """
             for container in data['spec']['containers']:
                 new_container = Container(container['name'], labels)
             """
-            new_container = Container(data['metadata']['name'], labels)
+            new_container = Container(metadata['name'], labels, namespace=namespace)
             self.containers.append(new_container)
 
+        elif data['kind'] == 'Namespace':
+            self.namespaces.append(Namespace(metadata['name'], metadata.get('labels') or {}))
+
+    @staticmethod
+    def create_selector(selector) -> Optional[LabelSelector]:
+        # a null selector is None, the empty one {} matches all objects
+        if selector is None:
+            return None
+        expressions = []
+        for e in selector.get('matchExpressions') or []:
+            if e['operator'] not in OPERATORS:
+                raise ValueError("unsupported operator {}".format(e['operator']))
+            expressions.append(LabelExpression(e['key'], e['operator'], list(e.get('values') or [])))
+        return LabelSelector(dict(selector.get('matchLabels') or {}), expressions)
+
+    @staticmethod
+    def create_peer(peer, namespace: str) -> PolicyPeer:
+        return PolicyPeer(ConfigParser.create_selector(peer.get('podSelector')),
+            ConfigParser.create_selector(peer.get('namespaceSelector')), namespace, 'ipBlock' in peer)
+
+    @staticmethod
+    def create_protocol(ports):
+        # ports belong to the rule, not to its peers; missing or empty matches all ports
+        if not ports:
+            return None
+        return PolicyProtocol([], [PolicyPort(p.get('protocol', 'TCP'), p.get('port'), p.get('endPort')) for p in ports])
 
     def print_all(self):
         for c in self.containers:
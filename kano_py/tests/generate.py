@@ -2,7 +2,7 @@ import os
 import random
 import yaml
 from collections import OrderedDict
-from ..kano.model import *
+from kano.model import *
 
 class ConfigFiles:
     def __init__(self, directory='data', podN=100,nsN=5,policyN=50,podLL=5,nsLL=5,keyL=5,valueL=10,userL=5,selectedLL=3,allowNSLL=3,allowpodLL=3):
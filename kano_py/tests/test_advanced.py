@@ -1,7 +1,19 @@
 # -*- coding: utf-8 -*-
 
 from .context import sample
+from kano.algorithm import ALL, NONE, SOME, covered_pairs, group_quotient, policy_shadow
+from kano.diff import snapshot_diff
+from kano.explain import EdgeExplainer
+from kano.exposure import OUT, container_groups, degree_report
+from kano.model import Container, PolicyAllow, PortReachabilityMatrix, ReachabilityMatrix
+from kano.parser import ConfigParser
+from bitarray.util import subset, urandom, zeros
 
+import itertools
+
+import os
+import subprocess
+import sys
 import unittest
 
 
@@ -11,6 +23,189 @@ class AdvancedTestSuite(unittest.TestCase):
     def test_thoughts(self):
         self.assertIsNone(None)
 
+    def test_port_reachability(self):
+        containers, policies = sample.paper_example()
+        matrix = ReachabilityMatrix.build_matrix(containers, policies)
+        containers, policies = sample.paper_example()
+        port_matrix = PortReachabilityMatrix(containers, policies)
+
+        partition = port_matrix.partition
+        # TCP/3306 (A, C, D), TCP/8080 (B) and the ports no policy mentions
+        self.assertEqual(len(partition.classes), 3)
+        self.assertNotEqual(partition.class_of("TCP", 3306), partition.class_of("TCP", 8080))
+        self.assertEqual(partition.class_of("TCP", 22), 0)
+        self.assertEqual(partition.class_of("UDP", 3306), 0)
+
+        # User -> Tomcat is only allowed by B, on TCP/8080
+        self.assertTrue(matrix[4, 2])
+        self.assertTrue(port_matrix.can_reach(4, 2, "TCP", 8080))
+        self.assertFalse(port_matrix.can_reach(4, 2, "TCP", 3306))
+        self.assertFalse(port_matrix.can_reach(4, 2, "UDP", 8080))
+
+    def test_policy_shadow(self):
+        containers, policies = sample.paper_example()
+        matrix = ReachabilityMatrix.build_matrix(containers, policies)
+        # C: Tomcat -> Nginx is covered by D: Alice -> Nginx, not the other way
+        self.assertEqual(policy_shadow(matrix, policies, containers), {(2, 3)})
+
+        sets = [urandom(50) | urandom(50) for _ in range(30)]
+        # duplicates, a strict subset, the empty and the full set
+        sets += [sets[0].copy(), sets[1] & sets[2], zeros(50), ~zeros(50)]
+        expected = {(i, j) for i, j in itertools.permutations(range(len(sets)), 2) if subset(sets[i], sets[j])}
+        for segments in (1, 7, 64, 100):
+            self.assertEqual(covered_pairs(sets, segments), expected)
+
+    def test_snapshot_diff(self):
+        def edges(containers, policies):
+            matrix = ReachabilityMatrix.build_matrix(containers, policies)
+            return {(a.name, b.name) for i, a in enumerate(containers) for j, b in enumerate(containers) if matrix[i, j]}
+
+        old = sample.paper_example()
+        before = edges(*sample.paper_example())
+        containers, policies = sample.paper_example()
+        # Bob's Nginx leaves, a new Tomcat comes, D only allows Alice's Tomcat
+        containers.pop(3)
+        containers.append(Container("F", {"app": "Alice", "role": "Tomcat"}))
+        policies[3].allow = PolicyAllow({"role": "Tomcat"})
+
+        diff = snapshot_diff(old, (containers, policies))
+        after = edges(containers, policies)
+        self.assertEqual(set(diff.added_pairs()), after - before)
+        self.assertEqual(set(diff.removed_pairs()), before - after)
+        # User -> the new Tomcat through B
+        self.assertEqual(diff.added_pairs(), [("E", "F")])
+        self.assertEqual(diff.summary("app"), {("User", "Alice"): (1, 0)})
+        # nothing changed
+        self.assertFalse(snapshot_diff(old, old))
+
+    def test_explain_edges(self):
+        containers, policies = sample.paper_example()
+        n = len(containers)
+        for flags in itertools.product([False, True], repeat=2):
+            containers, policies = sample.paper_example()
+            matrix = ReachabilityMatrix.build_matrix(containers, policies, *flags)
+            explanations = EdgeExplainer(containers, policies, *flags).explain_pairs(itertools.product(range(n), range(n)))
+            self.assertEqual([e.connected for e in explanations], [matrix[i, j] for i in range(n) for j in range(n)])
+
+        explainer = EdgeExplainer(containers, policies)
+        # User -> Tomcat through B, on ingress
+        explanation = explainer.explain(4, 2)
+        self.assertEqual(explanation.ingress.policies, [1])
+        self.assertIn("ingress: allowed by B", explainer.describe(4, 2))
+        self.assertFalse(explainer.explain(2, 4).connected)
+
+    def test_exposure_report(self):
+        containers, policies = sample.paper_example()
+        n = len(containers)
+        matrix = ReachabilityMatrix.build_matrix(containers, policies)
+        report = degree_report(matrix)
+        for i in range(n):
+            self.assertEqual(report.out_degree[i], matrix.getrow(i).count() - matrix[i, i])
+            self.assertEqual(report.in_degree[i], matrix.getcol(i).count() - matrix[i, i])
+        # the rows alone, as kubesv passes its edge rows
+        self.assertEqual(degree_report(matrix.matrix), report)
+
+        self.assertEqual(report.most_exposed(1)[0][1], max(report.in_degree))
+        self.assertEqual(sum(count for _, _, count in report.histogram(OUT)), n)
+        by_app = report.top_by_group(container_groups(containers, "app"), 1, OUT)
+        self.assertEqual(set(by_app), {"Alice", "Bob", "User"})
+        self.assertEqual(by_app["User"], [(4, report.out_degree[4])])
+
+    def test_group_quotient(self):
+        containers, policies = sample.paper_example()
+        matrix = ReachabilityMatrix.build_matrix(containers, policies)
+
+        # the only connection is User -> Tomcat (C)
+        by_role = group_quotient(matrix, containers, "role")
+        self.assertEqual(by_role.groups, ["DB", "Nginx", "Tomcat", "User"])
+        self.assertEqual(by_role["User", "Tomcat"], ALL)
+        self.assertEqual(sum(flag != NONE for row in by_role.flags for flag in row), 1)
+
+        # C is one of Alice's three containers
+        by_app = group_quotient(matrix, containers, "app")
+        self.assertEqual(by_app["User", "Alice"], SOME)
+        self.assertEqual(by_app["Alice", "User"], NONE)
+        # pairs of a container with itself are left out
+        self.assertEqual(by_app["User", "User"], NONE)
+        self.assertIn("User", by_app.format())
+
+    def test_selector_semantics(self):
+        def pod(name, namespace, labels):
+            return {"kind": "Pod", "metadata": {"name": name, "namespace": namespace, "labels": labels}}
+
+        def policy(name, namespace, spec):
+            return {"kind": "NetworkPolicy", "metadata": {"name": name, "namespace": namespace}, "spec": spec}
+
+        cp = ConfigParser()
+        for data in [
+            {"kind": "Namespace", "metadata": {"name": "prod", "labels": {"env": "prod"}}},
+            {"kind": "Namespace", "metadata": {"name": "dev", "labels": {"env": "dev"}}},
+            pod("db", "prod", {"app": "db"}),
+            pod("web", "prod", {"app": "web", "tier": "front"}),
+            pod("job", "dev", {"app": "job"}),
+            pod("tmp", "dev", {}),
+            pod("cache", "dev", {"tier": "back"}),
+            # OR-ed peers: prod pods having a tier, dev pods but the job (also those without app)
+            policy("db", "prod", {"podSelector": {"matchLabels": {"app": "db"}}, "ingress": [{"from": [
+                {"podSelector": {"matchExpressions": [{"key": "tier", "operator": "Exists"}]}},
+                {"namespaceSelector": {"matchLabels": {"env": "dev"}},
+                 "podSelector": {"matchExpressions": [{"key": "app", "operator": "NotIn", "values": ["job"]}]}}]}]}),
+            # dev pods without a tier, isolated by a policy without rules
+            policy("deny", "dev", {"podSelector": {"matchExpressions": [{"key": "tier", "operator": "DoesNotExist"}]},
+                "policyTypes": ["Ingress"]}),
+            # no pod has the key
+            policy("none", "prod", {"podSelector": {"matchLabels": {"missing": "x"}}, "policyTypes": ["Egress"],
+                "egress": [{}]}),
+        ]:
+            cp.create_object(data)
+        names = [container.name for container in cp.containers]
+        matrix = ReachabilityMatrix.build_matrix(cp.containers, cp.policies, namespaces=cp.namespaces)
+
+        def members(b):
+            return {names[i] for i in b.search(1)}
+
+        db, deny, none = cp.policies
+        # working_select_set of an ingress policy: the sources
+        self.assertEqual(members(db.working_select_set), {"web", "tmp", "cache"})
+        self.assertEqual(members(db.working_allow_set), {"db"})
+        self.assertEqual(members(deny.working_allow_set), {"job", "tmp"})
+        self.assertEqual(members(deny.working_select_set), set())
+        self.assertEqual(members(none.working_select_set), set())
+        self.assertEqual(members(none.working_allow_set), set(names))
+
+        index = {name: i for i, name in enumerate(names)}
+        self.assertTrue(matrix[index["web"], index["db"]])
+        self.assertTrue(matrix[index["cache"], index["db"]])
+        self.assertFalse(matrix[index["job"], index["db"]])
+        self.assertFalse(matrix[index["web"], index["job"]])
+        self.assertTrue(matrix[index["web"], index["cache"]])
+
+        # per container evaluation (snapshot_diff) agrees with the index
+        namespace_labels = {namespace.name: namespace.labels for namespace in cp.namespaces}
+        for p in cp.policies:
+            self.assertEqual([p.selects(c, set(), namespace_labels) for c in cp.containers], p.working_select_set.tolist())
+            self.assertEqual([p.allows(c, set(), namespace_labels) for c in cp.containers], p.working_allow_set.tolist())
+
+        # without policyTypes, Egress needs some egress rule
+        for egress in (None, []):
+            cp = ConfigParser()
+            cp.create_object(policy("web", "prod", {"podSelector": {}, "ingress": [{}], "egress": egress}))
+            self.assertEqual([p.name for p in cp.policies], ["web-ingress"])
+            self.assertEqual(cp.policies[0].allow.labels, {})
+
+    def test_import_time(self):
+        # yaml is only needed to parse files, kubesv/z3 are never needed
+        script = "\n".join([
+            "import sys",
+            "import kano.model, kano.algorithm, kano.parser",
+            "print(' '.join(m for m in ('yaml', 'z3', 'kubesv') if m in sys.modules))",
+        ])
+        root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+        output = subprocess.run([sys.executable, "-c", script], cwd=root,
+            check=True, capture_output=True, text=True).stdout
+
+        self.assertEqual(output.strip(), "")
+
 
 if __name__ == '__main__':
     unittest.main()
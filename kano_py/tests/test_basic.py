@@ -33,8 +33,7 @@ class BasicTestSuite(unittest.TestCase):
         # (Alice, DB) <- (Bob, Nginx) / (Alice, Nginx) <- (User, User) / (Bob, Nginx) <- (Alice, Tomcat)
         assert user_crosscheck(matrix, containers, "app") == [1, 2, 3]
         # (Nginx, Tomcat) <: (Alice, Tomcat)
-        # Actually the (3, 2) is wrong...
-        assert policy_shadow(matrix, policies, containers) == [(2, 3), (3, 2)]
+        assert policy_shadow(matrix, policies, containers) == {(2, 3)}
 
 
 if __name__ == '__main__':
@@ -1,12 +1,19 @@
+from __future__ import annotations
+
+import ctypes
 from math import log2, floor
 from os import name
-from z3 import *
+from .lazy import lazy_import
 from .model import *
+from .native import NativeInfo, build_native, iter_ones
+from .partition import build_partitioned
 from .utils import parse_z3_result
 
+z3 = lazy_import("z3")
+
 
 class GlobalInfo:
-    def __init__(self, fp: Fixedpoint, 
+    def __init__(self, fp: z3.Fixedpoint, 
             pods: List[PodAdapter], 
             policies: List[PolicyAdapter], 
             namespaces: List[NamespaceAdapter],
@@ -18,12 +25,18 @@ class GlobalInfo:
         self.check_select_by_any = check_select_by_no_policy
         self.ground_default_pod = ground_default_pod
 
-        self.rels: Dict[str, FuncDeclRef] = {}
-        self.ns_rels: Dict[str, FuncDeclRef] = {}
-        self.core_rels: Dict[str, FuncDeclRef] = {}
-        self.lit_map: Dict[str, IntNumRef] = {}
+        self.rels: Dict[str, z3.FuncDeclRef] = {}
+        self.ns_rels: Dict[str, z3.FuncDeclRef] = {}
+        self.core_rels: Dict[str, z3.FuncDeclRef] = {}
+        self.lit_map: Dict[str, z3.IntNumRef] = {}
+        # canonical selector -> shared selector relation (None on quick fail)
+        self.selectors: Dict[Any, Optional[z3.FuncDeclRef]] = {}
+        # (is_namespace, key, values) -> shared In relation
+        self.in_rels: Dict[Any, z3.FuncDeclRef] = {}
         
         self.fp = fp
+        # TuningResult if the backend was auto-tuned (see tuning.py)
+        self.tuning = None
         
         self.namespaces = namespaces
         self.pods = pods
@@ -33,11 +46,11 @@ class GlobalInfo:
         for i, ns in enumerate(namespaces):
             self.nam_map[ns.name] = i
         
-        self.nam_sort = BitVecSort(1 + floor(log2(1 + len(namespaces))))
-        self.pod_sort = BitVecSort(1 + floor(log2(1 + len(pods))))
-        self.pol_sort = BitVecSort(1 + floor(log2(1 + len(policies))))
+        self.nam_sort = z3.BitVecSort(1 + floor(log2(1 + len(namespaces))))
+        self.pod_sort = z3.BitVecSort(1 + floor(log2(1 + len(pods))))
+        self.pol_sort = z3.BitVecSort(1 + floor(log2(1 + len(policies))))
         # XXX: this is a hack... assume less than 2^31 - 1 unique label valuess
-        self.lv_sort = BitVecSort(32)
+        self.lv_sort = z3.BitVecSort(32)
         self.lv_counter = 0
 
     def register_relation(self, name, func, is_core=False):
@@ -51,25 +64,49 @@ class GlobalInfo:
         self.fp.register_relation(func)
         self.ns_rels[name] = func
 
+    def has_selector(self, key) -> bool:
+        return key in self.selectors
+
+    def get_selector(self, key) -> Optional[z3.FuncDeclRef]:
+        return self.selectors[key]
+
+    def register_selector(self, key, func: Optional[z3.FuncDeclRef]):
+        self.selectors[key] = func
+
+    def n_selectors(self) -> int:
+        return len(self.selectors)
+
+    def has_in_relation(self, key) -> bool:
+        return key in self.in_rels
+
+    def get_in_relation(self, key) -> z3.FuncDeclRef:
+        return self.in_rels[key]
+
+    def register_in_relation(self, key, func: z3.FuncDeclRef):
+        self.in_rels[key] = func
+
+    def n_in_relations(self) -> int:
+        return len(self.in_rels)
+
     def get_or_create_literal(self, s: str) -> Any:
         if s not in self.lit_map:
-            self.lit_map[s] = BitVecVal(self.lv_counter, self.lv_sort)
+            self.lit_map[s] = z3.BitVecVal(self.lv_counter, self.lv_sort)
             self.lv_counter += 1
         return self.lit_map[s]
 
-    def get_relation(self, name) -> Optional[FuncDeclRef]:
+    def get_relation(self, name) -> Optional[z3.FuncDeclRef]:
         if name in self.rels:
             return self.rels[name]
         else:
             return None
 
-    def get_relation_ns(self, name) -> Optional[FuncDeclRef]:
+    def get_relation_ns(self, name) -> Optional[z3.FuncDeclRef]:
         if name in self.ns_rels:
             return self.ns_rels[name]
         else:
             return None
 
-    def get_relation_core(self, name) -> Optional[FuncDeclRef]:
+    def get_relation_core(self, name) -> Optional[z3.FuncDeclRef]:
         if name in self.core_rels:
             return self.core_rels[name]
         else:
@@ -93,29 +130,42 @@ class GlobalInfo:
         func = self.core_rels[name]
         self.fp.fact(func(*args), name=cname)
 
-    def pod_value(self, v: int) -> BitVecVal:
-        return BitVecVal(v, self.pod_sort)
+    def add_ground_facts_core(self, name: str, tuples: Iterable[Tuple[int, ...]]):
+        """
+        Add facts of integer tuples directly to the relation table of the datalog engine,
+        much cheaper than add_fact_call_core for large numbers of facts
+        """
+        func = self.core_rels[name]
+        arity = func.arity()
+        args = (ctypes.c_uint * arity)()
+        ctx, fp, decl = self.fp.ctx.ref(), self.fp.fixedpoint, func.ast
+        for values in tuples:
+            args[:] = values
+            z3.Z3_fixedpoint_add_fact(ctx, fp, decl, arity, args)
+
+    def pod_value(self, v: int) -> z3.BitVecVal:
+        return z3.BitVecVal(v, self.pod_sort)
 
-    def nam_value(self, v: int) -> BitVecVal:
-        return BitVecVal(v, self.nam_sort)
+    def nam_value(self, v: int) -> z3.BitVecVal:
+        return z3.BitVecVal(v, self.nam_sort)
 
-    def pol_value(self, v: int) -> BitVecVal:
-        return BitVecVal(v, self.pol_sort)
+    def pol_value(self, v: int) -> z3.BitVecVal:
+        return z3.BitVecVal(v, self.pol_sort)
 
-    def get_namespace_idx(self, ns: str) -> BitVecVal:
-        return BitVecVal(self.nam_map[ns], self.nam_sort)
+    def get_namespace_idx(self, ns: str) -> z3.BitVecVal:
+        return z3.BitVecVal(self.nam_map[ns], self.nam_sort)
 
     def declare_var(self, name, sort, is_Var=False):
         if is_Var:
-            var = Var(name, sort)
+            var = z3.Var(name, sort)
         else:
-            var = Const(name, sort)
+            var = z3.Const(name, sort)
         self.fp.declare_var(var)
         return var
 
 
-def get_fixpoint_engine(**kwargs) -> Fixedpoint:
-    fp = Fixedpoint()
+def get_fixpoint_engine(**kwargs) -> z3.Fixedpoint:
+    fp = z3.Fixedpoint()
     fp_options = {
         "ctrl_c": True,
         "engine": "datalog",
@@ -129,19 +179,19 @@ def get_fixpoint_engine(**kwargs) -> Fixedpoint:
     return fp
 
 
-def get_smtlib(fp: Fixedpoint, queries: List[Any]) -> str:
+def get_smtlib(fp: z3.Fixedpoint, queries: List[Any]) -> str:
     return fp.to_string(queries)
 
 
-def get_answer(fp: Fixedpoint, queries: List[Any]) -> Tuple[CheckSatResult, Any]:
+def get_answer(fp: z3.Fixedpoint, queries: List[Any]) -> Tuple[z3.CheckSatResult, Any]:
     return (fp.query(queries), fp.get_answer())
 
 
 def define_model(gi: GlobalInfo):
     # define is_pol/pod/nam helpers
-    is_pol = Function('is_pol', gi.pol_sort, BoolSort())
-    is_pod = Function('is_pod', gi.pod_sort, BoolSort())
-    is_nam = Function('is_nam', gi.nam_sort, BoolSort())
+    is_pol = z3.Function('is_pol', gi.pol_sort, z3.BoolSort())
+    is_pod = z3.Function('is_pod', gi.pod_sort, z3.BoolSort())
+    is_nam = z3.Function('is_nam', gi.nam_sort, z3.BoolSort())
     gi.register_relation('is_pol', is_pol, is_core=True)
     gi.register_relation('is_pod', is_pod, is_core=True)
     gi.register_relation('is_nam', is_nam, is_core=True)
@@ -154,24 +204,24 @@ def define_model(gi: GlobalInfo):
         gi.add_fact(is_nam(gi.nam_value(i)))
 
     # define namespace(pod, value) relation
-    namespace = Function('namespace', gi.pod_sort, gi.nam_sort, BoolSort())
+    namespace = z3.Function('namespace', gi.pod_sort, gi.nam_sort, z3.BoolSort())
     gi.register_relation("namespace", namespace, is_core=True)
 
     # define selected_by_pol(pod_index, pol_index)
-    selected_by_pol = Function("selected_by_pol", gi.pod_sort, gi.pol_sort, BoolSort())
+    selected_by_pol = z3.Function("selected_by_pol", gi.pod_sort, gi.pol_sort, z3.BoolSort())
     gi.register_relation("selected_by_pol", selected_by_pol, is_core=True)
 
-    selected_by_any = Function("selected_by_any", gi.pod_sort, BoolSort())
+    selected_by_any = z3.Function("selected_by_any", gi.pod_sort, z3.BoolSort())
     gi.register_relation("selected_by_any", selected_by_any, is_core=True)
 
-    selected_by_none = Function("selected_by_none", gi.pod_sort, BoolSort())
+    selected_by_none = z3.Function("selected_by_none", gi.pod_sort, z3.BoolSort())
     gi.register_relation("selected_by_none", selected_by_none, is_core=True)
 
     # define ingress/egress_allow_by_pol(src_pod/dst_pod, pol)
-    ingress_allow_by_pol = Function("ingress_allow_by_pol", gi.pod_sort, gi.pol_sort, BoolSort())
+    ingress_allow_by_pol = z3.Function("ingress_allow_by_pol", gi.pod_sort, gi.pol_sort, z3.BoolSort())
     gi.register_relation("ingress_allow_by_pol", ingress_allow_by_pol, is_core=True)
 
-    egress_allow_by_pol = Function("egress_allow_by_pol", gi.pod_sort, gi.pol_sort, BoolSort())
+    egress_allow_by_pol = z3.Function("egress_allow_by_pol", gi.pod_sort, gi.pol_sort, z3.BoolSort())
     gi.register_relation("egress_allow_by_pol", egress_allow_by_pol, is_core=True)
 
     # define ingress/egress_traffic(src_pod/dst_pod, sel_pod)
@@ -188,10 +238,10 @@ def define_model(gi: GlobalInfo):
 
     gi.add_rule(selected_by_none(sel), [
         is_pod(sel),
-        Not(selected_by_any(sel))
+        z3.Not(selected_by_any(sel))
     ])
 
-    ingress_traffic = Function("ingress_traffic", gi.pod_sort, gi.pod_sort, BoolSort())
+    ingress_traffic = z3.Function("ingress_traffic", gi.pod_sort, gi.pod_sort, z3.BoolSort())
     gi.register_relation("ingress_traffic", ingress_traffic, is_core=True)
 
     if gi.check_self_traffic:
@@ -210,7 +260,7 @@ def define_model(gi: GlobalInfo):
             selected_by_none(sel)
         ])
 
-    egress_traffic = Function("egress_traffic", gi.pod_sort, gi.pod_sort, BoolSort())
+    egress_traffic = z3.Function("egress_traffic", gi.pod_sort, gi.pod_sort, z3.BoolSort())
     gi.register_relation("egress_traffic", egress_traffic, is_core=True)
 
     gi.add_rule(egress_traffic(dst, sel), [
@@ -226,10 +276,10 @@ def define_model(gi: GlobalInfo):
             selected_by_none(sel)
         ])
 
-    edge = Function("edge", gi.pod_sort, gi.pod_sort, BoolSort())
+    edge = z3.Function("edge", gi.pod_sort, gi.pod_sort, z3.BoolSort())
     gi.register_relation("edge", edge, is_core=True)
 
-    disconnect = Function("disconnect", gi.pod_sort, gi.pod_sort, BoolSort())
+    disconnect = z3.Function("disconnect", gi.pod_sort, gi.pod_sort, z3.BoolSort())
     gi.register_relation("disconnect", disconnect, is_core=True)
 
     # connected, if source's egress contains destination & destination's ingress contains source
@@ -241,14 +291,15 @@ def define_model(gi: GlobalInfo):
     gi.add_rule(disconnect(src, dst), [
         is_pod(src),
         is_pod(dst),
-        Not(edge(src, dst))
+        z3.Not(edge(src, dst))
     ])
 
-    path = Function("path", gi.pod_sort, gi.pod_sort, BoolSort())
+    path = z3.Function("path", gi.pod_sort, gi.pod_sort, z3.BoolSort())
     gi.register_relation("path", path, is_core=True)
 
+    # transitive closure of edge, right-linear so that a bound source only explores its own slice
     gi.add_rule(path(src, dst), edge(src, dst))
-    gi.add_rule(path(src, dst), [edge(src, sel), edge(sel, dst)])            
+    gi.add_rule(path(src, dst), [edge(src, sel), path(sel, dst)])
 
 
 def define_pod_facts(gi: GlobalInfo):
@@ -266,11 +317,11 @@ def define_pod_facts(gi: GlobalInfo):
             k_exists = "{}__exists".format(k)
 
             if gi.get_relation(k) is None:
-                gi.register_relation(k, Function(k, gi.pod_sort, gi.lv_sort, BoolSort()))
+                gi.register_relation(k, z3.Function(k, gi.pod_sort, gi.lv_sort, z3.BoolSort()))
             gi.add_fact_call(k, gi.pod_value(i), gi.get_or_create_literal(v))
 
             if gi.get_relation(k_exists) is None:
-                gi.register_relation(k_exists, Function(k_exists, gi.pod_sort, BoolSort()))
+                gi.register_relation(k_exists, z3.Function(k_exists, gi.pod_sort, z3.BoolSort()))
             gi.add_fact_call(k_exists, gi.pod_value(i))
 
     for i, ns in enumerate(gi.namespaces):
@@ -279,11 +330,11 @@ def define_pod_facts(gi: GlobalInfo):
             k_exists = "{}__exists".format(k_ns)
 
             if gi.get_relation_ns(k_ns) is None:
-                gi.register_relation_ns(k_ns, Function(k, gi.nam_sort, gi.lv_sort, BoolSort()))
+                gi.register_relation_ns(k_ns, z3.Function(k_ns, gi.nam_sort, gi.lv_sort, z3.BoolSort()))
             gi.add_fact_call_ns(k_ns, gi.nam_value(i), gi.get_or_create_literal(v))
 
             if gi.get_relation_ns(k_exists) is None:
-                gi.register_relation_ns(k_exists, Function(k_exists, gi.nam_sort, BoolSort()))
+                gi.register_relation_ns(k_exists, z3.Function(k_exists, gi.nam_sort, z3.BoolSort()))
             gi.add_fact_call_ns(k_exists, gi.nam_value(i))
 
 
@@ -294,6 +345,20 @@ def define_pol_facts(gi: GlobalInfo):
         pol.define_ingress_rules(i, gi)
 
 
+def define_native_pol_facts(gi: GlobalInfo, ni: NativeInfo):
+    """
+    Hybrid build: selected_by_pol, ingress_allow_by_pol and egress_allow_by_pol as ground facts
+    evaluated by the bitset engine, instead of the selector rules of define_pol_facts.
+    The recursive/negation layers (edge, path, custom rules...) are still derived by z3.
+    """
+    for name, allowed_by_pol in (
+            ("selected_by_pol", ni.selected_by_pol),
+            ("ingress_allow_by_pol", ni.ingress_allow_by_pol),
+            ("egress_allow_by_pol", ni.egress_allow_by_pol)):
+        gi.add_ground_facts_core(name,
+            ((pod, pol) for pol, pods in enumerate(allowed_by_pol) for pod in iter_ones(pods)))
+
+
 def ground_default_pods(gi: GlobalInfo):
     is_pod = gi.get_relation_core("is_pod")
     ingress_traffic = gi.get_relation_core("ingress_traffic")
@@ -322,7 +387,40 @@ def build(pods: List[PodAdapter],
         nams: List[NamespaceAdapter], 
         check_self_ingress_traffic=True, 
         check_select_by_no_policy=False, 
-        ground_default_pod=False, **kwargs):
+        ground_default_pod=False,
+        mode="z3", endpoints=None, **kwargs):
+    """
+    mode="z3": translate the model to z3 Datalog rules, required for custom rules/queries, kwargs are z3 options
+    mode="native": evaluate the model with bitsets (see native.py), no custom rules can be added
+    mode="partitioned": native, evaluated by namespace blocks (see partition.py), workers=N for N processes
+    mode="hybrid": z3, with the policy selections evaluated natively and asserted as facts (see define_native_pol_facts)
+    pods/pols/nams may also be bare k8s models (kubernetes.client or kubesv.lite)
+    endpoints: named external endpoints for ipBlock peers (native only, see ipblocks.py)
+    """
+    pods = adapt(pods, PodAdapter)
+    pols = adapt(pols, PolicyAdapter)
+    nams = adapt(nams, NamespaceAdapter)
+    if mode not in ("native", "z3", "partitioned", "hybrid"):
+        raise ValueError("unknown build mode {}".format(mode))
+    unused = set(kwargs) - {"workers"} if mode == "partitioned" else set(kwargs) if mode == "native" else set()
+    if unused:
+        raise TypeError("build(..., mode=\"{}\") does not take {}".format(mode, ", ".join(sorted(unused))))
+    if mode == "native":
+        return build_native(pods, pols, nams,
+            check_self_ingress_traffic=check_self_ingress_traffic,
+            check_select_by_no_policy=check_select_by_no_policy,
+            ground_default_pod=ground_default_pod,
+            endpoints=endpoints)
+    if mode == "partitioned":
+        return build_partitioned(pods, pols, nams,
+            check_self_ingress_traffic=check_self_ingress_traffic,
+            check_select_by_no_policy=check_select_by_no_policy,
+            ground_default_pod=ground_default_pod,
+            endpoints=endpoints,
+            workers=kwargs.get("workers"))
+    if endpoints is not None:
+        raise ValueError("external endpoints need build(..., mode=\"native\")")
+
     fp = get_fixpoint_engine(**kwargs)
     gi = GlobalInfo(fp, pods, pols, nams, 
         check_self_ingress_traffic=check_self_ingress_traffic, 
@@ -331,7 +429,13 @@ def build(pods: List[PodAdapter],
 
     define_model(gi)
     define_pod_facts(gi)
-    define_pol_facts(gi)
+    if mode == "hybrid":
+        ni = NativeInfo(pods, pols, nams)
+        ni.define_pod_facts()
+        ni.define_pol_facts()
+        define_native_pol_facts(gi, ni)
+    else:
+        define_pol_facts(gi)
 
     if check_select_by_no_policy and ground_default_pod:
         ground_default_pods(gi)
@@ -0,0 +1,81 @@
+"""
+Edge explanations: the policies supporting each direction of a pod pair, or why it is not connected.
+
+edge[src][dst] = ingress_traffic[src][dst] & egress_traffic[src][dst] (see native.eval_traffic), where
+    ingress: a policy selecting dst allows src in its ingress rules, or dst accepts it without policy
+        (self traffic, or dst selected by no policy with check_select_by_no_policy)
+    egress: a policy selecting src allows dst in its egress rules, or src is selected by no policy
+        (with check_select_by_no_policy)
+The pod x policy relations are transposed once into pod -> policies bitarrays,
+then explaining a pair takes one AND of policy bitarrays per direction.
+Rule ports are ignored, like edge.
+The explanations are kano's (kano.explain), the policies isolating a pod being those selecting it.
+"""
+from __future__ import annotations
+
+from bitarray import bitarray
+from bitarray.util import zeros
+from kano.explain import SELF_TRAFFIC, DirectionExplanation, EdgeExplanation
+from typing import *
+from .model import *
+from .constraint import GlobalInfo
+from .native import NativeInfo, iter_ones
+from .postprocess import get_pol_bitarrays
+
+SELECTED_BY_NO_POLICY = "selected by no policy"
+
+
+class ExplanationIndex:
+    def __init__(self, gi: Union[GlobalInfo, NativeInfo]):
+        """
+        gi: a model of any build mode, the z3 ones are queried once for their policy facts
+        """
+        self.pods = gi.pods
+        self.policies = gi.policies
+        self.check_self_traffic = gi.check_self_traffic
+        self.check_select_by_any = gi.check_select_by_any
+
+        # pod -> policies selecting it, allowing it as an ingress source, allowing it as an egress destination
+        self.selecting = self.transpose(get_pol_bitarrays(gi, "selected_by_pol"))
+        self.ingress_allowing = self.transpose(get_pol_bitarrays(gi, "ingress_allow_by_pol"))
+        self.egress_allowing = self.transpose(get_pol_bitarrays(gi, "egress_allow_by_pol"))
+
+    def transpose(self, by_pol: List[bitarray]) -> List[bitarray]:
+        by_pod = [zeros(len(self.policies)) for _ in self.pods]
+        for pol, pods in enumerate(by_pol):
+            for i in iter_ones(pods):
+                by_pod[i][pol] = True
+        return by_pod
+
+    def explain(self, src: int, dst: int) -> EdgeExplanation:
+        selecting_dst = self.selecting[dst]
+        ingress = selecting_dst & self.ingress_allowing[src]
+        ingress_default = None
+        if self.check_self_traffic and src == dst:
+            ingress_default = SELF_TRAFFIC
+        elif self.check_select_by_any and not selecting_dst.any():
+            ingress_default = SELECTED_BY_NO_POLICY
+
+        selecting_src = self.selecting[src]
+        egress = selecting_src & self.egress_allowing[dst]
+        egress_default = None
+        if self.check_select_by_any and not selecting_src.any():
+            egress_default = SELECTED_BY_NO_POLICY
+
+        return EdgeExplanation(src, dst,
+            DirectionExplanation(ingress.any() or ingress_default is not None,
+                list(iter_ones(ingress)), list(iter_ones(selecting_dst)), ingress_default),
+            DirectionExplanation(egress.any() or egress_default is not None,
+                list(iter_ones(egress)), list(iter_ones(selecting_src)), egress_default))
+
+    def explain_pairs(self, pairs: Iterable[Tuple[int, int]]) -> List[EdgeExplanation]:
+        return [self.explain(src, dst) for src, dst in pairs]
+
+    def pod_name(self, i: int) -> str:
+        return "{}/{}".format(self.pods[i].namespace, self.pods[i].name)
+
+    def policy_name(self, p: int) -> str:
+        return "{}/{}".format(self.policies[p].namespace, self.policies[p].metadata.name)
+
+    def describe(self, src: int, dst: int) -> str:
+        return self.explain(src, dst).describe(self.pod_name, self.policy_name)
@@ -0,0 +1,56 @@
+"""
+Exposure ranking on the edge relation:
+    in-degree, the number of pods reaching a pod (how exposed it is),
+    out-degree, the number of pods a pod reaches (how capable it is).
+
+Out-degrees are row popcounts. In-degrees are column popcounts, counted for all columns at once by adding
+the rows into bit-sliced counters (planes[k] holds bit k of every column count),
+so a row costs a few bitarray operations instead of one Python step per edge.
+The counting and the DegreeReport are kano's (kano.exposure), given the edge rows of the model,
+the container of the report being a pod here.
+"""
+from __future__ import annotations
+
+from bitarray import bitarray
+from bitarray.util import zeros
+from kano import exposure as kano_exposure
+from kano.exposure import IN, OUT, DegreeReport, column_counts
+from typing import *
+from .model import *
+from .constraint import GlobalInfo, get_answer
+from .native import NativeInfo
+from .postprocess import get_z3_bitarray
+from .lazy import lazy_import
+
+z3 = lazy_import("z3")
+
+
+def pod_groups(pods: List[PodAdapter], label: Optional[str] = None) -> List[str]:
+    """
+    The namespace of each pod, or its value of label ("" without it)
+    """
+    if label is None:
+        return [pod.namespace for pod in pods]
+    return [pod.labels.get(label, "") for pod in pods]
+
+
+def edge_rows(gi: Union[GlobalInfo, NativeInfo]) -> List[bitarray]:
+    if isinstance(gi, NativeInfo):
+        return gi.edge
+
+    edge = gi.get_relation_core("edge")
+    src = gi.declare_var('degree_src', gi.pod_sort)
+    dst = gi.declare_var('degree_dst', gi.pod_sort)
+    sat, answer = get_answer(gi.fp, [edge(src, dst)])
+    if sat == z3.unsat:
+        return [zeros(len(gi.pods)) for _ in gi.pods]
+    return get_z3_bitarray(answer, len(gi.pods))
+
+
+def degree_report(gi: Union[GlobalInfo, NativeInfo, List[bitarray]], self_edges=False) -> DegreeReport:
+    """
+    gi: a model of any build mode, or edge rows (rows[src][dst])
+    self_edges: count the edge of a pod to itself
+    """
+    rows = gi if isinstance(gi, list) else edge_rows(gi)
+    return kano_exposure.degree_report(rows, self_edges)
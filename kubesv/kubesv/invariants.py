@@ -0,0 +1,264 @@
+"""
+Invariants on the edge relation, written in a small language and checked together in one pass over the rows.
+
+A statement is one of
+    deny S -> D       no pod of S reaches a pod of D
+    only S -> D       the pods of D are only reached from pods of S
+    require S -> D    every pod of S reaches every pod of D
+optionally followed by "same K" or "different K", restricting the pairs to the pods with equal (different) values of
+the label K, or of their namespace for K = ns. Pods without the label K are in no group.
+S and D are selectors, comma separated terms all matched by the pods:
+    key=value, key=v1|v2, key!=value (also pods without the key), key (has the key), !key, *
+with ns=... matching the namespace. Pairs of a pod with itself are never violations.
+E.g. "only role=backend -> role=db same ns", "deny ns=prod -> ns=dev".
+
+Statements compile (cached) to plans. The selectors compile to bitsets of a LabelIndex,
+cached as long as the pods are the same (e.g. across the policy changes of watch.py),
+then each row of edge is checked against all plans with a few bitarray operations.
+"""
+from __future__ import annotations
+
+import re
+from array import array
+from dataclasses import dataclass, field
+from functools import lru_cache
+from bitarray import bitarray
+from bitarray.util import zeros
+from typing import *
+from .model import *
+from .constraint import GlobalInfo
+from .native import NativeInfo, iter_ones, ones
+from .exposure import edge_rows
+
+NAMESPACE_KEYS = ("ns", "namespace")
+
+# (key, operator, values) terms, operator in "=", "!=", "exists", "!exists", key "*" for all pods
+Selector = Tuple[Tuple[str, str, Tuple[str, ...]], ...]
+
+STATEMENT = re.compile(r"^\s*(deny|only|require)\s+(.+?)\s*->\s*(.+?)(?:\s+(same|different)\s+([\w./-]+))?\s*$")
+TERM = re.compile(r"^(!?)([\w./-]+)(?:(=|!=)([\w.|-]*))?$")
+
+
+class Plan(NamedTuple):
+    kind: str
+    src: Selector
+    dst: Selector
+    # ("same" | "different", key)
+    qualifier: Optional[Tuple[str, str]] = None
+
+
+def parse_selector(text: str) -> Selector:
+    terms = []
+    for term in text.split(","):
+        term = term.strip()
+        if term == "*":
+            continue
+        match = TERM.match(term)
+        if match is None:
+            raise ValueError("invalid selector term {!r}".format(term))
+        negated, key, operator, values = match.groups()
+        if operator is None:
+            terms.append((key, "!exists" if negated else "exists", ()))
+        elif negated:
+            raise ValueError("invalid selector term {!r}".format(term))
+        else:
+            terms.append((key, operator, tuple(sorted(values.split("|")))))
+    return tuple(sorted(terms))
+
+
+@lru_cache(maxsize=None)
+def compile_statement(text: str) -> Plan:
+    match = STATEMENT.match(text)
+    if match is None:
+        raise ValueError("invalid invariant {!r}".format(text))
+    kind, src, dst, qualifier, key = match.groups()
+    return Plan(kind, parse_selector(src), parse_selector(dst), (qualifier, key) if qualifier else None)
+
+
+def parse_invariants(text: str) -> Dict[str, str]:
+    """
+    "name: statement" lines, blank lines and # comments are skipped
+    """
+    invariants = {}
+    for line in text.splitlines():
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        name, sep, statement = line.partition(":")
+        if not sep:
+            raise ValueError("invalid invariant line {!r}, expected name: statement".format(line))
+        invariants[name.strip()] = statement.strip()
+    return invariants
+
+
+class LabelIndex:
+    def __init__(self, labels: List[Dict[str, str]], namespaces: Optional[List[str]] = None):
+        """
+        labels/namespaces of each pod, e.g. [c.labels for c in containers] for a kano matrix (no namespaces)
+        """
+        self.n = len(labels)
+        self.labels = labels
+        self.namespaces = namespaces if namespaces is not None else [""] * self.n
+        # key -> value -> pods, built on first use
+        self.values: Dict[str, Dict[str, bitarray]] = {}
+        self.selectors: Dict[Selector, bitarray] = {}
+        # key -> pod -> pods with the same value
+        self.groups: Dict[str, List[bitarray]] = {}
+
+    @classmethod
+    def of_pods(cls, pods: List[PodAdapter]) -> LabelIndex:
+        return cls([pod.labels for pod in pods], [pod.namespace for pod in pods])
+
+    def values_of(self, key: str) -> Dict[str, bitarray]:
+        if key not in self.values:
+            values: Dict[str, bitarray] = {}
+            if key in NAMESPACE_KEYS:
+                pairs = enumerate(self.namespaces)
+            else:
+                pairs = ((i, labels[key]) for i, labels in enumerate(self.labels) if key in labels)
+            for i, value in pairs:
+                if value not in values:
+                    values[value] = zeros(self.n)
+                values[value][i] = True
+            self.values[key] = values
+        return self.values[key]
+
+    def select(self, selector: Selector) -> bitarray:
+        if selector not in self.selectors:
+            selected = ones(self.n)
+            for key, operator, values in selector:
+                by_value = self.values_of(key)
+                if operator in ("exists", "!exists"):
+                    matched = zeros(self.n)
+                    for pods in by_value.values():
+                        matched |= pods
+                else:
+                    matched = zeros(self.n)
+                    for value in values:
+                        if value in by_value:
+                            matched |= by_value[value]
+                selected &= ~matched if operator.startswith("!") else matched
+            self.selectors[selector] = selected
+        return self.selectors[selector]
+
+    def labeled(self, key: str) -> bitarray:
+        """
+        Pods with the key, i.e. in some group of group_of(key)
+        """
+        return self.select(((key, "exists", ()),))
+
+    def group_of(self, key: str) -> List[bitarray]:
+        if key not in self.groups:
+            none = zeros(self.n)
+            groups = [none] * self.n
+            for pods in self.values_of(key).values():
+                for i in iter_ones(pods):
+                    groups[i] = pods
+            self.groups[key] = groups
+        return self.groups[key]
+
+
+@dataclass
+class Violations:
+    count: int = 0
+    # violating (src, dst) pairs, at most max_pairs of them
+    src: array = field(default_factory=lambda: array('q'))
+    dst: array = field(default_factory=lambda: array('q'))
+
+    def __bool__(self):
+        return self.count > 0
+
+    def pairs(self) -> List[Tuple[int, int]]:
+        return list(zip(self.src, self.dst))
+
+
+class InvariantChecker:
+    def __init__(self, invariants: Dict[str, str], max_pairs: Optional[int] = 1000):
+        """
+        invariants: name -> statement, see parse_invariants
+        max_pairs: violating pairs kept per invariant (all are counted), None for all of them
+        """
+        self.invariants = invariants
+        self.plans = {name: compile_statement(statement) for name, statement in invariants.items()}
+        self.max_pairs = max_pairs
+        # the pods of the last index, reused while a model has the same pods
+        self.pods: Optional[List[PodAdapter]] = None
+        self.index: Optional[LabelIndex] = None
+        self.last: Optional[Tuple[Any, Dict[str, Violations]]] = None
+
+    def index_of(self, gi: Union[GlobalInfo, NativeInfo]) -> LabelIndex:
+        if self.index is None or gi.pods is not self.pods:
+            self.pods = gi.pods
+            self.index = LabelIndex.of_pods(gi.pods)
+        return self.index
+
+    def check(self, gi: Union[GlobalInfo, NativeInfo]) -> Dict[str, Violations]:
+        """
+        Violations of each invariant on a model of any build mode, the result of the last model is kept
+        """
+        if self.last is None or self.last[0] is not gi:
+            self.last = (gi, self.check_rows(edge_rows(gi), self.index_of(gi)))
+        return self.last[1]
+
+    def check_rows(self, rows: List[bitarray], index: LabelIndex) -> Dict[str, Violations]:
+        """
+        Violations on edge rows (rows[src][dst]), e.g. matrix.matrix of kano
+        """
+        n = index.n
+        compiled = []
+        for name, plan in self.plans.items():
+            src, dst = index.select(plan.src), index.select(plan.dst)
+            groups, same, labeled = None, True, None
+            if plan.qualifier is not None:
+                groups, same = index.group_of(plan.qualifier[1]), plan.qualifier[0] == "same"
+                labeled = index.labeled(plan.qualifier[1])
+            # rows to check: all of them for only, the sources for deny/require
+            checked = ones(n) if plan.kind == "only" else src
+            compiled.append((name, plan.kind, checked, src, dst, groups, same, labeled))
+
+        results = {name: Violations() for name in self.plans}
+        none = zeros(n)
+        for i, row in enumerate(rows):
+            for name, kind, checked, src, dst, groups, same, labeled in compiled:
+                if not checked[i]:
+                    continue
+                if groups is None:
+                    pairs = dst
+                elif same:
+                    pairs = dst & groups[i]
+                elif labeled[i]:
+                    # pods without the key are in no group, not in a different one
+                    pairs = dst & labeled & ~groups[i]
+                else:
+                    pairs = none
+                if kind == "deny":
+                    violating = row & pairs
+                elif kind == "require":
+                    violating = pairs & ~row
+                elif src[i]:
+                    # only: a source may reach the pairs, not the rest of dst
+                    violating = row & dst & ~pairs if groups is not None else None
+                else:
+                    violating = row & dst
+                if violating is None:
+                    continue
+                if violating[i]:
+                    violating = violating.copy()
+                    violating[i] = False
+                count = violating.count()
+                if count == 0:
+                    continue
+                result = results[name]
+                result.count += count
+                for j in iter_ones(violating):
+                    if self.max_pairs is not None and len(result.src) >= self.max_pairs:
+                        break
+                    result.src.append(i)
+                    result.dst.append(j)
+        return results
+
+    def watch_invariants(self) -> Dict[str, Callable[[NativeInfo], int]]:
+        """
+        Violation counts as watch.Watcher invariants, all computed by one check per model
+        """
+        return {name: (lambda ni, name=name: self.check(ni)[name].count) for name in self.plans}
@@ -0,0 +1,80 @@
+"""
+Index of named external endpoints (IP addresses or CIDR ranges) for ipBlock peers.
+
+Endpoints are kept as sorted address intervals per IP version,
+so the endpoints inside a CIDR are found by two bisections
+and the except ranges are only checked against those.
+An endpoint is covered by an ipBlock if all of its addresses are allowed.
+"""
+import ipaddress
+
+from bisect import bisect_left, bisect_right
+from bitarray import bitarray
+from bitarray.util import zeros
+from typing import *
+
+IPNetwork = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+
+def to_interval(network: IPNetwork) -> Tuple[int, int]:
+    return int(network.network_address), int(network.broadcast_address)
+
+
+class EndpointIndex:
+    def __init__(self, endpoints: List[Tuple[str, str]]):
+        """
+        endpoints: (name, IP address or CIDR) pairs, endpoint index = position in the list
+        """
+        self.names = [name for name, _ in endpoints]
+        self.networks: List[IPNetwork] = [ipaddress.ip_network(addr, strict=False) for _, addr in endpoints]
+        self.n_endpoint = len(endpoints)
+
+        # version -> endpoint indices sorted by (first, last) address
+        self.order: Dict[int, List[int]] = {4: [], 6: []}
+        for i, network in enumerate(self.networks):
+            self.order[network.version].append(i)
+        self.starts: Dict[int, List[int]] = {}
+        self.ends: Dict[int, List[int]] = {}
+        for version, order in self.order.items():
+            order.sort(key=lambda i: to_interval(self.networks[i]))
+            self.starts[version] = [int(self.networks[i].network_address) for i in order]
+            self.ends[version] = [int(self.networks[i].broadcast_address) for i in order]
+
+        # (cidr, excepts) -> covered endpoints, ipBlocks are often repeated across policies
+        self.blocks: Dict[Any, bitarray] = {}
+
+    def __len__(self):
+        return self.n_endpoint
+
+    def covered(self, cidr: IPNetwork, excepts: List[IPNetwork]) -> bitarray:
+        """
+        Endpoints entirely in cidr and disjoint from every except range
+        The result is shared between equal blocks and must not be modified
+        """
+        key = (cidr, tuple(sorted(excepts, key=str)))
+        if key not in self.blocks:
+            self.blocks[key] = self._covered(cidr, excepts)
+        return self.blocks[key]
+
+    def _covered(self, cidr: IPNetwork, excepts: List[IPNetwork]) -> bitarray:
+        result = zeros(self.n_endpoint)
+        version = cidr.version
+        starts, ends, order = self.starts[version], self.ends[version], self.order[version]
+        first, last = to_interval(cidr)
+
+        excluded = sorted(to_interval(e) for e in excepts if e.version == version)
+        ex_starts = [s for s, _ in excluded]
+        # running max of the except ends, in start order
+        ex_max_ends = []
+        for _, end in excluded:
+            ex_max_ends.append(max(end, ex_max_ends[-1]) if ex_max_ends else end)
+
+        for k in range(bisect_left(starts, first), bisect_right(starts, last)):
+            if ends[k] > last:
+                continue
+            # the except ranges starting before the end of the endpoint must all end before its start
+            j = bisect_right(ex_starts, ends[k])
+            if j > 0 and ex_max_ends[j - 1] >= starts[k]:
+                continue
+            result[order[k]] = True
+        return result
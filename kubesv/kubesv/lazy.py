@@ -0,0 +1,21 @@
+"""
+Lazy imports of the heavy dependencies (z3, kubernetes, yaml).
+The module is loaded on first attribute access, so e.g. the native build
+with kubesv.lite models never pays for z3 or kubernetes.
+"""
+import importlib.util
+import sys
+
+
+def lazy_import(name: str):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError("no module named {}".format(name), name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
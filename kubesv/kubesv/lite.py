@@ -0,0 +1,256 @@
+"""
+Lightweight k8s models built straight from manifest dicts.
+Only the fields the adapters read are kept, under the attribute names of kubernetes.client.models,
+so PodAdapter/PolicyAdapter/NamespaceAdapter accept both.
+kubernetes is only needed to convert real k8s models (see from_model).
+"""
+from typing import *
+
+
+class ObjectMeta:
+    __slots__ = ("name", "namespace", "labels")
+
+    def __init__(self, name=None, namespace=None, labels=None):
+        self.name = name
+        self.namespace = namespace
+        self.labels = labels
+
+    @staticmethod
+    def from_dict(data: Optional[dict]) -> "ObjectMeta":
+        data = data or {}
+        return ObjectMeta(data.get("name"), data.get("namespace"), data.get("labels"))
+
+
+class LabelSelectorRequirement:
+    __slots__ = ("key", "operator", "values")
+
+    def __init__(self, key, operator, values=None):
+        self.key = key
+        self.operator = operator
+        self.values = values
+
+    @staticmethod
+    def from_dict(data: dict) -> "LabelSelectorRequirement":
+        return LabelSelectorRequirement(data["key"], data["operator"], data.get("values"))
+
+
+class LabelSelector:
+    __slots__ = ("match_labels", "match_expressions")
+
+    def __init__(self, match_labels=None, match_expressions=None):
+        self.match_labels = match_labels
+        self.match_expressions = match_expressions
+
+    @staticmethod
+    def from_dict(data: Optional[dict]) -> Optional["LabelSelector"]:
+        # NOTE: keep None (null selector) and {} (empty selector) apart
+        if data is None:
+            return None
+        exprs = data.get("matchExpressions")
+        if exprs is not None:
+            exprs = [LabelSelectorRequirement.from_dict(e) for e in exprs]
+        return LabelSelector(data.get("matchLabels"), exprs)
+
+
+class IPBlock:
+    __slots__ = ("cidr", "_except")
+
+    def __init__(self, cidr, _except=None):
+        self.cidr = cidr
+        self._except = _except
+
+    @staticmethod
+    def from_dict(data: Optional[dict]) -> Optional["IPBlock"]:
+        if data is None:
+            return None
+        return IPBlock(data["cidr"], data.get("except"))
+
+
+class NetworkPolicyPeer:
+    __slots__ = ("pod_selector", "namespace_selector", "ip_block")
+
+    def __init__(self, pod_selector=None, namespace_selector=None, ip_block=None):
+        self.pod_selector = pod_selector
+        self.namespace_selector = namespace_selector
+        self.ip_block = ip_block
+
+    @staticmethod
+    def from_dict(data: dict) -> "NetworkPolicyPeer":
+        return NetworkPolicyPeer(
+            LabelSelector.from_dict(data.get("podSelector")),
+            LabelSelector.from_dict(data.get("namespaceSelector")),
+            IPBlock.from_dict(data.get("ipBlock")))
+
+
+class NetworkPolicyPort:
+    __slots__ = ("port", "protocol", "end_port")
+
+    def __init__(self, port=None, protocol=None, end_port=None):
+        self.port = port
+        self.protocol = protocol
+        self.end_port = end_port
+
+    @staticmethod
+    def from_dict(data: dict) -> "NetworkPolicyPort":
+        return NetworkPolicyPort(data.get("port"), data.get("protocol"), data.get("endPort"))
+
+
+def _peers(data: Optional[list]) -> Optional[List[NetworkPolicyPeer]]:
+    return None if data is None else [NetworkPolicyPeer.from_dict(p) for p in data]
+
+
+def _ports(data: Optional[list]) -> Optional[List[NetworkPolicyPort]]:
+    return None if data is None else [NetworkPolicyPort.from_dict(p) for p in data]
+
+
+class NetworkPolicyIngressRule:
+    __slots__ = ("_from", "ports")
+
+    def __init__(self, _from=None, ports=None):
+        self._from = _from
+        self.ports = ports
+
+    @staticmethod
+    def from_dict(data: dict) -> "NetworkPolicyIngressRule":
+        return NetworkPolicyIngressRule(_peers(data.get("from")), _ports(data.get("ports")))
+
+
+class NetworkPolicyEgressRule:
+    __slots__ = ("to", "ports")
+
+    def __init__(self, to=None, ports=None):
+        self.to = to
+        self.ports = ports
+
+    @staticmethod
+    def from_dict(data: dict) -> "NetworkPolicyEgressRule":
+        return NetworkPolicyEgressRule(_peers(data.get("to")), _ports(data.get("ports")))
+
+
+class NetworkPolicySpec:
+    __slots__ = ("pod_selector", "ingress", "egress", "policy_types")
+
+    def __init__(self, pod_selector=None, ingress=None, egress=None, policy_types=None):
+        self.pod_selector = pod_selector
+        self.ingress = ingress
+        self.egress = egress
+        self.policy_types = policy_types
+
+    @staticmethod
+    def from_dict(data: Optional[dict]) -> Optional["NetworkPolicySpec"]:
+        if data is None:
+            return None
+        ingress = data.get("ingress")
+        egress = data.get("egress")
+        return NetworkPolicySpec(
+            LabelSelector.from_dict(data.get("podSelector")),
+            None if ingress is None else [NetworkPolicyIngressRule.from_dict(r) for r in ingress],
+            None if egress is None else [NetworkPolicyEgressRule.from_dict(r) for r in egress],
+            data.get("policyTypes"))
+
+
+class NetworkPolicy:
+    __slots__ = ("metadata", "spec")
+
+    def __init__(self, metadata, spec=None):
+        self.metadata = metadata
+        self.spec = spec
+
+    @staticmethod
+    def from_dict(data: dict) -> "NetworkPolicy":
+        return NetworkPolicy(ObjectMeta.from_dict(data.get("metadata")), NetworkPolicySpec.from_dict(data.get("spec")))
+
+
+class ContainerPort:
+    __slots__ = ("name", "container_port", "protocol")
+
+    def __init__(self, container_port, name=None, protocol=None):
+        self.container_port = container_port
+        self.name = name
+        self.protocol = protocol
+
+    @staticmethod
+    def from_dict(data: dict) -> "ContainerPort":
+        return ContainerPort(data["containerPort"], data.get("name"), data.get("protocol"))
+
+
+class Container:
+    __slots__ = ("name", "ports")
+
+    def __init__(self, name, ports=None):
+        self.name = name
+        self.ports = ports
+
+    @staticmethod
+    def from_dict(data: dict) -> "Container":
+        ports = data.get("ports")
+        return Container(data.get("name"), None if ports is None else [ContainerPort.from_dict(p) for p in ports])
+
+
+class PodSpec:
+    __slots__ = ("containers",)
+
+    def __init__(self, containers=None):
+        self.containers = containers
+
+    @staticmethod
+    def from_dict(data: Optional[dict]) -> Optional["PodSpec"]:
+        if data is None:
+            return None
+        return PodSpec([Container.from_dict(c) for c in data.get("containers") or []])
+
+
+class Pod:
+    __slots__ = ("metadata", "spec")
+
+    def __init__(self, metadata, spec=None):
+        self.metadata = metadata
+        self.spec = spec
+
+    @staticmethod
+    def from_dict(data: dict) -> "Pod":
+        return Pod(ObjectMeta.from_dict(data.get("metadata")), PodSpec.from_dict(data.get("spec")))
+
+
+class Namespace:
+    __slots__ = ("metadata",)
+
+    def __init__(self, metadata):
+        self.metadata = metadata
+
+    @staticmethod
+    def from_dict(data: dict) -> "Namespace":
+        return Namespace(ObjectMeta.from_dict(data.get("metadata")))
+
+
+# manifest kind or kubernetes.client model name -> lightweight model
+KINDS = {
+    "Pod": Pod,
+    "V1Pod": Pod,
+    "NetworkPolicy": NetworkPolicy,
+    "V1NetworkPolicy": NetworkPolicy,
+    "Namespace": Namespace,
+    "V1Namespace": Namespace,
+}
+
+
+def from_dict(kind: str, data: dict):
+    return KINDS[kind].from_dict(data)
+
+
+def from_dicts(datas: Iterable[dict], kind: Optional[str] = None) -> List[Any]:
+    """
+    If kind is None, it is taken from the kind field of each manifest
+    """
+    if kind is not None:
+        return [from_dict(kind, data) for data in datas]
+    return [from_dict(data["kind"], data) for data in datas]
+
+
+def from_model(obj):
+    """
+    Convert a kubernetes.client model (V1Pod, V1NetworkPolicy, V1Namespace)
+    """
+    from kubernetes.client import ApiClient
+    data = ApiClient().sanitize_for_serialization(obj)
+    return from_dict(type(obj).__name__, data)
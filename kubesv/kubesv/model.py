@@ -1,27 +1,66 @@
 """
 k8s configuration models
-use kubernetes.client.models + adapter
+use kubernetes.client.models (or the lightweight kubesv.lite models) + adapter
 """
+from __future__ import annotations
+
 import ipaddress
-import z3
 
 from pprint import pprint
 from dataclasses import dataclass
 from typing import *
 from typing_extensions import *
-from kubernetes.client.models import (
-    V1ObjectMeta,
-    V1Pod, 
-    V1IPBlock,
-    V1LabelSelector,
-    V1NetworkPolicy,
-    V1NetworkPolicySpec,
-    V1NetworkPolicyPeer,
-    V1NetworkPolicyPort,
-    V1NetworkPolicyEgressRule,
-    V1NetworkPolicyIngressRule,
-    V1Namespace,
-)
+from .lazy import lazy_import
+from .ports import MIN_PORT, MAX_PORT, DEFAULT_PROTOCOL, PortRange
+
+z3 = lazy_import("z3")
+
+if TYPE_CHECKING:
+    from kubernetes.client.models import (
+        V1ObjectMeta,
+        V1Pod, 
+        V1IPBlock,
+        V1LabelSelector,
+        V1NetworkPolicy,
+        V1NetworkPolicySpec,
+        V1NetworkPolicyPeer,
+        V1NetworkPolicyPort,
+        V1NetworkPolicyEgressRule,
+        V1NetworkPolicyIngressRule,
+        V1Namespace,
+    )
+
+
+class memoized_property:
+    """
+    A property computed once per adapter and then cached in the instance __dict__
+    (a non-data descriptor, so later reads are plain attribute lookups)
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        value = self.func(obj)
+        obj.__dict__[self.name] = value
+        return value
+
+
+class MemoizedAdapter:
+    """
+    Adapters wrap k8s models that are treated as immutable,
+    call invalidate() after updating the wrapped model in place
+    """
+
+    def invalidate(self):
+        for klass in type(self).__mro__:
+            for name, attr in vars(klass).items():
+                if isinstance(attr, memoized_property):
+                    self.__dict__.pop(name, None)
 
 
 class NamespaceAdapter:
@@ -56,7 +95,7 @@ class NamespaceAdapter:
         }
 
 
-class PodAdapter:
+class PodAdapter(MemoizedAdapter):
     """
     provide some adapter function for k8s client models
     potentially, we can parse it from kubectl outputs
@@ -84,6 +123,25 @@ class PodAdapter:
     def labels(self) -> Dict[str, str]:
         return self.metadata.labels if self.metadata.labels else {}
 
+    @memoized_property
+    def named_ports(self) -> Dict[Tuple[str, str], int]:
+        """
+        (protocol, name) -> port number of the named container ports,
+        the values named ports of policy rules resolve to on this pod
+        """
+        ports = {}
+        spec = self.pod.spec
+        if spec is None:
+            return ports
+        for container in spec.containers or []:
+            for p in container.ports or []:
+                if p.name is None:
+                    continue
+                protocol = p.protocol if p.protocol is not None else DEFAULT_PROTOCOL
+                # container port names are unique in a pod, keep the first one otherwise
+                ports.setdefault((protocol, p.name), p.container_port)
+        return ports
+
     def to_dict(self):
         return {
             "name": self.name,
@@ -124,7 +182,7 @@ class InRelation:
         }
 
 
-class LabelSelectorAdapter:
+class LabelSelectorAdapter(MemoizedAdapter):
     """
     A label selector is a label query over a set of resources. 
     The result of matchLabels and matchExpressions are ANDed. 
@@ -135,7 +193,7 @@ class LabelSelectorAdapter:
     def __init__(self, selector: V1LabelSelector):
         self.selector = selector
 
-    @property
+    @memoized_property
     def match_expressions(self) -> Optional[List[Union[ExistRelation, InRelation]]]:
         """
         matchExpressions is a list of label selector requirements. The requirements are ANDed
@@ -152,8 +210,9 @@ class LabelSelectorAdapter:
                 exprs.append(InRelation(InRelation.NOT_IN, expr.key, expr.values))
             if expr.operator.lower() == "exists":
                 exprs.append(ExistRelation(ExistRelation.EXISTS, expr.key))
-            if expr.operator.lower() == "doesnotexists":
-                exprs.append(ExistRelation(ExistRelation.DOES_NOT_EXISTS, expr.key))        
+            # NOTE: also the misspelled "DoesNotExists" older manifests of this repo use
+            if expr.operator.lower() in ("doesnotexist", "doesnotexists"):
+                exprs.append(ExistRelation(ExistRelation.DOES_NOT_EXISTS, expr.key))
         return exprs
 
     @property
@@ -172,103 +231,152 @@ class LabelSelectorAdapter:
     def to_dict(self):
         return {
             "match_labels": self.match_labels,
-            "match_expressions": self.selector.match_expressions if self.selector.match_expressions else None
+            "match_expressions": [
+                {"key": e.key, "operator": e.operator, "values": e.values} for e in self.selector.match_expressions
+            ] if self.selector.match_expressions else None
         }
 
-    def define_label_selector(self, idx: int, gi, var, rhs: List[Any], prefix: str, is_namespace=False) -> bool:
+    def canonical(self) -> FrozenSet[Tuple[str, int, Tuple[str, ...]]]:
+        """
+        Canonical form of the selector: the set of ANDed (key, operator, sorted values) requirements.
+        matchLabels {k: v} is rewritten to (k, In, (v,)), so equivalent selectors share one key.
+        The empty set is the empty selector.
+        """
+        reqs = set()
+        if self.match_expressions is not None:
+            for expr in self.match_expressions:
+                if isinstance(expr, InRelation):
+                    reqs.add((expr.key, expr.operator, tuple(sorted(set(expr.values)))))
+                else:
+                    reqs.add((expr.key, expr.operator, ()))
+        if self.match_labels is not None:
+            for k, v in self.match_labels.items():
+                reqs.add((k, InRelation.IN, (v,)))
+        return frozenset(reqs)
+
+    def define_label_selector(self, gi, var, rhs: List[Any], is_namespace=False) -> bool:
         """
         Return a boolean value indicating quick fail -> no possible key
         An empty label selector matches all objects. (matchExpressions == matchLabels == null)
         A null label selector matchs no objects (e.g. if namespace_selectors == null)
+        Each distinct canonical selector is translated once into a shared relation, memoized in gi.
         """
-        match_expr = self.match_expressions
-        match_label = self.match_labels
-
-        if match_expr is not None:
-            for expr in match_expr:
-                key_label = None
-                key_label_exists = None
-                if is_namespace:
-                    key_label = "{}__namespace".format(expr.key)
-                    key_label_exists = "{}__exists".format(key_label)
-                    key_label = gi.get_relation_ns(key_label)
-                    key_label_exists = gi.get_relation_ns(key_label_exists)
-                else:
-                    key_label = expr.key
-                    key_label_exists = "{}__exists".format(key_label)
-                    key_label = gi.get_relation(key_label)
-                    key_label_exists = gi.get_relation(key_label_exists)
+        reqs = self.canonical()
+        # empty selector, no constraint
+        if not reqs:
+            return False
+
+        key = (is_namespace, reqs)
+        if not gi.has_selector(key):
+            gi.register_selector(key, LabelSelectorAdapter.define_canonical_selector(gi, reqs, is_namespace))
+
+        selector = gi.get_selector(key)
+        # quick fail, no possible match
+        if selector is None:
+            return True
+        rhs.append(selector(var))
+        return False
+
+    @staticmethod
+    def define_canonical_selector(gi, reqs: FrozenSet[Tuple[str, int, Tuple[str, ...]]], is_namespace=False):
+        """
+        selector_n(Var) :- is_pod/is_nam(Var), requirement_0(Var), requirement_1(Var), ...
+        Return None on quick fail (an In/Exists requirement on a key no object has)
+        """
+        if is_namespace:
+            var = gi.declare_var("sel_nam_var", gi.nam_sort)
+            rhs = [gi.get_relation_core("is_nam")(var)]
+        else:
+            var = gi.declare_var("sel_pod_var", gi.pod_sort)
+            rhs = [gi.get_relation_core("is_pod")(var)]
+
+        for key, operator, values in sorted(reqs):
+            if is_namespace:
+                key_label = gi.get_relation_ns("{}__namespace".format(key))
+                key_label_exists = gi.get_relation_ns("{}__namespace__exists".format(key))
+            else:
+                key_label = gi.get_relation(key)
+                key_label_exists = gi.get_relation("{}__exists".format(key))
+            if key_label is None or key_label_exists is None:
+                # no object has the key: NotIn and DoesNotExist hold for all of them
+                if operator in (InRelation.NOT_IN, ExistRelation.DOES_NOT_EXISTS):
+                    continue
                 # quick fail, no possible match
-                if key_label is None or key_label_exists is None:
-                    return True
+                return None
 
-                if expr.operator == ExistRelation.EXISTS:
-                    rhs.append(key_label_exists(var))
-                elif expr.operator == ExistRelation.DOES_NOT_EXISTS:
-                    rhs.append(z3.Not(key_label_exists(var)))
-                else:
-                    values = expr.values
-                    in_func_name = "{}_{}_{}_in_{}".format(prefix, idx, expr.key, "namespace" if is_namespace else "pod")
-                    in_func = z3.Function(in_func_name, gi.pod_sort, z3.BoolSort())
-                    in_var = None
-                    if is_namespace:
-                        in_var = gi.declare_var("in_nam_var", gi.nam_sort)
-                    else:
-                        in_var = gi.declare_var("in_pod_var", gi.pod_sort)
-                    gi.register_relation(in_func_name, in_func, is_core=True)
-
-                    for v in values:
-                        gi.add_rule(in_func(in_var), key_label(in_var, gi.get_or_create_literal(v)))
-                    
-                    if expr.operator == InRelation.IN:
-                        rhs.append(in_func(var))
-                    else:
-                        rhs.append(z3.Not(in_func(var)))
-
-        if match_label is not None:
-            for k, v in match_label.items():
-                k_entity = k
-                if is_namespace:
-                    k_entity = k_entity + "__namespace"
-                    k_entity = gi.get_relation_ns(k_entity)
+            if operator == ExistRelation.EXISTS:
+                rhs.append(key_label_exists(var))
+            elif operator == ExistRelation.DOES_NOT_EXISTS:
+                rhs.append(z3.Not(key_label_exists(var)))
+            else:
+                in_atom = LabelSelectorAdapter.define_in_relation(gi, key, values, key_label, is_namespace)(var)
+                if operator == InRelation.IN:
+                    rhs.append(in_atom)
                 else:
-                    k_entity = gi.get_relation(k_entity)
+                    rhs.append(z3.Not(in_atom))
 
-                # quick fail
-                if k_entity is None:
-                    return True
+        func_name = "{}_selector_{}".format("namespace" if is_namespace else "pod", gi.n_selectors())
+        func = z3.Function(func_name, gi.nam_sort if is_namespace else gi.pod_sort, z3.BoolSort())
+        gi.register_relation(func_name, func, is_core=True)
+        gi.add_rule(func(var), rhs)
+        return func
 
-                rhs.append(k_entity(var, gi.get_or_create_literal(v)))
+    @staticmethod
+    def define_in_relation(gi, key: str, values: Tuple[str, ...], key_label, is_namespace=False):
+        """
+        Return a callable Var -> (label key of Var is in values), shared by all selectors
+        """
+        # a single value needs no helper relation
+        if len(values) == 1:
+            lit = gi.get_or_create_literal(values[0])
+            return lambda var: key_label(var, lit)
+
+        in_key = (is_namespace, key, values)
+        if not gi.has_in_relation(in_key):
+            in_func_name = "{}_in_{}_{}".format(key, "namespace" if is_namespace else "pod", gi.n_in_relations())
+            in_func = z3.Function(in_func_name, gi.nam_sort if is_namespace else gi.pod_sort, z3.BoolSort())
+            in_var = None
+            if is_namespace:
+                in_var = gi.declare_var("in_nam_var", gi.nam_sort)
+            else:
+                in_var = gi.declare_var("in_pod_var", gi.pod_sort)
+            gi.register_relation(in_func_name, in_func, is_core=True)
 
-        return False
+            for v in values:
+                gi.add_rule(in_func(in_var), key_label(in_var, gi.get_or_create_literal(v)))
+            gi.register_in_relation(in_key, in_func)
+        return gi.get_in_relation(in_key)
 
 
 IPAddress = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
-class PolicyPeerAdapter:
+class PolicyPeerAdapter(MemoizedAdapter):
 
-    def __init__(self, peer: V1NetworkPolicyPeer, direction):
+    def __init__(self, peer: V1NetworkPolicyPeer, direction, namespace: Optional[str] = None):
         self.peer = peer
         self.direction = direction
+        # namespace of the policy, None if unknown (a peer without namespaceSelector then selects in all namespaces)
+        self.namespace = namespace
 
-    @property
+    @memoized_property
     def ip_block(self) -> Optional[Tuple[IPAddress, List[IPAddress]]]:
         """
-        TODO: for current version, may ignore this selector
         IPBlock defines policy on a particular IPBlock. 
         If this field is set then neither of the other fields can be.
+        It selects no pod, only external endpoints (see ipblocks.py)
         """
         # CIDR is a string representing the IP Block Valid examples are "192.168.1.1/24" or "2001:db9::/64"
+        # NOTE: host bits may be set (192.168.1.1/24), hence strict=False
         if self.peer.ip_block is None:
             return None
 
         ip_block: V1IPBlock = self.peer.ip_block
-        cidr = ipaddress.ip_network(ip_block.cidr)
+        cidr = ipaddress.ip_network(ip_block.cidr, strict=False)
         
         if ip_block._except is None:
             return (cidr, [])
-        return (cidr, list(map(ipaddress.ip_network, ip_block._except)))
+        return (cidr, [ipaddress.ip_network(e, strict=False) for e in ip_block._except])
 
-    @property
+    @memoized_property
     def namespace_selector(self) -> Optional[LabelSelectorAdapter]:
         """
         Selects Namespaces using cluster-scoped labels. 
@@ -281,7 +389,7 @@ class PolicyPeerAdapter:
             return None
         return LabelSelectorAdapter(self.peer.namespace_selector)
 
-    @property
+    @memoized_property
     def pod_selector(self) -> Optional[LabelSelectorAdapter]:
         """
         This is a label selector which selects Pods. 
@@ -302,34 +410,45 @@ class PolicyPeerAdapter:
         }
 
     def define_peer_selector(self, idx: int, gi, pod_var, ns_var, rhs: List[Any], is_namespace=False) -> bool:
+        # an ipBlock peer allows no pod
+        if self.ip_block is not None:
+            return True
         if self.namespace_selector is not None:
-            fail = self.namespace_selector.define_label_selector(idx, gi, ns_var, rhs, self.direction, is_namespace=True)
+            fail = self.namespace_selector.define_label_selector(gi, ns_var, rhs, is_namespace=True)
             # quick fail
             if fail:
                 return True
+        elif self.pod_selector is not None and self.namespace is not None:
+            # a podSelector alone selects the pods of the policy's own namespace
+            if self.namespace not in gi.nam_map:
+                return True
+            rhs.append(gi.get_relation_core("namespace")(pod_var, gi.get_namespace_idx(self.namespace)))
         if self.pod_selector is not None:
-            fail = self.pod_selector.define_label_selector(idx, gi, pod_var, rhs, self.direction)
+            fail = self.pod_selector.define_label_selector(gi, pod_var, rhs)
             # quick fail
             if fail:
                 return True
         return False
 
 
-class PolicyRuleAdatper:
+class PolicyRuleAdatper(MemoizedAdapter):
     """
     provide some adapter function for k8s policy rules
     """
     INGRESS = 0
     EGRESS = 1
 
-    def __init__(self, rule: Union[V1NetworkPolicyEgressRule, V1NetworkPolicyIngressRule]):
-        if type(rule) == V1NetworkPolicyEgressRule:
-            self.direction = PolicyRuleAdatper.EGRESS
-        else:
-            self.direction = PolicyRuleAdatper.INGRESS
+    def __init__(self, rule: Union[V1NetworkPolicyEgressRule, V1NetworkPolicyIngressRule], direction: Optional[int] = None,
+            namespace: Optional[str] = None):
+        # NOTE: rule may be a kubernetes.client model or a kubesv.lite one, only egress rules have `to`
+        if direction is None:
+            direction = PolicyRuleAdatper.EGRESS if hasattr(rule, "to") else PolicyRuleAdatper.INGRESS
+        self.direction = direction
         self.rule = rule
+        # namespace of the policy, see PolicyPeerAdapter
+        self.namespace = namespace
 
-    @property
+    @memoized_property
     def peer(self) -> Optional[List[PolicyPeerAdapter]]:
         """
         ingress: [] -> deny all
@@ -342,17 +461,17 @@ class PolicyRuleAdatper:
         if self.direction == PolicyRuleAdatper.EGRESS:
             if self.rule.to is None:
                 return None
-            return list(map(lambda x: PolicyPeerAdapter(x, "egress_allow"), self.rule.to))
+            return [PolicyPeerAdapter(x, "egress_allow", self.namespace) for x in self.rule.to]
         if self.rule._from is None:
             return None
-        return list(map(lambda x: PolicyPeerAdapter(x, "ingress_allow"), self.rule._from))
+        return [PolicyPeerAdapter(x, "ingress_allow", self.namespace) for x in self.rule._from]
 
     def define_peer_rule(self, idx: int, gi, pod_var, ns_var) -> List[List[Any]]:
         # return many OR branches
 
         # If this field is empty or missing, this rule matches all destinations -> no rhs added
         if self.peer is None:
-            return
+            return [[]]
 
         all_rhs = []
         for p in self.peer:
@@ -362,7 +481,7 @@ class PolicyRuleAdatper:
                all_rhs.append(rhs)
         return all_rhs
 
-    @property
+    @memoized_property
     def ports(self) -> Optional[List[Tuple[Optional[Union[int, str]], str]]]:
         """
         List of destination ports for outgoing traffic. 
@@ -382,7 +501,42 @@ class PolicyRuleAdatper:
             if p.protocol is not None:
                 results.append((p.port, p.protocol))
             else:
-                results.append((p.port, "TCP"))
+                results.append((p.port, DEFAULT_PROTOCOL))
+        return results
+
+    @memoized_property
+    def port_ranges(self) -> Optional[List[PortRange]]:
+        """
+        Numerical ports as (protocol, first, last) ranges, endPort included.
+        None if the rule matches all ports, named ports are left out (see named_ports).
+        """
+        if not self.rule.ports:
+            return None
+
+        ranges = []
+        for p in self.rule.ports:
+            protocol = p.protocol if p.protocol is not None else DEFAULT_PROTOCOL
+            port = p.port
+            if isinstance(port, str) and port.isdigit():
+                port = int(port)
+            if port is None:
+                ranges.append((protocol, MIN_PORT, MAX_PORT))
+            elif isinstance(port, int):
+                # NOTE: end_port is missing from older kubernetes.client models
+                end_port = getattr(p, "end_port", None)
+                ranges.append((protocol, port, end_port if end_port is not None else port))
+        return ranges
+
+    @memoized_property
+    def named_ports(self) -> List[Tuple[str, str]]:
+        """
+        Named ports as (protocol, name), resolved on the destination pod:
+        the selected pod of an ingress rule, the peer pod of an egress rule.
+        """
+        if not self.rule.ports:
+            return []
+        return [(p.protocol if p.protocol is not None else DEFAULT_PROTOCOL, p.port)
+            for p in self.rule.ports if isinstance(p.port, str) and not p.port.isdigit()]
 
     def to_dict(self):
         return {
@@ -391,7 +545,7 @@ class PolicyRuleAdatper:
         }
 
 
-class PolicyAdapter:
+class PolicyAdapter(MemoizedAdapter):
     """
     provide some adapter function for k8s policy models
     """
@@ -416,7 +570,7 @@ class PolicyAdapter:
     def spec(self) -> Optional[V1NetworkPolicySpec]:
         return self.policy.spec
 
-    @property
+    @memoized_property
     def egress_rules(self) -> Optional[List[PolicyRuleAdatper]]:
         """
         List of egress rules to be applied to the selected pods. 
@@ -427,7 +581,7 @@ class PolicyAdapter:
         """
         if self.spec.egress is None:
             return None
-        return list(map(PolicyRuleAdatper, self.spec.egress))
+        return [PolicyRuleAdatper(rule, PolicyRuleAdatper.EGRESS, self.namespace) for rule in self.spec.egress]
 
     def define_egress_rules(self, idx: int, gi):
         egress_allow_by_pol = gi.get_relation_core("egress_allow_by_pol")
@@ -448,7 +602,7 @@ class PolicyAdapter:
                 rhs.insert(0, namespace(pod_var, ns_var))
                 gi.add_rule(egress_allow_by_pol(pod_var, gi.pol_value(idx)), rhs)
 
-    @property
+    @memoized_property
     def ingress_rules(self) -> Optional[List[PolicyRuleAdatper]]:
         """
         List of ingress rules to be applied to the selected pods. 
@@ -461,7 +615,7 @@ class PolicyAdapter:
         # ingress: []
         if self.spec.ingress is None:
             return None
-        return list(map(PolicyRuleAdatper, self.spec.ingress))
+        return [PolicyRuleAdatper(rule, PolicyRuleAdatper.INGRESS, self.namespace) for rule in self.spec.ingress]
 
     def define_ingress_rules(self, idx: int, gi):
         ingress_allow_by_pol = gi.get_relation_core("ingress_allow_by_pol")
@@ -482,7 +636,7 @@ class PolicyAdapter:
                 rhs.insert(0, namespace(pod_var, ns_var))
                 gi.add_rule(ingress_allow_by_pol(pod_var, gi.pol_value(idx)), rhs)
 
-    @property
+    @memoized_property
     def pod_selector(self) -> Optional[LabelSelectorAdapter]:
         """
         Selects the pods to which this NetworkPolicy object applies. 
@@ -512,14 +666,14 @@ class PolicyAdapter:
         if self.pod_selector is None:
             pass
         else:
-            fail = self.pod_selector.define_label_selector(idx, gi, pod_var, rhs, "select_by_pol")
+            fail = self.pod_selector.define_label_selector(gi, pod_var, rhs)
             # quick fail, no possible selection
             if fail:
                 return
 
         gi.add_rule(selected_by_pol(pod_var, gi.pol_value(idx)), rhs)
 
-    @property
+    @memoized_property
     def policy_types(self) -> List[int]:
         """
         List of rule types that the NetworkPolicy relates to. 
@@ -552,3 +706,10 @@ class PolicyAdapter:
             "pod_selector": self.pod_selector.to_dict() if self.pod_selector else None,
             "policy_types": self.policy_types
         }
+
+
+def adapt(objs: Iterable[Any], adapter: type) -> List[Any]:
+    """
+    Wrap k8s models (kubernetes.client or kubesv.lite) into adapters, adapters are kept as is
+    """
+    return [obj if isinstance(obj, adapter) else adapter(obj) for obj in objs]
@@ -0,0 +1,659 @@
+"""
+Native bitset evaluation of the kubesv model, without z3.
+
+Mirrors the relations of constraint.define_model:
+    unary pod relations are bitarrays over pods,
+    pod x policy relations are lists of pod bitarrays indexed by policy,
+    pod x pod relations are lists of bitarray rows indexed by the first argument
+    (except egress_traffic, which is indexed by the selected pod, see below).
+The results match build(..., mode="z3"), including the quick fail of
+LabelSelectorAdapter.define_label_selector on In/Exists requirements over label keys no object has.
+
+These relations ignore rule ports (a pod pair is connected if it is on some port),
+port-aware edges are evaluated per class of the PortPartition, see edge_on.
+ipBlock peers allow no pod, only the external endpoints they cover, see define_external_facts.
+"""
+from bitarray import bitarray
+from bitarray.util import zeros, any_and
+from kano.algorithm import covered_pairs, iter_covered_pairs
+from typing import *
+from typing_extensions import *
+from .model import *
+from .ports import PortPartition, PortRange
+from .ipblocks import EndpointIndex
+
+
+def ones(n: int) -> bitarray:
+    b = bitarray(n)
+    b.setall(True)
+    return b
+
+
+def iter_ones(b: bitarray) -> Iterator[int]:
+    return b.search(bitarray('1'))
+
+
+def eval_traffic(n: int,
+        selected_by_pol: List[bitarray],
+        ingress_allow_by_pol: List[bitarray],
+        egress_allow_by_pol: List[bitarray],
+        selected_by_any: bitarray,
+        check_self_traffic: bool,
+        check_select_by_any: bool) -> Tuple[List[bitarray], List[bitarray], List[bitarray]]:
+    """
+    ingress_traffic, egress_traffic and edge rows of n pods, see NativeInfo.eval_traffic
+    A module function so it can also evaluate the namespace blocks of partition.py in worker processes
+    """
+    selected_by_none = ~selected_by_any
+
+    ingress_traffic = [zeros(n) for _ in range(n)]
+    egress_traffic = [zeros(n) for _ in range(n)]
+
+    for pol, selected in enumerate(selected_by_pol):
+        if not selected.any():
+            continue
+        for src in iter_ones(ingress_allow_by_pol[pol]):
+            ingress_traffic[src] |= selected
+        egress_allow = egress_allow_by_pol[pol]
+        for sel in iter_ones(selected):
+            egress_traffic[sel] |= egress_allow
+
+    for i in range(n):
+        if check_self_traffic:
+            ingress_traffic[i][i] = True
+        if check_select_by_any:
+            ingress_traffic[i] |= selected_by_none
+            if selected_by_none[i]:
+                egress_traffic[i].setall(True)
+
+    # connected, if source's egress contains destination & destination's ingress contains source
+    edge = [ingress_traffic[i] & egress_traffic[i] for i in range(n)]
+    return ingress_traffic, egress_traffic, edge
+
+
+class NativeInfo:
+    def __init__(self,
+            pods: List[PodAdapter],
+            policies: List[PolicyAdapter],
+            namespaces: List[NamespaceAdapter],
+            check_self_ingress_traffic=True,
+            check_select_by_no_policy=False,
+            ground_default_pod=False,
+            endpoints: Optional[EndpointIndex] = None):
+
+        self.check_self_traffic = check_self_ingress_traffic
+        self.check_select_by_any = check_select_by_no_policy
+        # NOTE: grounding is a z3 optimization only, the semantics are the same
+        self.ground_default_pod = ground_default_pod
+
+        self.namespaces = namespaces
+        self.pods = pods
+        self.policies = policies
+        self.n_pod = len(pods)
+        self.n_nam = len(namespaces)
+
+        self.nam_map = {}
+        for i, ns in enumerate(namespaces):
+            self.nam_map[ns.name] = i
+
+        # label key -> label value -> pods/namespaces with that label
+        self.pod_labels: Dict[str, Dict[str, bitarray]] = {}
+        self.pod_labels_exists: Dict[str, bitarray] = {}
+        self.nam_labels: Dict[str, Dict[str, bitarray]] = {}
+        self.nam_labels_exists: Dict[str, bitarray] = {}
+        # namespace index -> pods in that namespace
+        self.nam_pods: List[bitarray] = [zeros(self.n_pod) for _ in range(self.n_nam)]
+        # (is_namespace, canonical selector) -> selected pods/namespaces, shared by all policies
+        self.selectors: Dict[Any, Optional[bitarray]] = {}
+
+        # pol index -> pods
+        self.selected_by_pol: List[bitarray] = []
+        self.ingress_allow_by_pol: List[bitarray] = []
+        self.egress_allow_by_pol: List[bitarray] = []
+        self.selected_by_any: bitarray = zeros(self.n_pod)
+
+        # ingress_traffic(src, sel): src -> sel
+        self.ingress_traffic: List[bitarray] = []
+        # egress_traffic(dst, sel): sel -> dst, the selected pod is the sender
+        self.egress_traffic: List[bitarray] = []
+        # edge(src, dst): src -> dst
+        self.edge: List[bitarray] = []
+
+        self._edge_transpose = None
+        self._path = None
+
+        # port restricted rule index -> (direction, pol index, allowed pods, destination pods), see define_port_facts
+        # destination pods is None unless the rule comes from a named port
+        self.port_rules: List[Tuple[int, int, bitarray, Optional[bitarray]]] = []
+        # (protocol, port name) -> port number -> pods with a container port of that name and number
+        self._named_port_pods: Optional[Dict[Tuple[str, str], Dict[int, bitarray]]] = None
+        # pol index -> pods allowed by the rules of the policy matching all ports
+        self.ingress_allow_all_ports: List[bitarray] = []
+        self.egress_allow_all_ports: List[bitarray] = []
+        self._port_partition: Optional[PortPartition] = None
+        # port class -> edge rows
+        self._edge_by_class: Dict[int, List[bitarray]] = {}
+
+        # external endpoints, relations over them are bitarrays over endpoints
+        self.endpoints = endpoints
+        # pol index -> endpoints
+        self.ext_ingress_allow_by_pol: List[bitarray] = []
+        self.ext_egress_allow_by_pol: List[bitarray] = []
+        # pod -> endpoints the pod can send to
+        self.external_egress: List[bitarray] = []
+        # pod -> endpoints the pod can receive from
+        self.external_ingress: List[bitarray] = []
+
+    def define_pod_facts(self):
+        for i, pod in enumerate(self.pods):
+            self.nam_pods[self.nam_map[pod.namespace]][i] = True
+            for k, v in pod.labels.items():
+                self._add_label(self.pod_labels, self.pod_labels_exists, self.n_pod, i, k, v)
+
+        for i, ns in enumerate(self.namespaces):
+            for k, v in ns.labels.items():
+                self._add_label(self.nam_labels, self.nam_labels_exists, self.n_nam, i, k, v)
+
+    def with_policies(self, policies: List[PolicyAdapter]) -> "NativeInfo":
+        """
+        A NativeInfo over the same pods and namespaces with other policies, ready for define_pol_facts:
+        the pod facts and the selector cache only depend on pods and namespaces and are shared
+        """
+        ni = NativeInfo(self.pods, policies, self.namespaces,
+            check_self_ingress_traffic=self.check_self_traffic,
+            check_select_by_no_policy=self.check_select_by_any,
+            ground_default_pod=self.ground_default_pod,
+            endpoints=self.endpoints)
+        ni.nam_pods = self.nam_pods
+        ni.pod_labels, ni.pod_labels_exists = self.pod_labels, self.pod_labels_exists
+        ni.nam_labels, ni.nam_labels_exists = self.nam_labels, self.nam_labels_exists
+        ni.selectors = self.selectors
+        ni._named_port_pods = self._named_port_pods
+        return ni
+
+    @staticmethod
+    def _add_label(labels, exists, n, i, k, v):
+        if k not in labels:
+            labels[k] = {}
+            exists[k] = zeros(n)
+        if v not in labels[k]:
+            labels[k][v] = zeros(n)
+        labels[k][v][i] = True
+        exists[k][i] = True
+
+    def eval_label_selector(self, selector: LabelSelectorAdapter, is_namespace=False) -> Optional[bitarray]:
+        """
+        Return the selected pods (or namespaces), None on quick fail (see define_label_selector)
+        The result is shared between equivalent selectors and must not be modified
+        """
+        key = (is_namespace, selector.canonical())
+        if key not in self.selectors:
+            self.selectors[key] = self._eval_label_selector(selector, is_namespace)
+        return self.selectors[key]
+
+    def _eval_label_selector(self, selector: LabelSelectorAdapter, is_namespace=False) -> Optional[bitarray]:
+        labels, exists, n = self.pod_labels, self.pod_labels_exists, self.n_pod
+        if is_namespace:
+            labels, exists, n = self.nam_labels, self.nam_labels_exists, self.n_nam
+
+        selected = ones(n)
+        match_expr = selector.match_expressions
+        match_label = selector.match_labels
+
+        if match_expr is not None:
+            for expr in match_expr:
+                if expr.key not in labels:
+                    # no object has the key: NotIn and DoesNotExist hold for all of them
+                    if expr.operator in (InRelation.NOT_IN, ExistRelation.DOES_NOT_EXISTS):
+                        continue
+                    # quick fail, no possible match
+                    return None
+
+                if expr.operator == ExistRelation.EXISTS:
+                    selected &= exists[expr.key]
+                elif expr.operator == ExistRelation.DOES_NOT_EXISTS:
+                    selected &= ~exists[expr.key]
+                else:
+                    in_set = zeros(n)
+                    for v in expr.values:
+                        if v in labels[expr.key]:
+                            in_set |= labels[expr.key][v]
+                    if expr.operator == InRelation.IN:
+                        selected &= in_set
+                    else:
+                        selected &= ~in_set
+
+        if match_label is not None:
+            for k, v in match_label.items():
+                # quick fail
+                if k not in labels:
+                    return None
+                if v not in labels[k]:
+                    selected.setall(False)
+                else:
+                    selected &= labels[k][v]
+
+        return selected
+
+    def eval_peer(self, peer: PolicyPeerAdapter) -> Optional[bitarray]:
+        # an ipBlock peer allows no pod
+        if peer.ip_block is not None:
+            return None
+        selected = ones(self.n_pod)
+        if peer.namespace_selector is not None:
+            nams = self.eval_label_selector(peer.namespace_selector, is_namespace=True)
+            # quick fail
+            if nams is None:
+                return None
+            in_nams = zeros(self.n_pod)
+            for i in iter_ones(nams):
+                in_nams |= self.nam_pods[i]
+            selected &= in_nams
+        elif peer.pod_selector is not None and peer.namespace is not None:
+            # a podSelector alone selects the pods of the policy's own namespace
+            if peer.namespace not in self.nam_map:
+                return None
+            selected &= self.nam_pods[self.nam_map[peer.namespace]]
+        if peer.pod_selector is not None:
+            pods = self.eval_label_selector(peer.pod_selector)
+            # quick fail
+            if pods is None:
+                return None
+            selected &= pods
+        return selected
+
+    def eval_rule(self, rule: PolicyRuleAdatper) -> bitarray:
+        # If this field is empty or missing, this rule matches all destinations
+        if rule.peer is None:
+            return ones(self.n_pod)
+
+        # each peer in the rule is OR-chained
+        allowed = zeros(self.n_pod)
+        for p in rule.peer:
+            peer_allowed = self.eval_peer(p)
+            if peer_allowed is not None:
+                allowed |= peer_allowed
+        return allowed
+
+    def eval_rules(self, rules: Optional[List[PolicyRuleAdatper]]) -> bitarray:
+        allowed = zeros(self.n_pod)
+        # no rules, nothing allowed by this policy
+        if rules is None:
+            return allowed
+
+        # each rule is OR-chained
+        for rule in rules:
+            allowed |= self.eval_rule(rule)
+            if allowed.all():
+                break
+        return allowed
+
+    def eval_pod_selector(self, pol: PolicyAdapter) -> bitarray:
+        # quick fail -> no possible namespace
+        if pol.namespace not in self.nam_map:
+            return zeros(self.n_pod)
+
+        selected = self.nam_pods[self.nam_map[pol.namespace]].copy()
+        # An empty podSelector matches all pods in this namespace.
+        if pol.pod_selector is not None:
+            pods = self.eval_label_selector(pol.pod_selector)
+            if pods is None:
+                return zeros(self.n_pod)
+            selected &= pods
+        return selected
+
+    def define_pol_facts(self):
+        for pol in self.policies:
+            self.selected_by_pol.append(self.eval_pod_selector(pol))
+            self.egress_allow_by_pol.append(self.eval_rules(pol.egress_rules))
+            self.ingress_allow_by_pol.append(self.eval_rules(pol.ingress_rules))
+
+    def define_model(self):
+        for selected in self.selected_by_pol:
+            self.selected_by_any |= selected
+        self.ingress_traffic, self.egress_traffic, self.edge = \
+            self.eval_traffic(self.ingress_allow_by_pol, self.egress_allow_by_pol)
+
+    def eval_traffic(self, ingress_allow_by_pol: List[bitarray], egress_allow_by_pol: List[bitarray]) \
+            -> Tuple[List[bitarray], List[bitarray], List[bitarray]]:
+        """
+        ingress_traffic, egress_traffic and edge rows for the given allowed pods of each policy
+        """
+        return eval_traffic(self.n_pod, self.selected_by_pol, ingress_allow_by_pol, egress_allow_by_pol,
+            self.selected_by_any, self.check_self_traffic, self.check_select_by_any)
+
+    def eval_external_rules(self, rules: Optional[List[PolicyRuleAdatper]]) -> bitarray:
+        n = len(self.endpoints)
+        allowed = zeros(n)
+        for rule in rules or []:
+            # If this field is empty or missing, this rule matches all destinations
+            if rule.peer is None:
+                allowed.setall(True)
+                break
+            for p in rule.peer:
+                if p.ip_block is not None:
+                    allowed |= self.endpoints.covered(*p.ip_block)
+        return allowed
+
+    def define_external_facts(self):
+        """
+        Traffic between pods and the external endpoints.
+        Like pod traffic, a pod selected by no policy has none unless check_select_by_no_policy.
+        """
+        n = len(self.endpoints)
+        for pol in self.policies:
+            self.ext_egress_allow_by_pol.append(self.eval_external_rules(pol.egress_rules))
+            self.ext_ingress_allow_by_pol.append(self.eval_external_rules(pol.ingress_rules))
+
+        self.external_egress = [zeros(n) for _ in range(self.n_pod)]
+        self.external_ingress = [zeros(n) for _ in range(self.n_pod)]
+        for pol, selected in enumerate(self.selected_by_pol):
+            for sel in iter_ones(selected):
+                self.external_egress[sel] |= self.ext_egress_allow_by_pol[pol]
+                self.external_ingress[sel] |= self.ext_ingress_allow_by_pol[pol]
+
+        if self.check_select_by_any:
+            for i in iter_ones(~self.selected_by_any):
+                self.external_egress[i].setall(True)
+                self.external_ingress[i].setall(True)
+
+    @property
+    def named_port_pods(self) -> Dict[Tuple[str, str], Dict[int, bitarray]]:
+        """
+        Index of the named container ports of all pods, built once from PodAdapter.named_ports
+        """
+        if self._named_port_pods is None:
+            self._named_port_pods = {}
+            for i, pod in enumerate(self.pods):
+                for key, number in pod.named_ports.items():
+                    numbers = self._named_port_pods.setdefault(key, {})
+                    if number not in numbers:
+                        numbers[number] = zeros(self.n_pod)
+                    numbers[number][i] = True
+        return self._named_port_pods
+
+    def define_port_facts(self):
+        """
+        Split the allowed pods of each policy by rule ports:
+        rules matching all ports are shared by every port class,
+        the port restricted ones only count for the classes they cover.
+        A named port becomes one rule per port number it resolves to,
+        restricted to the destination pods resolving it to that number.
+        """
+        rule_ranges = []
+        for pol_idx, pol in enumerate(self.policies):
+            for direction, rules, all_ports in (
+                    (PolicyRuleAdatper.INGRESS, pol.ingress_rules, self.ingress_allow_all_ports),
+                    (PolicyRuleAdatper.EGRESS, pol.egress_rules, self.egress_allow_all_ports)):
+                allowed = zeros(self.n_pod)
+                for rule in rules or []:
+                    if rule.port_ranges is None:
+                        allowed |= self.eval_rule(rule)
+                        continue
+                    rule_allowed = self.eval_rule(rule)
+                    self.port_rules.append((direction, pol_idx, rule_allowed, None))
+                    rule_ranges.append(rule.port_ranges)
+                    for protocol, name in rule.named_ports:
+                        for number, pods in self.named_port_pods.get((protocol, name), {}).items():
+                            self.port_rules.append((direction, pol_idx, rule_allowed, pods))
+                            rule_ranges.append([(protocol, number, number)])
+                all_ports.append(allowed)
+        self._port_partition = PortPartition(rule_ranges)
+
+    @property
+    def port_partition(self) -> PortPartition:
+        if self._port_partition is None:
+            self.define_port_facts()
+        return self._port_partition
+
+    def edge_of_class(self, port_class: int) -> List[bitarray]:
+        if port_class not in self._edge_by_class:
+            partition = self.port_partition
+            # NOTE: shallow copies, only the policies of the covering rules get a new bitarray
+            selected = list(self.selected_by_pol)
+            ingress_allow = list(self.ingress_allow_all_ports)
+            egress_allow = list(self.egress_allow_all_ports)
+            for rule in partition.classes[port_class]:
+                direction, pol, allowed, dst_pods = self.port_rules[rule]
+                if direction == PolicyRuleAdatper.EGRESS:
+                    egress_allow[pol] = egress_allow[pol] | (allowed if dst_pods is None else allowed & dst_pods)
+                elif dst_pods is None:
+                    ingress_allow[pol] = ingress_allow[pol] | allowed
+                else:
+                    # only the selected pods resolving the named port accept the traffic, as an extra policy
+                    selected.append(self.selected_by_pol[pol] & dst_pods)
+                    ingress_allow.append(allowed)
+                    egress_allow.append(zeros(self.n_pod))
+            self._edge_by_class[port_class] = eval_traffic(self.n_pod, selected, ingress_allow, egress_allow,
+                self.selected_by_any, self.check_self_traffic, self.check_select_by_any)[2]
+        return self._edge_by_class[port_class]
+
+    def edge_on(self, protocol: str, port: int) -> List[bitarray]:
+        """
+        edge rows for the traffic to the given destination port
+        """
+        return self.edge_of_class(self.port_partition.class_of(protocol, port))
+
+    @property
+    def edge_transpose(self) -> List[bitarray]:
+        if self._edge_transpose is None:
+            self._edge_transpose = [zeros(self.n_pod) for _ in range(self.n_pod)]
+            for src, row in enumerate(self.edge):
+                for dst in iter_ones(row):
+                    self._edge_transpose[dst][src] = True
+        return self._edge_transpose
+
+    @property
+    def path(self) -> List[bitarray]:
+        """
+        Transitive closure of edge (Warshall on bitset rows)
+        """
+        if self._path is None:
+            path = [row.copy() for row in self.edge]
+            for k in range(self.n_pod):
+                row_k = path[k]
+                for i in range(self.n_pod):
+                    if path[i][k]:
+                        path[i] |= row_k
+            self._path = path
+        return self._path
+
+    def reachable_from(self, idx: int) -> bitarray:
+        if self._path is not None:
+            return self._path[idx]
+        reached = self.edge[idx].copy()
+        frontier = reached.copy()
+        while frontier.any():
+            nxt = zeros(self.n_pod)
+            for i in iter_ones(frontier):
+                nxt |= self.edge[i]
+            frontier = nxt & ~reached
+            reached |= nxt
+        return reached
+
+    def reachable_to(self, idx: int) -> bitarray:
+        if self._path is not None:
+            return self.get_column(self._path, idx)
+        reached = self.get_column(self.edge, idx)
+        frontier = reached.copy()
+        while frontier.any():
+            nxt = zeros(self.n_pod)
+            for i, row in enumerate(self.edge):
+                if any_and(row, frontier):
+                    nxt[i] = True
+            frontier = nxt & ~reached
+            reached |= nxt
+        return reached
+
+    def get_column(self, rows: List[bitarray], idx: int) -> bitarray:
+        col = zeros(self.n_pod)
+        for i, row in enumerate(rows):
+            if row[idx]:
+                col[i] = True
+        return col
+
+    def get_rows(self, rel: str) -> List[bitarray]:
+        """
+        Rows of a pod x pod relation indexed by its first argument
+        """
+        if rel == "edge":
+            return self.edge
+        if rel == "path":
+            return self.path
+        if rel == "disconnect":
+            return [~row for row in self.edge]
+        if rel == "ingress_traffic":
+            return self.ingress_traffic
+        if rel == "egress_traffic":
+            # egress_traffic(dst, sel) is stored by sel
+            return [self.get_column(self.egress_traffic, dst) for dst in range(self.n_pod)]
+        raise ValueError("unknown pod relation {}".format(rel))
+
+
+def build_native(pods: List[PodAdapter],
+        pols: List[PolicyAdapter],
+        nams: List[NamespaceAdapter],
+        check_self_ingress_traffic=True,
+        check_select_by_no_policy=False,
+        ground_default_pod=False,
+        endpoints: Optional[Union[EndpointIndex, List[Tuple[str, str]]]] = None) -> NativeInfo:
+    """
+    endpoints: named external endpoints (name, IP address or CIDR) for ipBlock peers
+    """
+    if endpoints is not None and not isinstance(endpoints, EndpointIndex):
+        endpoints = EndpointIndex(endpoints)
+    ni = NativeInfo(pods, pols, nams,
+        check_self_ingress_traffic=check_self_ingress_traffic,
+        check_select_by_no_policy=check_select_by_no_policy,
+        ground_default_pod=ground_default_pod,
+        endpoints=endpoints)
+
+    ni.define_pod_facts()
+    ni.define_pol_facts()
+    ni.define_model()
+    if endpoints is not None:
+        ni.define_external_facts()
+    return ni
+
+
+def get_all_pairs(ni: NativeInfo, rel: str, src: Optional[int] = None, dst: Optional[int] = None):
+    """
+    Same shape as postprocess.get_all_pairs:
+    pairs if unbound, the free side if one side is bound, the bound pair if both are
+    """
+    if rel == "path" and src is not None and dst is None:
+        return set(iter_ones(ni.reachable_from(src)))
+    if rel == "path" and dst is not None and src is None:
+        return set(iter_ones(ni.reachable_to(dst)))
+
+    rows = ni.get_rows(rel)
+    if src is not None and dst is not None:
+        return {(src, dst)} if rows[src][dst] else set()
+    if src is not None:
+        return set(iter_ones(rows[src]))
+    if dst is not None:
+        return set(iter_ones(ni.get_column(rows, dst)))
+    return {(i, j) for i, row in enumerate(rows) for j in iter_ones(row)}
+
+
+def all_reach_isolate(ni: NativeInfo) -> Tuple[List[int], List[int]]:
+    # a pod is reachable by all if its column is full, isolated if its column is empty
+    reached_by_all = ones(ni.n_pod)
+    reached_by_any = zeros(ni.n_pod)
+    for row in ni.edge:
+        reached_by_all &= row
+        reached_by_any |= row
+    return list(iter_ones(reached_by_all)), list(iter_ones(~reached_by_any))
+
+
+def all_reachable(ni: NativeInfo) -> Set[int]:
+    return set(all_reach_isolate(ni)[0])
+
+
+def all_isolated(ni: NativeInfo) -> Set[int]:
+    return set(all_reach_isolate(ni)[1])
+
+
+def user_crosscheck(ni: NativeInfo, l: str) -> Set[int]:
+    """
+    Pods reached from a pod with a different value of label l (both pods must have l)
+    """
+    return set(iter_ones(user_crosscheck_bits(ni, l)))
+
+
+def user_crosscheck_bits(ni: NativeInfo, l: str) -> bitarray:
+    if l not in ni.pod_labels:
+        return zeros(ni.n_pod)
+    labeled = ni.pod_labels_exists[l]
+    violations = zeros(ni.n_pod)
+    for src, row in enumerate(ni.edge):
+        if not labeled[src]:
+            continue
+        same_user = ni.pod_labels[l][ni.pods[src].labels[l]]
+        violations |= row & labeled & ~same_user
+    return violations
+
+
+def system_isolation(ni: NativeInfo, idx: int) -> Set[int]:
+    return set(iter_ones(~ni.edge[idx]))
+
+
+def policy_sets(ni: NativeInfo) -> List[bitarray]:
+    # the selected, ingress allowed and egress allowed pods of each policy, end to end
+    return [selected + ingress_allow + egress_allow for selected, ingress_allow, egress_allow in
+        zip(ni.selected_by_pol, ni.ingress_allow_by_pol, ni.egress_allow_by_pol)]
+
+
+def policy_shadow(ni: NativeInfo) -> Set[Tuple[int, int]]:
+    """
+    (p0, p1) if every pod selected/allowed by p0 is also selected/allowed by p1
+    """
+    return covered_pairs(policy_sets(ni))
+
+
+def policy_conflict(ni: NativeInfo) -> Set[Tuple[int, int]]:
+    """
+    (p0, p1) if p0 and p1 have no selected/allowed pod in common
+    """
+    pols = set()
+    n_pol = len(ni.policies)
+    for p0 in range(n_pol):
+        for p1 in range(n_pol):
+            if p0 == p1:
+                continue
+            if not any_and(ni.selected_by_pol[p0], ni.selected_by_pol[p1]) and \
+                    not any_and(ni.ingress_allow_by_pol[p0], ni.ingress_allow_by_pol[p1]) and \
+                    not any_and(ni.egress_allow_by_pol[p0], ni.egress_allow_by_pol[p1]):
+                pols.add((p0, p1))
+    return pols
+
+
+def get_port_edges(ni: NativeInfo, protocol: str, port: int) -> Set[Tuple[int, int]]:
+    return {(i, j) for i, row in enumerate(ni.edge_on(protocol, port)) for j in iter_ones(row)}
+
+
+def allowed_ports(ni: NativeInfo, src: int, dst: int) -> List[PortRange]:
+    """
+    Port ranges on which src can connect to dst,
+    protocols no rule mentions are omitted (they are allowed iff the port class 0 is)
+    """
+    ranges = []
+    for protocol, first, last, port_class in ni.port_partition.intervals():
+        if not ni.edge_of_class(port_class)[src][dst]:
+            continue
+        if ranges and ranges[-1][0] == protocol and ranges[-1][2] == first - 1:
+            ranges[-1] = (protocol, ranges[-1][1], last)
+        else:
+            ranges.append((protocol, first, last))
+    return ranges
+
+
+def get_external_pairs(ni: NativeInfo, egress=True) -> Set[Tuple[int, int]]:
+    """
+    (pod, endpoint) pairs the pod can send to if egress, else (endpoint, pod) pairs the pod can receive from
+    """
+    if ni.endpoints is None:
+        raise ValueError("no external endpoints, see build_native(..., endpoints=...)")
+    if egress:
+        return {(i, e) for i, row in enumerate(ni.external_egress) for e in iter_ones(row)}
+    return {(e, i) for i, row in enumerate(ni.external_ingress) for e in iter_ones(row)}
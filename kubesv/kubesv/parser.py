@@ -1,22 +1,99 @@
 """
 k8s yaml file -> model
 XXX: could just generate models instead
+Deserialization is offline: no kube config or cluster is needed.
+With lite=True the lightweight models of kubesv.lite are built instead of kubernetes.client ones.
 """
-import yaml
-from kubernetes import client, config
+from __future__ import annotations
 
+import inspect
+import json
 
-def from_dict(kind: str, data: dict):
-    config.load_kube_config()
-    api = client.ApiClient()
-    
-    class FakeResposne:
-        def __init__(self, obj):
-            import json
-            self.data = json.dumps(obj)
+from functools import lru_cache
+from typing import *
+from . import lite as lite_models
+from .lazy import lazy_import
 
-    return api.deserialize(FakeResposne(data), kind)
+yaml = lazy_import("yaml")
 
+if TYPE_CHECKING:
+    from kubernetes import client
 
-def from_yaml(kind: str, yml: str):
-    return from_dict(kind, yaml.safe_load(yml))        
+
+# manifest kind -> kubernetes.client model
+KINDS = {
+    "Pod": "V1Pod",
+    "NetworkPolicy": "V1NetworkPolicy",
+    "Namespace": "V1Namespace",
+}
+
+_api_client = None
+
+
+def get_api_client() -> client.ApiClient:
+    # one shared client, creating one per object (and its configuration) costs milliseconds
+    global _api_client
+    if _api_client is None:
+        from kubernetes import client
+        _api_client = client.ApiClient()
+    return _api_client
+
+
+class JsonResponse:
+    """
+    The part of a REST response ApiClient.deserialize reads
+    """
+    def __init__(self, data: str):
+        self.data = data
+
+
+@lru_cache(maxsize=None)
+def takes_content_type() -> bool:
+    # recent clients take the response text and its content type, older ones the response
+    return "content_type" in inspect.signature(get_api_client().deserialize).parameters
+
+
+def deserialize(data: dict, kind: str):
+    # NOTE: default=str for the timestamps yaml loads as datetimes, the model parses them back
+    body = json.dumps(data, default=str)
+    if takes_content_type():
+        return get_api_client().deserialize(body, kind, "application/json")
+    return get_api_client().deserialize(JsonResponse(body), kind)
+
+
+def get_safe_loader():
+    # the C loader is much faster, but only available if yaml was built against libyaml
+    return getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def from_dict(kind: str, data: dict, lite=False):
+    if lite:
+        return lite_models.from_dict(kind, data)
+    return deserialize(data, kind)
+
+
+def from_dicts(datas: Iterable[dict], kind: Optional[str] = None, lite=False) -> List[Any]:
+    """
+    Batch version of from_dict.
+    If kind is None, it is taken from the kind field of each manifest (see KINDS).
+    """
+    if kind is not None:
+        return [from_dict(kind, data, lite=lite) for data in datas]
+    return [from_dict(manifest_kind(data), data, lite=lite) for data in datas]
+
+
+def manifest_kind(data: dict) -> str:
+    if data.get("kind") not in KINDS:
+        raise ValueError("unsupported manifest kind {!r}, expected one of {}".format(data.get("kind"), ", ".join(KINDS)))
+    return KINDS[data["kind"]]
+
+
+def from_yaml(kind: str, yml: str, lite=False):
+    return from_dict(kind, yaml.load(yml, Loader=get_safe_loader()), lite=lite)
+
+
+def from_yaml_all(yml: str, lite=False) -> List[Any]:
+    """
+    All manifests of a (multi-document) yaml stream, kinds are taken from the manifests
+    """
+    return from_dicts((data for data in yaml.load_all(yml, Loader=get_safe_loader()) if data is not None), lite=lite)
@@ -0,0 +1,218 @@
+"""
+Namespace-partitioned evaluation of the native model.
+
+A policy only selects pods of its own namespace, so the pod x pod relations split into
+namespace blocks: the block (A, A) only depends on the policies of A restricted to the pods of A,
+and is evaluated as an independent small model, optionally in worker processes.
+A block (A, B) with A != B is only non-empty through policies allowing peers outside their namespace
+(through a namespaceSelector), which is checked on the allowed pods themselves rather than on the peer syntax.
+Only the rows of those cross-namespace policies are evaluated over all pods.
+
+The result is a NativeInfo with the same relations as build_native, assembled from the blocks.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from bitarray import bitarray
+from bitarray.util import zeros
+from typing import *
+from .model import *
+from .native import NativeInfo, eval_traffic, iter_ones
+from .ipblocks import EndpointIndex
+
+# namespace block: local pod count, then the local bitarrays of eval_traffic
+BlockTask = Tuple[int, List[bitarray], List[bitarray], List[bitarray], bitarray, bool, bool]
+
+
+class NamespaceBlock:
+    def __init__(self, members: List[int]):
+        """
+        members: global indices of the pods of the namespace, sorted
+        """
+        self.members = members
+        # pods of a namespace are usually listed together, blocks are then copied by slices
+        self.contiguous = bool(members) and members[-1] - members[0] + 1 == len(members)
+
+    def __len__(self):
+        return len(self.members)
+
+    def gather(self, b: bitarray) -> bitarray:
+        """
+        Restrict a bitarray over all pods to the pods of the namespace
+        """
+        if self.contiguous:
+            return b[self.members[0]:self.members[-1] + 1]
+        return bitarray([b[i] for i in self.members])
+
+    def place(self, row: bitarray, local: bitarray):
+        """
+        Write a bitarray over the pods of the namespace into a row over all pods
+        """
+        if self.contiguous:
+            row[self.members[0]:self.members[-1] + 1] = local
+            return
+        for j in iter_ones(local):
+            row[self.members[j]] = True
+
+
+def eval_block(task: BlockTask) -> Tuple[List[bitarray], List[bitarray], List[bitarray]]:
+    return eval_traffic(*task)
+
+
+class PartitionState:
+    """
+    Results of a previous define_partitioned_model, for successive builds of a changing cluster (see watch.py):
+    blocks with equal inputs are not evaluated again,
+    and over the same pods only the rows of changed blocks or cross-namespace rows are assembled again
+    """
+
+    def __init__(self):
+        # namespace name -> (task, result)
+        self.blocks: Dict[str, Tuple[BlockTask, Any]] = {}
+        self.pods: Optional[List[PodAdapter]] = None
+        self.ingress_cross: Dict[int, bitarray] = {}
+        self.egress_cross: Dict[int, bitarray] = {}
+        self.ingress_traffic: List[bitarray] = []
+        self.egress_traffic: List[bitarray] = []
+        self.edge: List[bitarray] = []
+
+
+def define_partitioned_model(ni: NativeInfo, workers: Optional[int] = None,
+        state: Optional[PartitionState] = None):
+    """
+    Fill selected_by_any, ingress_traffic, egress_traffic and edge of ni from its policy facts,
+    same result as ni.define_model()
+    workers: number of processes evaluating the namespace blocks, in this process if None or 1
+    state: reused and updated, see PartitionState
+    """
+    n = ni.n_pod
+    for selected in ni.selected_by_pol:
+        ni.selected_by_any |= selected
+
+    blocks = [NamespaceBlock(list(iter_ones(pods))) for pods in ni.nam_pods]
+    # namespace index -> policies selecting some pod
+    nam_pols: List[List[int]] = [[] for _ in range(ni.n_nam)]
+    for pol, selected in enumerate(ni.selected_by_pol):
+        if selected.any():
+            nam_pols[ni.nam_map[ni.policies[pol].namespace]].append(pol)
+
+    tasks: List[BlockTask] = []
+    for nam, block in enumerate(blocks):
+        pols = nam_pols[nam]
+        tasks.append((len(block),
+            [block.gather(ni.selected_by_pol[pol]) for pol in pols],
+            [block.gather(ni.ingress_allow_by_pol[pol]) for pol in pols],
+            [block.gather(ni.egress_allow_by_pol[pol]) for pol in pols],
+            block.gather(ni.selected_by_any),
+            ni.check_self_traffic, ni.check_select_by_any))
+
+    results: List[Any] = [None] * len(tasks)
+    todo = []
+    for nam, task in enumerate(tasks):
+        name = ni.namespaces[nam].name
+        if state is not None and name in state.blocks and state.blocks[name][0] == task:
+            results[nam] = state.blocks[name][1]
+        else:
+            todo.append(nam)
+
+    if workers is not None and workers > 1 and len(todo) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            evaluated = list(executor.map(eval_block, [tasks[nam] for nam in todo]))
+    else:
+        evaluated = [eval_block(tasks[nam]) for nam in todo]
+    for nam, result in zip(todo, evaluated):
+        results[nam] = result
+
+    # cross-namespace rows, only for pods reached by a policy allowing peers outside its namespace
+    ingress_cross: Dict[int, bitarray] = {}
+    egress_cross: Dict[int, bitarray] = {}
+    for nam, pols in enumerate(nam_pols):
+        outside = ~ni.nam_pods[nam]
+        for pol in pols:
+            selected = ni.selected_by_pol[pol]
+            ingress_out = ni.ingress_allow_by_pol[pol] & outside
+            for src in iter_ones(ingress_out):
+                ingress_cross.setdefault(src, zeros(n))
+                ingress_cross[src] |= selected
+            egress_out = ni.egress_allow_by_pol[pol] & outside
+            if egress_out.any():
+                for sel in iter_ones(selected):
+                    egress_cross.setdefault(sel, zeros(n))
+                    egress_cross[sel] |= egress_out
+
+    if ni.check_select_by_any:
+        # pods selected by no policy accept from and send to every pod, also across namespaces
+        selected_by_none = ~ni.selected_by_any
+        for nam, block in enumerate(blocks):
+            outside = ~ni.nam_pods[nam]
+            for i in block.members:
+                ingress_cross.setdefault(i, zeros(n))
+                ingress_cross[i] |= selected_by_none & outside
+                if selected_by_none[i]:
+                    egress_cross[i] = outside
+
+    # pod -> (namespace index, index in the namespace)
+    position: List[Tuple[int, int]] = [(0, 0)] * n
+    for nam, block in enumerate(blocks):
+        for j, i in enumerate(block.members):
+            position[i] = (nam, j)
+
+    if state is not None and state.pods is not None and state.pods == ni.pods:
+        # same pods, assemble again only the rows that may differ from the previous ones
+        rows: Iterable[int] = {i for nam in todo for i in blocks[nam].members}
+        for cross, previous in ((ingress_cross, state.ingress_cross), (egress_cross, state.egress_cross)):
+            rows |= {i for i in cross.keys() | previous.keys() if cross.get(i) != previous.get(i)}
+        ni.ingress_traffic = list(state.ingress_traffic)
+        ni.egress_traffic = list(state.egress_traffic)
+        ni.edge = list(state.edge)
+    else:
+        rows = range(n)
+        ni.ingress_traffic = [None] * n
+        ni.egress_traffic = [None] * n
+        ni.edge = [None] * n
+
+    for i in rows:
+        nam, j = position[i]
+        block = blocks[nam]
+        ingress_traffic, egress_traffic, _ = results[nam]
+        ingress_row, egress_row = zeros(n), zeros(n)
+        block.place(ingress_row, ingress_traffic[j])
+        block.place(egress_row, egress_traffic[j])
+        if i in ingress_cross:
+            ingress_row |= ingress_cross[i]
+        if i in egress_cross:
+            egress_row |= egress_cross[i]
+        ni.ingress_traffic[i], ni.egress_traffic[i] = ingress_row, egress_row
+        # cheaper on the assembled rows than placing the block edges
+        ni.edge[i] = ingress_row & egress_row
+
+    if state is not None:
+        state.blocks = {ni.namespaces[nam].name: (tasks[nam], results[nam]) for nam in range(len(tasks))}
+        state.pods = ni.pods
+        state.ingress_cross, state.egress_cross = ingress_cross, egress_cross
+        state.ingress_traffic, state.egress_traffic, state.edge = ni.ingress_traffic, ni.egress_traffic, ni.edge
+
+
+def build_partitioned(pods: List[PodAdapter],
+        pols: List[PolicyAdapter],
+        nams: List[NamespaceAdapter],
+        check_self_ingress_traffic=True,
+        check_select_by_no_policy=False,
+        ground_default_pod=False,
+        endpoints: Optional[Union[EndpointIndex, List[Tuple[str, str]]]] = None,
+        workers: Optional[int] = None) -> NativeInfo:
+    """
+    Same as build_native, with the pod x pod relations evaluated by namespace blocks
+    """
+    if endpoints is not None and not isinstance(endpoints, EndpointIndex):
+        endpoints = EndpointIndex(endpoints)
+    ni = NativeInfo(pods, pols, nams,
+        check_self_ingress_traffic=check_self_ingress_traffic,
+        check_select_by_no_policy=check_select_by_no_policy,
+        ground_default_pod=ground_default_pod,
+        endpoints=endpoints)
+
+    ni.define_pod_facts()
+    ni.define_pol_facts()
+    define_partitioned_model(ni, workers=workers)
+    if endpoints is not None:
+        ni.define_external_facts()
+    return ni
@@ -0,0 +1,18 @@
+"""
+Partition of the port space by the port ranges of policy rules.
+
+The port space of each protocol is cut into the intervals no rule range splits,
+and intervals covered by the same set of rules share one class:
+every port of a class is allowed by exactly the same rules,
+so reachability is evaluated once per class instead of once per port.
+Rules matching all ports are in every class and are not part of the partition.
+
+The partition itself is kano's PortPartition, built here from rule ranges instead of policy ranges.
+"""
+from typing import *
+from kano.model import MIN_PORT, MAX_PORT, PortPartition, check_port
+
+DEFAULT_PROTOCOL = "TCP"
+
+# (protocol, first port, last port), inclusive
+PortRange = Tuple[str, int, int]
@@ -1,19 +1,37 @@
 """
 Post processing some z3 results to implement similar results as Kano.
 """
-from z3 import *
+from __future__ import annotations
+
 from typing import *
 from typing_extensions import *
 from bitarray import bitarray
+from bitarray.util import zeros
 from .constraint import GlobalInfo, get_answer
+from .native import NativeInfo, iter_ones
 from .utils import *
+from . import native
 from time import perf_counter
+from .lazy import lazy_import
+
+z3 = lazy_import("z3")
+
+
+def native_result(result, empty):
+    # wrap the results of the native evaluator like the z3 ones
+    if not result:
+        return z3.unsat, empty
+    return z3.sat, result
 
 
-def get_z3_bitarray(answer: BoolRef, n_container: int, is_ingress=True) -> List[bitarray]:
+def get_z3_bitarray(answer: z3.BoolRef, n_container: int, is_ingress=True) -> List[bitarray]:
     # assume the answer is Or(And(Var0, Var1, ...), ...)
+    try:
+        return get_z3_bit_matrix(answer, n_container, transpose=not is_ingress)
+    except ValueError:
+        pass
     all_answer = [bitarray('0' * n_container) for _ in range(n_container)]
-    pairs = parse_z3_result(answer)
+    pairs = parse_z3_result_generic(answer)
     if pairs is None:
         return all_answer
     for src, dst in pairs:
@@ -50,25 +68,111 @@ def all_isolated(matrix: List[bitarray]) -> List[int]:
     return all_isolated
 
 
-def get_all_pairs(gi: GlobalInfo, rel: str):
+def get_all_pairs(gi: GlobalInfo, rel: str, src: Optional[int] = None, dst: Optional[int] = None):
+    """
+    Query a binary pod relation (e.g. edge, path).
+    If src and/or dst is given, the query is bound to that pod and only the free side is returned,
+    so e.g. get_all_pairs(gi, "path", src=i) is the set of pods reachable from pod i.
+    """
+    if isinstance(gi, NativeInfo):
+        return native_result(native.get_all_pairs(gi, rel, src=src, dst=dst), set())
+    if rel == "path" and (src is None) != (dst is None):
+        return path_slice(gi, src, dst)
+
     rel = gi.get_relation_core(rel)
 
-    src = gi.declare_var('src_pair', gi.pod_sort)
-    dst = gi.declare_var('dst_pair', gi.pod_sort)
+    src_arg = gi.pod_value(src) if src is not None else gi.declare_var('src_pair', gi.pod_sort)
+    dst_arg = gi.pod_value(dst) if dst is not None else gi.declare_var('dst_pair', gi.pod_sort)
 
-    fact = [rel(src, dst)]
+    fact = [rel(src_arg, dst_arg)]
     sat, answer = get_answer(gi.fp, fact)
     if sat == z3.unsat:
         return sat, set()
-    
+    # fully bound query, the answer is just True
+    if src is not None and dst is not None:
+        return sat, {(src, dst)}
+
     return sat, parse_z3_result(answer)    
 
 
+def path_slice(gi: GlobalInfo, src: Optional[int] = None, dst: Optional[int] = None):
+    """
+    Pods reachable from src (or reaching dst) through one or more edges.
+    z3 evaluates the whole program for a bound path query (magic sets are skipped, the rules have negation),
+    so only edge is queried and its rows are closed over from the bound pod, as NativeInfo.reachable_from/to do.
+    """
+    edge = gi.get_relation_core("edge")
+    sat, answer = get_answer(gi.fp, [edge(gi.declare_var('src_pair', gi.pod_sort), gi.declare_var('dst_pair', gi.pod_sort))])
+    if sat == z3.unsat:
+        return sat, set()
+    # rows[i]: the pods i has an edge to, or those having an edge to i if dst is bound
+    rows = get_z3_bitarray(answer, len(gi.pods), is_ingress=dst is None)
+    reached = rows[src if src is not None else dst].copy()
+    frontier = reached.copy()
+    while frontier.any():
+        nxt = zeros(len(gi.pods))
+        for i in iter_ones(frontier):
+            nxt |= rows[i]
+        frontier = nxt & ~reached
+        reached |= nxt
+    if not reached.any():
+        return z3.unsat, set()
+    return z3.sat, set(iter_ones(reached))
+
+
 def get_all_edges(gi: GlobalInfo):
     return get_all_pairs(gi, "edge") 
 
 
+def get_all_paths(gi: GlobalInfo):
+    return get_all_pairs(gi, "path")
+
+
+def reachable_from(gi: GlobalInfo, idx: int):
+    """
+    All pods reachable from pod idx through one or more edges
+    """
+    return get_all_pairs(gi, "path", src=idx)
+
+
+def reachable_to(gi: GlobalInfo, idx: int):
+    """
+    All pods which can reach pod idx through one or more edges
+    """
+    return get_all_pairs(gi, "path", dst=idx)
+
+
+def get_port_edges(gi: GlobalInfo, protocol: str, port: int):
+    """
+    Edges for the traffic to destination port `port`, rule ports are taken into account
+    """
+    if not isinstance(gi, NativeInfo):
+        raise ValueError("port-aware reachability needs build(..., mode=\"native\")")
+    return native_result(native.get_port_edges(gi, protocol, port), set())
+
+
+def allowed_ports(gi: GlobalInfo, src: int, dst: int):
+    """
+    (protocol, first, last) port ranges on which pod src can connect to pod dst
+    """
+    if not isinstance(gi, NativeInfo):
+        raise ValueError("port-aware reachability needs build(..., mode=\"native\")")
+    return native_result(native.allowed_ports(gi, src, dst), [])
+
+
+def get_external_pairs(gi: GlobalInfo, egress=True):
+    """
+    (pod, endpoint) pairs of egress traffic to external endpoints, (endpoint, pod) pairs of ingress traffic if not egress
+    """
+    if not isinstance(gi, NativeInfo):
+        raise ValueError("external endpoints need build(..., mode=\"native\")")
+    return native_result(native.get_external_pairs(gi, egress=egress), set())
+
+
 def all_reach_isolate(gi: GlobalInfo):
+    if isinstance(gi, NativeInfo):
+        return native.all_reach_isolate(gi)
+
     rel = gi.get_relation_core("edge")
 
     src = gi.declare_var('src_edge', gi.pod_sort)
@@ -81,15 +185,18 @@ def all_reach_isolate(gi: GlobalInfo):
 
 
 def all_reachable_native(gi: GlobalInfo):
+    if isinstance(gi, NativeInfo):
+        return native_result(native.all_reachable(gi), set())
+
     is_pod = gi.get_relation_core("is_pod")
     disconnect = gi.get_relation_core("disconnect")
 
     src = gi.declare_var('src_edge', gi.pod_sort)
     dst = gi.declare_var('dst_edge', gi.pod_sort)
 
-    has_unreachable = Function('has_unreachable', gi.pod_sort, BoolSort())
+    has_unreachable = z3.Function('has_unreachable', gi.pod_sort, z3.BoolSort())
     gi.register_relation("has_unreachable", has_unreachable, is_core=True)
-    all_reachable = Function('all_reachable', gi.pod_sort, BoolSort())
+    all_reachable = z3.Function('all_reachable', gi.pod_sort, z3.BoolSort())
     gi.register_relation("all_reachable", all_reachable, is_core=True)
 
     gi.add_rule(has_unreachable(dst), [
@@ -99,7 +206,7 @@ def all_reachable_native(gi: GlobalInfo):
 
     gi.add_rule(all_reachable(dst), [
         is_pod(dst),
-        Not(has_unreachable(dst))
+        z3.Not(has_unreachable(dst))
     ])
 
     fact = [all_reachable(dst)]
@@ -111,15 +218,18 @@ def all_reachable_native(gi: GlobalInfo):
 
 
 def all_isolated_native(gi: GlobalInfo):
+    if isinstance(gi, NativeInfo):
+        return native_result(native.all_isolated(gi), set())
+
     edge = gi.get_relation_core("edge")
     is_pod = gi.get_relation_core("is_pod")
 
     src = gi.declare_var('src_edge', gi.pod_sort)
     dst = gi.declare_var('dst_edge', gi.pod_sort)
 
-    has_reachable = Function('has_reachable', gi.pod_sort, BoolSort())
+    has_reachable = z3.Function('has_reachable', gi.pod_sort, z3.BoolSort())
     gi.register_relation("has_reachable", has_reachable, is_core=True)
-    all_isolated = Function('all_isolated', gi.pod_sort, BoolSort())
+    all_isolated = z3.Function('all_isolated', gi.pod_sort, z3.BoolSort())
     gi.register_relation("all_isolated", all_isolated, is_core=True)
 
     gi.add_rule(has_reachable(dst), [
@@ -129,7 +239,7 @@ def all_isolated_native(gi: GlobalInfo):
 
     gi.add_rule(all_isolated(dst), [
         is_pod(dst),
-        Not(has_reachable(dst))
+        z3.Not(has_reachable(dst))
     ])
 
     fact = [all_isolated(dst)]
@@ -146,11 +256,27 @@ def user_crosscheck(gi: GlobalInfo, l: str):
     User is specified by the label. 
     Kano: All constainers should have that label.
     """
+    if isinstance(gi, NativeInfo):
+        return native_result(native.user_crosscheck(gi, l), [])
+
+    sat, answer = user_crosscheck_answer(gi, l)
+    if sat == z3.unsat:
+        return sat, []
+    return sat, parse_z3_result(answer)
+
+
+def user_crosscheck_answer(gi: GlobalInfo, l: str):
+    """
+    The z3 answer of user_crosscheck, unparsed
+    """
     label = gi.get_relation(l)
+    # no pod has this label
+    if label is None:
+        return z3.unsat, None
     is_pod = gi.get_relation_core("is_pod")
     edge = gi.get_relation_core("edge")
 
-    user_violation = Function('user_violation_{}'.format(label), gi.pod_sort, BoolSort())
+    user_violation = z3.Function('user_violation_{}'.format(label), gi.pod_sort, z3.BoolSort())
     gi.register_relation("user_violation_{}".format(label), user_violation, is_core=True)
 
     sel = gi.declare_var('sel_{}'.format(label), gi.pod_sort)
@@ -168,11 +294,7 @@ def user_crosscheck(gi: GlobalInfo, l: str):
     ])
 
     fact = [user_violation(sel)]
-    sat, answer = get_answer(gi.fp, fact)
-    if sat == z3.unsat:
-        return sat, []
-    
-    return sat, parse_z3_result(answer)
+    return get_answer(gi.fp, fact)
 
 
 def system_isolation(gi: GlobalInfo, idx: int):
@@ -181,18 +303,21 @@ def system_isolation(gi: GlobalInfo, idx: int):
     System pod is specified by idx
     Kano: only consider egress edge, not path
     """
+    if isinstance(gi, NativeInfo):
+        return native_result(native.system_isolation(gi, idx), [])
+
     is_pod = gi.get_relation_core("is_pod")
     edge = gi.get_relation_core("edge")
     pod_idx = gi.pod_value(idx)
 
-    system_isolation = Function('system_isolation_{}'.format(idx), gi.pod_sort, BoolSort())
+    system_isolation = z3.Function('system_isolation_{}'.format(idx), gi.pod_sort, z3.BoolSort())
     gi.register_relation("system_isolation_{}".format(idx), system_isolation, is_core=True)
 
     sel = gi.declare_var('system_iso_sel_{}'.format(idx), gi.pod_sort)
 
     gi.add_rule(system_isolation(sel), [
         is_pod(sel),
-        Not(edge(pod_idx, sel))
+        z3.Not(edge(pod_idx, sel))
     ])
 
     fact = [system_isolation(sel)]
@@ -203,63 +328,45 @@ def system_isolation(gi: GlobalInfo, idx: int):
     return sat, parse_z3_result(answer)
 
 
-def policy_shadow(gi: GlobalInfo):
+def get_pol_bitarrays(gi: GlobalInfo, rel: str) -> List[bitarray]:
     """
-    The connections built by a policy are completely covered by another policy, then this policy may be redundant
-    NOTE: this is a general version, not Kano's per pod version
+    Query a pod x policy relation (e.g. selected_by_pol) as pod bitarrays indexed by policy
     """
-    is_pod = gi.get_relation_core("is_pod")
-    is_pol = gi.get_relation_core("is_pol")
-    selected_by_pol = gi.get_relation_core("selected_by_pol")
-    ingress_allow_by_pol = gi.get_relation_core("ingress_allow_by_pol")
-    egress_allow_by_pol = gi.get_relation_core("egress_allow_by_pol")
+    if isinstance(gi, NativeInfo):
+        return getattr(gi, rel)
 
-    policy_shadow = Function('policy_shadow', gi.pol_sort, gi.pol_sort, BoolSort())
-    gi.register_relation("policy_shadow", policy_shadow, is_core=True)
-    policy_unshadow = Function('policy_unshadow', gi.pol_sort, gi.pol_sort, BoolSort())
-    gi.register_relation("policy_unshadow", policy_unshadow, is_core=True)
+    func = gi.get_relation_core(rel)
+    pod = gi.declare_var('pol_bitarray_pod', gi.pod_sort)
+    pol = gi.declare_var('pol_bitarray_pol', gi.pol_sort)
+    rows = [bitarray("0" * len(gi.pods)) for _ in gi.policies]
+    sat, answer = get_answer(gi.fp, [func(pod, pol)])
+    if sat == z3.sat:
+        for i, p in parse_z3_result(answer):
+            rows[p][i] = True
+    return rows
 
 
-    p0 = gi.declare_var('policy_shadow_inner', gi.pol_sort)
-    p1 = gi.declare_var('policy_shadow_outer', gi.pol_sort)
-
-    select = gi.declare_var('policy_shadow_select', gi.pod_sort)
+def policy_shadow(gi: GlobalInfo):
+    """
+    The connections built by a policy are completely covered by another policy, then this policy may be redundant
+    NOTE: this is a general version, not Kano's per pod version
+    Both engines only read the selected/allowed pods of the policies, see kano.algorithm.covered_pairs
+    """
+    return native_result(native.covered_pairs(policy_sets(gi)), [])
 
-    gi.add_rule(policy_unshadow(p0, p1), [
-        is_pol(p0),
-        is_pol(p1),
-        is_pod(select),
-        selected_by_pol(select, p0),
-        Not(selected_by_pol(select, p1))
-    ])
-    gi.add_rule(policy_unshadow(p0, p1), [
-        is_pol(p0),
-        is_pol(p1),
-        is_pod(select),
-        ingress_allow_by_pol(select, p0),
-        Not(ingress_allow_by_pol(select, p1))
-    ])
-    gi.add_rule(policy_unshadow(p0, p1), [
-        is_pol(p0),
-        is_pol(p1),
-        is_pod(select),
-        egress_allow_by_pol(select, p0),
-        Not(egress_allow_by_pol(select, p1))
-    ])
 
-    gi.add_rule(policy_shadow(p0, p1), [
-        is_pol(p0),
-        is_pol(p1),
-        p0 != p1,
-        Not(policy_unshadow(p0, p1))        
-    ])
+def policy_sets(gi: GlobalInfo) -> List[bitarray]:
+    """
+    The selected, ingress allowed and egress allowed pods of each policy end to end, see native.policy_sets
+    """
+    if isinstance(gi, NativeInfo):
+        return native.policy_sets(gi)
 
-    fact = [policy_shadow(p0, p1)]
-    sat, answer = get_answer(gi.fp, fact)
-    if sat == z3.unsat:
-        return sat, []
-    
-    return sat, parse_z3_result(answer)
+    sets = [bitarray() for _ in gi.policies]
+    for rel in ("selected_by_pol", "ingress_allow_by_pol", "egress_allow_by_pol"):
+        for pol, pods in enumerate(get_pol_bitarrays(gi, rel)):
+            sets[pol] += pods
+    return sets
 
 
 def policy_conflict(gi: GlobalInfo):
@@ -267,15 +374,18 @@ def policy_conflict(gi: GlobalInfo):
     The connections built by a policy are totally contradict the connections built by another    
     NOTE: this is a general version, not Kano's per pod version
     """
+    if isinstance(gi, NativeInfo):
+        return native_result(native.policy_conflict(gi), [])
+
     is_pod = gi.get_relation_core("is_pod")
     is_pol = gi.get_relation_core("is_pol")
     selected_by_pol = gi.get_relation_core("selected_by_pol")
     ingress_allow_by_pol = gi.get_relation_core("ingress_allow_by_pol")
     egress_allow_by_pol = gi.get_relation_core("egress_allow_by_pol")
 
-    policy_conflict = Function('policy_conflict', gi.pol_sort, gi.pol_sort, BoolSort())
+    policy_conflict = z3.Function('policy_conflict', gi.pol_sort, gi.pol_sort, z3.BoolSort())
     gi.register_relation("policy_conflict", policy_conflict, is_core=True)
-    policy_inconflict = Function('policy_inconflict', gi.pol_sort, gi.pol_sort, BoolSort())
+    policy_inconflict = z3.Function('policy_inconflict', gi.pol_sort, gi.pol_sort, z3.BoolSort())
     gi.register_relation("policy_inconflict", policy_inconflict, is_core=True)
 
 
@@ -310,7 +420,7 @@ def policy_conflict(gi: GlobalInfo):
         is_pol(p0),
         is_pol(p1),
         p0 != p1,
-        Not(policy_inconflict(p0, p1))        
+        z3.Not(policy_inconflict(p0, p1))        
     ])
 
     fact = [policy_conflict(p0, p1)]
@@ -0,0 +1,295 @@
+"""
+Approximate verification of clusters too large for the edge matrix, by sampling pods.
+
+Only the pod and policy facts of the native model are evaluated (linear in the pods),
+then single rows and columns of edge are assembled from the per-policy bitarrays (see native.eval_traffic):
+    row(src): ingress_traffic[src] = OR of the selected pods of the policies allowing src as an ingress source
+              egress_traffic[src] = OR of the egress allowed pods of the policies selecting src
+    column(dst): the same with the roles of the selected and allowed pods swapped
+Pods are sampled without replacement in rounds, stratified by namespace (or a label) with proportional allocation.
+Each sampled pod gives its row (as a source) and its column (as a destination), from which
+    the fraction of connected pairs (pods with themselves left out), a stratified mean of row counts,
+    the number of isolated pods (empty column, see native.all_isolated),
+    the number of cross-user pods (see native.user_crosscheck)
+are estimated with confidence intervals, until the time budget is spent or the intervals are narrow enough.
+Sampling all pods gives the exact values.
+"""
+import random
+
+from dataclasses import dataclass
+from math import atan, ceil, cos, exp, lgamma, pi, sin, sqrt, tan
+from statistics import NormalDist
+from time import perf_counter
+from bitarray import bitarray
+from bitarray.util import zeros
+from typing import *
+from .model import *
+from .exposure import pod_groups
+from .native import NativeInfo
+
+
+@dataclass
+class Estimate:
+    value: float
+    low: float
+    high: float
+
+    @property
+    def half_width(self) -> float:
+        return (self.high - self.low) / 2
+
+    def __str__(self):
+        return "{:.4g} [{:.4g}, {:.4g}]".format(self.value, self.low, self.high)
+
+
+@dataclass
+class SampledReport:
+    # fraction of the ordered pairs of distinct pods that are connected
+    reachable_fraction: Estimate
+    # number of pods reached by no pod
+    isolated: Estimate
+    # number of pods reached from a pod of another user, None without a user label
+    cross_user: Optional[Estimate]
+    n_pod: int
+    sampled: int
+    seconds: float
+
+    @property
+    def exact(self) -> bool:
+        return self.sampled == self.n_pod
+
+    def report(self) -> str:
+        lines = ["{} of {} pods sampled in {:.3f}s{}".format(self.sampled, self.n_pod, self.seconds,
+            " (exact)" if self.exact else "")]
+        lines.append("reachable pairs: {}".format(self.reachable_fraction))
+        lines.append("isolated pods: {}".format(self.isolated))
+        if self.cross_user is not None:
+            lines.append("cross-user pods: {}".format(self.cross_user))
+        return "\n".join(lines)
+
+
+def build_facts(pods: List[PodAdapter], pols: List[PolicyAdapter], nams: List[NamespaceAdapter],
+        check_self_ingress_traffic=True,
+        check_select_by_no_policy=False) -> NativeInfo:
+    """
+    A native model with the pod and policy facts only, edge is left empty
+    """
+    ni = NativeInfo(adapt(pods, PodAdapter), adapt(pols, PolicyAdapter), adapt(nams, NamespaceAdapter),
+        check_self_ingress_traffic=check_self_ingress_traffic,
+        check_select_by_no_policy=check_select_by_no_policy)
+    ni.define_pod_facts()
+    ni.define_pol_facts()
+    for selected in ni.selected_by_pol:
+        ni.selected_by_any |= selected
+    return ni
+
+
+class PairSampler:
+    def __init__(self, ni: NativeInfo):
+        """
+        ni: a native model with its policy facts, e.g. build_facts or build
+        """
+        self.ni = ni
+        self.n = ni.n_pod
+        self.selected_by_none = ~ni.selected_by_any
+
+    def row(self, src: int) -> bitarray:
+        ni = self.ni
+        ingress = zeros(self.n)
+        egress = zeros(self.n)
+        for pol, selected in enumerate(ni.selected_by_pol):
+            if ni.ingress_allow_by_pol[pol][src]:
+                ingress |= selected
+            if selected[src]:
+                egress |= ni.egress_allow_by_pol[pol]
+        if ni.check_self_traffic:
+            ingress[src] = True
+        if ni.check_select_by_any:
+            ingress |= self.selected_by_none
+            if self.selected_by_none[src]:
+                egress.setall(True)
+        return ingress & egress
+
+    def column(self, dst: int) -> bitarray:
+        ni = self.ni
+        ingress = zeros(self.n)
+        egress = zeros(self.n)
+        for pol, selected in enumerate(ni.selected_by_pol):
+            if selected[dst]:
+                ingress |= ni.ingress_allow_by_pol[pol]
+            if ni.egress_allow_by_pol[pol][dst]:
+                egress |= selected
+        if ni.check_self_traffic:
+            ingress[dst] = True
+        if ni.check_select_by_any:
+            if self.selected_by_none[dst]:
+                ingress.setall(True)
+            egress |= self.selected_by_none
+        return ingress & egress
+
+
+def mean_estimate(samples: List[List[float]], sizes: List[int], confidence: float) -> Estimate:
+    """
+    Stratified mean of values in [0, 1], samples and sizes by stratum.
+    The normal interval undercovers on the few, skewed values of the first rounds (mostly zeros, the rows
+    of isolated pods), down to a zero width when no sampled value differs. So the variance of each stratum
+    is taken with one pseudo-value at each bound (the Agresti-Coull idea for proportions, extended to values in [0, 1])
+    and the quantile is Student's, with the Satterthwaite degrees of freedom of the strata variances (rounded down).
+    """
+    n = sum(sizes)
+    value, var = 0.0, 0.0
+    # sum of (variance term) ** 2 / degrees of freedom of each stratum
+    dof_terms = 0.0
+    for values, size in zip(samples, sizes):
+        if not values:
+            continue
+        weight = size / n
+        value += weight * sum(values) / len(values)
+        term = weight ** 2 * (1 - len(values) / size) * variance(values + [0.0, 1.0]) / len(values)
+        var += term
+        dof_terms += term ** 2 / max(1, len(values) - 1)
+    if var == 0:
+        return Estimate(value, value, value)
+    half = t_quantile((1 + confidence) / 2, max(1, int(var ** 2 / dof_terms))) * sqrt(var)
+    return Estimate(value, max(0.0, value - half), min(1.0, value + half))
+
+
+def t_quantile(p: float, dof: int) -> float:
+    """
+    Quantile of the Student t distribution with dof >= 1 degrees of freedom:
+    Cornish-Fisher expansion around the normal quantile, refined by Newton steps on t_cdf
+    """
+    if dof == 1:
+        return tan(pi * (p - 0.5))
+    z = NormalDist().inv_cdf(p)
+    z2 = z * z
+    t = z + (z2 + 1) * z / (4 * dof) \
+        + ((5 * z2 + 16) * z2 + 3) * z / (96 * dof ** 2) \
+        + (((3 * z2 + 19) * z2 + 17) * z2 - 15) * z / (384 * dof ** 3)
+    norm = exp(lgamma((dof + 1) / 2) - lgamma(dof / 2)) / sqrt(dof * pi)
+    for _ in range(50):
+        step = (t_cdf(t, dof) - p) / (norm * (1 + t * t / dof) ** (-(dof + 1) / 2))
+        t -= step
+        if abs(step) <= 1e-12 * max(1.0, abs(t)):
+            break
+    return t
+
+
+def t_cdf(t: float, dof: int) -> float:
+    """
+    Student t distribution function for an integer dof, by the finite series in cos(theta) ** 2 of
+    Abramowitz and Stegun 26.7.3-4, theta = atan(t / sqrt(dof))
+    """
+    theta = atan(t / sqrt(dof))
+    c2 = cos(theta) ** 2
+    series, term = 1.0, 1.0
+    if dof % 2:
+        for k in range(1, (dof - 1) // 2):
+            term *= 2 * k / (2 * k + 1) * c2
+            series += term
+        central = 2 / pi * (theta + (sin(theta) * cos(theta) * series if dof > 1 else 0.0))
+    else:
+        for k in range(1, dof // 2):
+            term *= (2 * k - 1) / (2 * k) * c2
+            series += term
+        central = sin(theta) * series
+    return (1 + central) / 2
+
+
+def variance(values: List[float]) -> float:
+    if len(values) < 2:
+        return 0.0
+    mean = sum(values) / len(values)
+    return sum((x - mean) ** 2 for x in values) / (len(values) - 1)
+
+
+def count_estimate(hits: List[int], taken: List[int], sizes: List[int], z: float) -> Estimate:
+    """
+    Number of pods with some property from the hits among the pods taken of each stratum.
+    Wilson score interval on the stratified proportion, the sample being close to self-weighting,
+    with the finite population correction (exact once all pods are taken).
+    """
+    n, m = sum(sizes), sum(taken)
+    count = sum(size * h / t for h, t, size in zip(hits, taken, sizes) if t)
+    p = count / n
+    z2 = z * z * (1 - m / n)
+    center = (p + z2 / (2 * m)) / (1 + z2 / m)
+    half = z * sqrt(1 - m / n) * sqrt(p * (1 - p) / m + z2 / (4 * m * m)) / (1 + z2 / m)
+    return Estimate(count, max(0.0, min(p, center - half)) * n, min(1.0, max(p, center + half)) * n)
+
+
+def estimate(ni: NativeInfo, user_label: Optional[str] = None, strata: Optional[str] = None,
+        budget=1.0, tolerance: Optional[float] = None, confidence=0.95,
+        batch=64, seed=0) -> SampledReport:
+    """
+    ni: a native model with its policy facts, see build_facts
+    user_label: label of the users for the cross-user estimate
+    strata: label grouping the pods (see exposure.pod_groups), the namespace if None
+    budget: seconds of sampling, the first round is always done
+    tolerance: stop once the half widths of all intervals are below it, as fractions of the pairs/pods
+    batch: pods added per round, allocated proportionally to the strata (at least 2 per stratum)
+    """
+    start = perf_counter()
+    n = ni.n_pod
+    if n == 0:
+        empty = Estimate(0.0, 0.0, 0.0)
+        return SampledReport(empty, empty, empty if user_label is not None else None, 0, 0, perf_counter() - start)
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    sampler = PairSampler(ni)
+    rnd = random.Random(seed)
+
+    members: Dict[str, List[int]] = {}
+    for i, group in enumerate(pod_groups(ni.pods, strata)):
+        members.setdefault(group, []).append(i)
+    order = [members[group] for group in sorted(members)]
+    for pods in order:
+        rnd.shuffle(pods)
+    sizes = [len(pods) for pods in order]
+
+    labeled = ni.pod_labels_exists.get(user_label) if user_label is not None else None
+    fractions: List[List[float]] = [[] for _ in order]
+    isolated = [0] * len(order)
+    cross_user = [0] * len(order)
+    taken = [0] * len(order)
+
+    report = None
+    target = 0
+    while True:
+        target = min(n, target + batch)
+        for h, pods in enumerate(order):
+            wanted = min(sizes[h], max(2, ceil(target * sizes[h] / n)))
+            for i in pods[taken[h]:wanted]:
+                row = sampler.row(i)
+                fractions[h].append((row.count() - row[i]) / (n - 1) if n > 1 else 0.0)
+                column = sampler.column(i)
+                if not column.any():
+                    isolated[h] += 1
+                if labeled is not None and labeled[i]:
+                    same_user = ni.pod_labels[user_label][ni.pods[i].labels[user_label]]
+                    if (column & labeled & ~same_user).any():
+                        cross_user[h] += 1
+            taken[h] = max(taken[h], wanted)
+
+        report = SampledReport(
+            mean_estimate(fractions, sizes, confidence),
+            count_estimate(isolated, taken, sizes, z),
+            count_estimate(cross_user, taken, sizes, z) if user_label is not None else None,
+            n, sum(taken), perf_counter() - start)
+        if report.exact or perf_counter() - start >= budget:
+            break
+        if tolerance is not None and report.reachable_fraction.half_width <= tolerance and \
+                all(e.half_width <= tolerance * n for e in (report.isolated, report.cross_user) if e is not None):
+            break
+    return report
+
+
+def estimate_cluster(pods: List[PodAdapter], pols: List[PolicyAdapter], nams: List[NamespaceAdapter],
+        check_self_ingress_traffic=True,
+        check_select_by_no_policy=False, **kwargs) -> SampledReport:
+    """
+    estimate on the facts of a cluster, kwargs as for estimate
+    """
+    ni = build_facts(pods, pols, nams,
+        check_self_ingress_traffic=check_self_ingress_traffic,
+        check_select_by_no_policy=check_select_by_no_policy)
+    return estimate(ni, **kwargs)
@@ -0,0 +1,273 @@
+"""
+Streaming output of large results, as NDJSON or as a compact binary record stream.
+
+Results are produced as chunks of index arrays (one array('q') per field, at most chunk_size records),
+straight from the bitarray rows of a native model (or of a kano matrix, see row_chunks)
+or from the z3 answer (see utils.iter_z3_answer_chunks), without building Python sets of tuples.
+Names are resolved through an IndexTable built once per pod/policy list.
+Memory stays bounded by the model, the chunk and the tables.
+
+Binary format, little endian:
+    b"KSVS", version u8, number of fields u8, index width u8 (4 or 8), number of tables u8
+    each table: u32 number of names, then each name as u32 length and UTF-8 bytes
+    each field: u8 table index, 255 for none
+    blocks: u32 number of records n, then each field as n indices, until a block with n = 0
+"""
+from __future__ import annotations
+
+import json
+import struct
+import sys
+from array import array
+from itertools import repeat
+from bitarray import bitarray
+from typing import *
+from .model import *
+from .constraint import GlobalInfo, get_answer
+from .native import NativeInfo, iter_ones
+from .utils import iter_z3_answer_chunks, parse_z3_result_generic
+from . import native
+from . import postprocess
+from .lazy import lazy_import
+
+z3 = lazy_import("z3")
+
+CHUNK_SIZE = 1 << 16
+MAGIC = b"KSVS"
+VERSION = 1
+NO_TABLE = 255
+TYPECODES = {4: 'i', 8: 'q'}
+
+Chunk = Tuple[array, ...]
+
+
+class IndexTable:
+    def __init__(self, names: List[str]):
+        self.names = names
+        self._quoted: Optional[List[str]] = None
+
+    @classmethod
+    def of_pods(cls, pods: List[PodAdapter]) -> IndexTable:
+        return cls(["{}/{}".format(pod.namespace, pod.name) for pod in pods])
+
+    @classmethod
+    def of_policies(cls, policies: List[PolicyAdapter]) -> IndexTable:
+        return cls(["{}/{}".format(pol.namespace, pol.metadata.name) for pol in policies])
+
+    def __len__(self):
+        return len(self.names)
+
+    def quoted(self) -> List[str]:
+        # JSON strings of the names, escaped once
+        if self._quoted is None:
+            self._quoted = [json.dumps(name) for name in self.names]
+        return self._quoted
+
+
+def chunked(records: Iterable[Tuple[int, ...]], n_field: int, chunk_size=CHUNK_SIZE) -> Iterator[Chunk]:
+    columns = tuple(array('q') for _ in range(n_field))
+    for record in records:
+        for column, value in zip(columns, record):
+            column.append(value)
+        if len(columns[0]) >= chunk_size:
+            yield columns
+            columns = tuple(array('q') for _ in range(n_field))
+    if len(columns[0]):
+        yield columns
+
+
+def row_chunks(rows: Iterable[bitarray], chunk_size=CHUNK_SIZE) -> Iterator[Chunk]:
+    """
+    (row index, column index) of the ones of bitarray rows, e.g. NativeInfo.edge or ReachabilityMatrix.matrix
+    """
+    src, dst = array('q'), array('q')
+    for i, row in enumerate(rows):
+        ones = array('q', iter_ones(row))
+        src.extend(repeat(i, len(ones)))
+        dst.extend(ones)
+        if len(src) >= chunk_size:
+            yield src, dst
+            src, dst = array('q'), array('q')
+    if len(src):
+        yield src, dst
+
+
+def bit_chunks(bits: bitarray, chunk_size=CHUNK_SIZE) -> Iterator[Chunk]:
+    return chunked(((i,) for i in iter_ones(bits)), 1, chunk_size)
+
+
+def answer_chunks(answer, n_field: int, chunk_size=CHUNK_SIZE) -> Iterator[Chunk]:
+    """
+    Tuples of a z3 answer, see utils.iter_z3_answer_chunks, other answer shapes are parsed first
+    """
+    try:
+        chunks = iter_z3_answer_chunks(answer, chunk_size)
+        first = next(chunks, None)
+    except ValueError:
+        result = parse_z3_result_generic(answer) or set()
+        yield from chunked(sorted(t if isinstance(t, tuple) else (t,) for t in result), n_field, chunk_size)
+        return
+    if first is not None:
+        yield first
+        yield from chunks
+
+
+def relation_chunks(gi: Union[GlobalInfo, NativeInfo], rel: str, chunk_size=CHUNK_SIZE) -> Iterator[Chunk]:
+    """
+    (src, dst) of a pod x pod relation (e.g. edge, path, disconnect), for any build mode
+    """
+    if isinstance(gi, NativeInfo):
+        rows = (~row for row in gi.edge) if rel == "disconnect" else gi.get_rows(rel)
+        yield from row_chunks(rows, chunk_size)
+        return
+
+    func = gi.get_relation_core(rel)
+    src = gi.declare_var('stream_src', gi.pod_sort)
+    dst = gi.declare_var('stream_dst', gi.pod_sort)
+    sat, answer = get_answer(gi.fp, [func(src, dst)])
+    if sat == z3.sat:
+        yield from answer_chunks(answer, 2, chunk_size)
+
+
+def crosscheck_chunks(gi: Union[GlobalInfo, NativeInfo], l: str, chunk_size=CHUNK_SIZE) -> Iterator[Chunk]:
+    """
+    Pods of postprocess.user_crosscheck
+    """
+    if isinstance(gi, NativeInfo):
+        yield from bit_chunks(native.user_crosscheck_bits(gi, l), chunk_size)
+        return
+
+    sat, answer = postprocess.user_crosscheck_answer(gi, l)
+    if sat == z3.sat:
+        yield from answer_chunks(answer, 1, chunk_size)
+
+
+def shadow_chunks(gi: Union[GlobalInfo, NativeInfo], chunk_size=CHUNK_SIZE) -> Iterator[Chunk]:
+    """
+    Policy pairs of postprocess.policy_shadow
+    """
+    return chunked(native.iter_covered_pairs(postprocess.policy_sets(gi)), 2, chunk_size)
+
+
+def write_ndjson(out: TextIO, chunks: Iterable[Chunk], fields: Sequence[str],
+        tables: Optional[Sequence[Optional[IndexTable]]] = None) -> int:
+    """
+    One JSON object per record, e.g. {"src": "default/a", "dst": "default/b"},
+    the indices of a field are replaced by the names of its table (if any). Return the number of records.
+    """
+    if tables is None:
+        tables = [None] * len(fields)
+    template = "{" + ",".join('"{}":%s'.format(field) for field in fields) + "}\n"
+    names = [table.quoted() if table is not None else None for table in tables]
+    n_record = 0
+    for chunk in chunks:
+        columns = [column if quoted is None else [quoted[i] for i in column] for column, quoted in zip(chunk, names)]
+        out.write("".join(template % record for record in zip(*columns)))
+        n_record += len(chunk[0])
+    return n_record
+
+
+def write_binary(out: BinaryIO, chunks: Iterable[Chunk], n_field: int,
+        tables: Optional[Sequence[Optional[IndexTable]]] = None, width=4) -> int:
+    """
+    The binary format of the module docstring, tables shared by several fields are written once.
+    width: bytes per index, 4 or 8. Return the number of records.
+    """
+    if tables is None:
+        tables = [None] * n_field
+    if width not in TYPECODES:
+        raise ValueError("unsupported index width {}".format(width))
+    distinct: List[IndexTable] = []
+    for table in tables:
+        if table is not None and all(table is not t for t in distinct):
+            distinct.append(table)
+
+    out.write(MAGIC + struct.pack("<BBBB", VERSION, n_field, width, len(distinct)))
+    for table in distinct:
+        out.write(struct.pack("<I", len(table)))
+        for name in table.names:
+            data = name.encode("utf-8")
+            out.write(struct.pack("<I", len(data)) + data)
+    for table in tables:
+        index = NO_TABLE if table is None else next(k for k, t in enumerate(distinct) if t is table)
+        out.write(struct.pack("<B", index))
+
+    n_record = 0
+    for chunk in chunks:
+        n = len(chunk[0])
+        if n == 0:
+            continue
+        out.write(struct.pack("<I", n))
+        for column in chunk:
+            out.write(index_bytes(column, width))
+        n_record += n
+    out.write(struct.pack("<I", 0))
+    return n_record
+
+
+def index_bytes(column: array, width: int) -> bytes:
+    if sys.byteorder == "little" and column.typecode == 'q':
+        if width == 8:
+            return column.tobytes()
+        if max(column) >= 1 << 31 or min(column) < 0:
+            raise OverflowError("index does not fit in {} bytes".format(width))
+        # the low halves of the little endian 8 byte indices, without a Python loop
+        return memoryview(column).cast('B').cast('i')[0::2].tobytes()
+    column = array(TYPECODES[width], column)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column.tobytes()
+
+
+def read_binary(inp: BinaryIO) -> Tuple[List[Optional[List[str]]], Iterator[Chunk]]:
+    """
+    (names of each field, None without table; chunks of indices) of a stream written by write_binary
+    """
+    def read(size: int) -> bytes:
+        data = inp.read(size)
+        if len(data) != size:
+            raise ValueError("truncated record stream")
+        return data
+
+    if read(4) != MAGIC:
+        raise ValueError("not a record stream")
+    version, n_field, width, n_table = struct.unpack("<BBBB", read(4))
+    if version != VERSION or width not in TYPECODES:
+        raise ValueError("unsupported record stream version {} or width {}".format(version, width))
+    tables = []
+    for _ in range(n_table):
+        count, = struct.unpack("<I", read(4))
+        names = []
+        for _ in range(count):
+            size, = struct.unpack("<I", read(4))
+            names.append(read(size).decode("utf-8"))
+        tables.append(names)
+    fields = [None if index == NO_TABLE else tables[index] for index in read(n_field)]
+
+    def blocks() -> Iterator[Chunk]:
+        while True:
+            n, = struct.unpack("<I", read(4))
+            if n == 0:
+                return
+            columns = []
+            for _ in range(n_field):
+                column = array(TYPECODES[width])
+                column.frombytes(read(n * width))
+                if sys.byteorder == "big":
+                    column.byteswap()
+                columns.append(array('q', column))
+            yield tuple(columns)
+
+    return fields, blocks()
+
+
+def write_edges(gi: Union[GlobalInfo, NativeInfo], out: Union[TextIO, BinaryIO], binary=False, names=True,
+        rel="edge", chunk_size=CHUNK_SIZE) -> int:
+    """
+    Stream a pod x pod relation of any build mode to out (a text file for NDJSON, a binary one otherwise)
+    """
+    table = IndexTable.of_pods(gi.pods) if names else None
+    chunks = relation_chunks(gi, rel, chunk_size)
+    if binary:
+        return write_binary(out, chunks, 2, [table, table])
+    return write_ndjson(out, chunks, ("src", "dst"), [table, table])
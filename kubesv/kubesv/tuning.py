@@ -0,0 +1,224 @@
+"""
+Auto-tuning of the z3 Datalog backend.
+Which relation backend saturates fastest depends a lot on the cluster shape,
+so profile the candidate configurations on a sample of the cluster,
+run the real build with the fastest one and remember the choice per cluster fingerprint.
+"""
+import hashlib
+import json
+import os
+import random
+
+from dataclasses import dataclass, field
+from math import log2, floor
+from time import perf_counter
+from typing import *
+from typing_extensions import *
+from .constraint import GlobalInfo, build
+from .model import *
+from .lazy import lazy_import
+
+z3 = lazy_import("z3")
+
+
+# NOTE: "udoc" is the NoD backend (difference of cubes), "pentagon" is z3's default
+CANDIDATES: List[Dict[str, Any]] = [
+    {"datalog.default_relation": "pentagon"},
+    {"datalog.default_relation": "hashtable"},
+    {"datalog.default_relation": "bitvector_table"},
+    {"datalog.default_relation": "sparse_table"},
+    {"datalog.default_relation": "udoc"},
+    {"datalog.default_relation": "doc"},
+]
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "kubesv", "tuning.json")
+
+
+def candidate_name(options: Dict[str, Any]) -> str:
+    return json.dumps(options, sort_keys=True)
+
+
+@dataclass
+class TuningResult:
+    fingerprint: str
+    options: Dict[str, Any]
+    # candidate name -> seconds on the sample, None if it timed out
+    timings: Dict[str, Optional[float]] = field(default_factory=dict)
+    cached: bool = False
+
+    def report(self) -> str:
+        lines = ["cluster {}{}".format(self.fingerprint, " (cached)" if self.cached else "")]
+        chosen = candidate_name(self.options)
+        for name, seconds in self.timings.items():
+            mark = "*" if name == chosen else " "
+            lines.append("{} {}: {}".format(mark, name, "timeout" if seconds is None else "{:.4f}s".format(seconds)))
+        return "\n".join(lines)
+
+    def to_dict(self):
+        return {
+            "options": self.options,
+            "timings": self.timings
+        }
+
+
+def fingerprint(pods: List[PodAdapter], pols: List[PolicyAdapter], nams: List[NamespaceAdapter]) -> str:
+    """
+    Shape of the cluster, sizes are bucketed by log2 so similar clusters share a tuning
+    """
+    def bucket(n):
+        return floor(log2(1 + n))
+
+    label_keys = set()
+    for pod in pods:
+        label_keys.update(pod.labels.keys())
+
+    n_rules = 0
+    n_ns_peers = 0
+    n_exprs = 0
+    for pol in pols:
+        for rules in (pol.ingress_rules, pol.egress_rules):
+            for rule in rules or []:
+                n_rules += 1
+                for peer in rule.peer or []:
+                    if peer.namespace_selector is not None:
+                        n_ns_peers += 1
+        if pol.pod_selector is not None and pol.pod_selector.match_expressions:
+            n_exprs += 1
+
+    shape = {
+        "pods": bucket(len(pods)),
+        "policies": bucket(len(pols)),
+        "namespaces": bucket(len(nams)),
+        "label_keys": bucket(len(label_keys)),
+        "rules": bucket(n_rules),
+        "namespace_peers": bucket(n_ns_peers),
+        "match_expressions": bucket(n_exprs),
+    }
+    return hashlib.sha1(json.dumps(shape, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def tuning_key(fp: str, candidates: List[Dict[str, Any]], **params) -> str:
+    """
+    Cache key, the same cluster tuned over other candidates or build flags gets its own entry
+    """
+    setup = json.dumps({"candidates": candidates, "params": params}, sort_keys=True, default=str)
+    return "{}-{}".format(fp, hashlib.sha1(setup.encode()).hexdigest()[:16])
+
+
+def sample_cluster(pods: List[PodAdapter], pols: List[PolicyAdapter], nams: List[NamespaceAdapter],
+        max_pods=200, max_pols=50, seed=0):
+    """
+    A random subset of pods and policies, all namespaces are kept (pods refer to them)
+    """
+    rnd = random.Random(seed)
+    pod_idx = sorted(rnd.sample(range(len(pods)), min(max_pods, len(pods))))
+    pol_idx = sorted(rnd.sample(range(len(pols)), min(max_pols, len(pols))))
+    return [pods[i] for i in pod_idx], [pols[i] for i in pol_idx], nams
+
+
+def profile(pods, pols, nams, options: Dict[str, Any], timeout_ms: int, **flags) -> Optional[float]:
+    """
+    Seconds to build and saturate edge with these options, None on timeout
+    """
+    start = perf_counter()
+    gi = build(pods, pols, nams, mode="z3", timeout=timeout_ms, **flags, **options)
+    edge = gi.get_relation_core("edge")
+    src = gi.declare_var('src_tune', gi.pod_sort)
+    dst = gi.declare_var('dst_tune', gi.pod_sort)
+    if gi.fp.query(edge(src, dst)) == z3.unknown:
+        return None
+    return perf_counter() - start
+
+
+def load_cache(cache_path: str) -> Dict[str, Any]:
+    if not os.path.isfile(cache_path):
+        return {}
+    with open(cache_path) as f:
+        return json.load(f)
+
+
+def save_cache(cache_path: str, cache: Dict[str, Any]):
+    directory = os.path.dirname(cache_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, cache_path)
+
+
+def autotune(pods: List[PodAdapter], pols: List[PolicyAdapter], nams: List[NamespaceAdapter],
+        candidates: Optional[List[Dict[str, Any]]] = None,
+        max_pods=200, max_pols=50,
+        timeout_ms=10000, slack=3.0,
+        cache_path: Optional[str] = DEFAULT_CACHE_PATH,
+        retune=False, seed=0, **flags) -> TuningResult:
+    """
+    Pick the fastest candidate configuration on a sample of the cluster.
+    Candidates slower than slack x the best one so far are cut off by a z3 timeout.
+    The choice is persisted in cache_path (None to disable) per cluster fingerprint, candidates and flags,
+    unless every candidate timed out.
+    pods/pols/nams may also be bare k8s models (kubernetes.client or kubesv.lite)
+    """
+    pods = adapt(pods, PodAdapter)
+    pols = adapt(pols, PolicyAdapter)
+    nams = adapt(nams, NamespaceAdapter)
+    if candidates is None:
+        candidates = CANDIDATES
+
+    fp = fingerprint(pods, pols, nams)
+    key = tuning_key(fp, candidates, max_pods=max_pods, max_pols=max_pols,
+        timeout_ms=timeout_ms, slack=slack, seed=seed, **flags)
+    cache = load_cache(cache_path) if cache_path is not None else {}
+    if not retune and key in cache:
+        return TuningResult(fp, cache[key]["options"], cache[key]["timings"], cached=True)
+
+    s_pods, s_pols, s_nams = sample_cluster(pods, pols, nams, max_pods=max_pods, max_pols=max_pols, seed=seed)
+
+    result = TuningResult(fp, {})
+    best = None
+    for options in candidates:
+        limit = timeout_ms
+        if best is not None:
+            limit = min(timeout_ms, max(100, int(best * slack * 1000)))
+        seconds = profile(s_pods, s_pols, s_nams, options, limit, **flags)
+        result.timings[candidate_name(options)] = seconds
+        if seconds is not None and (best is None or seconds < best):
+            best = seconds
+            result.options = dict(options)
+
+    # no candidate finished, nothing worth remembering
+    if cache_path is not None and best is not None:
+        # reload, another process may have tuned another cluster meanwhile
+        cache = load_cache(cache_path)
+        cache[key] = result.to_dict()
+        save_cache(cache_path, cache)
+    return result
+
+
+def build_tuned(pods: List[PodAdapter], pols: List[PolicyAdapter], nams: List[NamespaceAdapter],
+        check_self_ingress_traffic=True,
+        check_select_by_no_policy=False,
+        ground_default_pod=False,
+        cache_path: Optional[str] = DEFAULT_CACHE_PATH,
+        retune=False, **kwargs) -> GlobalInfo:
+    """
+    build(..., mode="z3") with the auto-tuned backend, the tuning result is kept in gi.tuning
+    Explicit z3 options in kwargs take precedence over the tuned ones.
+    pods/pols/nams may also be bare k8s models (kubernetes.client or kubesv.lite)
+    """
+    pods = adapt(pods, PodAdapter)
+    pols = adapt(pols, PolicyAdapter)
+    nams = adapt(nams, NamespaceAdapter)
+    flags = {
+        "check_self_ingress_traffic": check_self_ingress_traffic,
+        "check_select_by_no_policy": check_select_by_no_policy,
+        "ground_default_pod": ground_default_pod,
+    }
+    result = autotune(pods, pols, nams, cache_path=cache_path, retune=retune, **flags)
+
+    options = dict(result.options)
+    options.update(kwargs)
+    gi = build(pods, pols, nams, mode="z3", **flags, **options)
+    gi.tuning = result
+    return gi
@@ -1,10 +1,17 @@
-from z3 import *
+from __future__ import annotations
+
+import ctypes
+from array import array
+from bitarray import bitarray
 from typing import *
 from typing_extensions import *
+from .lazy import lazy_import
+
+z3 = lazy_import("z3")
 
 
 def parse_z3_var_assignment(assign):
-    idx = get_var_index(assign.arg(0))
+    idx = z3.get_var_index(assign.arg(0))
     num = assign.arg(1).as_long()
     return idx, num
 
@@ -17,20 +24,20 @@ def parse_z3_and_var(assigns):
     return results
 
 
-def parse_z3_or_and(answer: BoolRef) -> Set[Tuple[int, ...]]:
+def parse_z3_or_and(answer: z3.BoolRef) -> Set[Tuple[int, ...]]:
     # assume the answer is Or(And(Var0, Var1, ...), ...)
     all_answer = None
     
-    if is_eq(answer):
+    if z3.is_eq(answer):
         return parse_z3_var_assignment(answer)
 
-    if is_and(answer):
+    if z3.is_and(answer):
         all_answer = [-1 for _ in range(answer.num_args())]
         for i in range(answer.num_args()):
             assign = answer.arg(i)
             idx, num = parse_z3_or_and(assign)
             all_answer[idx] = num
-    elif is_or(answer):
+    elif z3.is_or(answer):
         all_answer = set()
         for i in range(answer.num_args()):
             assigns = answer.arg(i)
@@ -43,10 +50,134 @@ def parse_z3_or_and(answer: BoolRef) -> Set[Tuple[int, ...]]:
     return all_answer
 
 
-def parse_z3_result(answer: BoolRef):
+def parse_z3_result(answer: z3.BoolRef):
+    try:
+        chunks = list(iter_z3_answer_chunks(answer))
+    except ValueError:
+        # not a plain Or(And(Var == value, ...)) answer, take the generic path
+        return parse_z3_result_generic(answer)
+    if not chunks:
+        return parse_z3_result_generic(answer)
+    if len(chunks[0]) == 1:
+        return {v for chunk in chunks for v in chunk[0]}
+    return {t for chunk in chunks for t in zip(*chunk)}
+
+
+def parse_z3_result_generic(answer: z3.BoolRef):
     result = parse_z3_or_and(answer)
     if isinstance(result, list):
         return {tuple(result)}
     elif isinstance(result, tuple):
         return {result[1]}
-    return result
\ No newline at end of file
+    return result
+
+
+def iter_z3_answer_chunks(answer: z3.BoolRef, chunk_size: int = 1 << 16) -> Iterator[Tuple[array, ...]]:
+    """
+    Stream an Or(And(Var(0) == v0, Var(1) == v1, ...), ...) answer, chunk_size tuples at a time.
+    Each chunk holds one array of values per variable, ordered by variable index.
+    Walks the AST with the raw C API, so no python z3 object is created per tuple.
+    Raise ValueError if the answer is not of that shape (e.g. True, or non-ground terms).
+    """
+    ctx = answer.ctx_ref()
+    ast = answer.as_ast()
+
+    if z3.is_or(answer):
+        n_tuple = z3.Z3_get_app_num_args(ctx, ast)
+        first = z3.Z3_get_app_arg(ctx, ast, 0)
+        get_tuple = lambda i: z3.Z3_get_app_arg(ctx, ast, i)
+    elif z3.is_and(answer) or z3.is_eq(answer):
+        n_tuple = 1
+        first = ast
+        get_tuple = lambda i: ast
+    elif z3.is_false(answer):
+        return
+    else:
+        raise ValueError("unsupported answer {}".format(answer))
+
+    # Var == value for unary relations, And(Var == value, ...) otherwise
+    is_single = is_app_of(ctx, first, z3.Z3_OP_EQ)
+    if is_single:
+        n_var = 1
+    elif is_app_of(ctx, first, z3.Z3_OP_AND):
+        n_var = z3.Z3_get_app_num_args(ctx, first)
+    else:
+        raise ValueError("unsupported tuple in answer")
+
+    value = ctypes.c_uint64()
+    value_ref = ctypes.byref(value)
+
+    for start in range(0, n_tuple, chunk_size):
+        columns = tuple(array('q') for _ in range(n_var))
+        for i in range(start, min(n_tuple, start + chunk_size)):
+            assigns = get_tuple(i)
+            # every tuple has the shape of the first one
+            if not (is_app_of(ctx, assigns, z3.Z3_OP_EQ) if is_single else
+                    is_app_of(ctx, assigns, z3.Z3_OP_AND) and z3.Z3_get_app_num_args(ctx, assigns) == n_var):
+                raise ValueError("irregular tuple in answer")
+            for j in range(n_var):
+                assign = assigns if is_single else z3.Z3_get_app_arg(ctx, assigns, j)
+                if not is_app_of(ctx, assign, z3.Z3_OP_EQ):
+                    raise ValueError("unsupported assignment in answer")
+                var = z3.Z3_get_app_arg(ctx, assign, 0)
+                num = z3.Z3_get_app_arg(ctx, assign, 1)
+                if z3.Z3_get_ast_kind(ctx, var) != z3.Z3_VAR_AST or \
+                        z3.Z3_get_ast_kind(ctx, num) != z3.Z3_NUMERAL_AST or \
+                        not z3.Z3_get_numeral_uint64(ctx, num, value_ref):
+                    raise ValueError("unsupported assignment in answer")
+                index = z3.Z3_get_index_value(ctx, var)
+                if index >= n_var:
+                    raise ValueError("variable {} out of range in answer".format(index))
+                columns[index].append(value.value)
+            # each variable exactly once
+            row = i - start + 1
+            if any(len(column) != row for column in columns):
+                raise ValueError("repeated variable in answer")
+        yield columns
+
+
+def is_app_of(ctx, ast, op: int) -> bool:
+    return z3.Z3_get_ast_kind(ctx, ast) == z3.Z3_APP_AST and \
+        z3.Z3_get_decl_kind(ctx, z3.Z3_get_app_decl(ctx, ast)) == op
+
+
+def get_z3_index_arrays(answer: z3.BoolRef, sort=True) -> Tuple[array, ...]:
+    """
+    All tuples of an answer as one array per variable, lexicographically sorted if sort
+    """
+    columns = None
+    for chunk in iter_z3_answer_chunks(answer):
+        if columns is None:
+            columns = chunk
+        else:
+            for column, part in zip(columns, chunk):
+                column.extend(part)
+    if columns is None:
+        return ()
+    if sort and len(columns) > 1:
+        order = sorted(range(len(columns[0])), key=lambda i: tuple(c[i] for c in columns))
+        columns = tuple(array('q', (c[i] for i in order)) for c in columns)
+    elif sort:
+        columns = (array('q', sorted(columns[0])),)
+    return columns
+
+
+def get_z3_bit_matrix(answer: z3.BoolRef, n_row: int, n_col: Optional[int] = None, transpose=False) -> List[bitarray]:
+    """
+    Pack a binary relation answer into bitarray rows, rows[Var(0)][Var(1)] (swapped if transpose)
+    """
+    if n_col is None:
+        n_col = n_row
+    if transpose:
+        n_row, n_col = n_col, n_row
+    rows = [bitarray(n_col) for _ in range(n_row)]
+    for row in rows:
+        row.setall(False)
+
+    for chunk in iter_z3_answer_chunks(answer):
+        fst, snd = chunk
+        if transpose:
+            fst, snd = snd, fst
+        for i, j in zip(fst, snd):
+            rows[i][j] = True
+    return rows
\ No newline at end of file
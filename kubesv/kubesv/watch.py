@@ -0,0 +1,317 @@
+"""
+Watch mode: keep reachability and invariant results up to date from a stream of k8s watch events.
+
+Events are {"type": "ADDED" | "MODIFIED" | "DELETED", "object": {...}} JSON lines,
+as written by the API server watch endpoints (e.g. /api/v1/pods?watch=1) or `kubectl get -w -o json`,
+for pods, namespaces and network policies; they are read from files, pipes or URLs.
+
+Each source is read by its own thread, which timestamps the events when they arrive.
+Events queued while a verdict is computed are applied together and share the next verdict.
+Updates are incremental:
+    an event that does not change labels, container ports or policy spec (e.g. a pod status update) is free,
+    a policy change keeps the pod facts, the selector cache and the facts of the other policies,
+    namespace blocks with unchanged inputs and the rows they do not change are reused (see partition.py).
+The latency of each event is the time from its arrival to the verdict reflecting it.
+"""
+import json
+import queue
+import sys
+import threading
+import urllib.request
+
+from bisect import bisect_left
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import *
+from .model import *
+from .native import NativeInfo, all_isolated
+from .partition import PartitionState, define_partitioned_model
+from . import parser
+
+EVENT_TYPES = ("ADDED", "MODIFIED", "DELETED")
+
+# invariant name -> function of the current model
+Invariants = Dict[str, Callable[[NativeInfo], Any]]
+
+DEFAULT_INVARIANTS: Invariants = {
+    "edges": lambda ni: sum(row.count() for row in ni.edge),
+    "isolated": lambda ni: len(all_isolated(ni)),
+}
+
+
+class LatencyHistogram:
+    """
+    Event-to-verdict latencies in 1-2-5 buckets, from 0.1ms to 10s
+    """
+    BOUNDS = [m * 10.0 ** e for e in range(-4, 1) for m in (1, 2, 5)] + [10.0]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.samples: List[float] = []
+
+    def record(self, seconds: float):
+        self.counts[bisect_left(self.BOUNDS, seconds)] += 1
+        self.samples.append(seconds)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def percentile(self, q: float) -> float:
+        if not self.samples:
+            raise ValueError("no latency recorded")
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+    @staticmethod
+    def format_seconds(seconds: float) -> str:
+        if seconds < 1:
+            return "{:g}ms".format(round(seconds * 1000, 3))
+        return "{:g}s".format(seconds)
+
+    def report(self, width=40) -> str:
+        if not self.samples:
+            return "no events"
+        lines = ["{} events, p50 {}, p99 {}, max {}".format(len(self),
+            self.format_seconds(self.percentile(50)), self.format_seconds(self.percentile(99)),
+            self.format_seconds(max(self.samples)))]
+        top = max(self.counts)
+        for i, count in enumerate(self.counts):
+            if count == 0:
+                continue
+            label = "<= " + self.format_seconds(self.BOUNDS[i]) if i < len(self.BOUNDS) else "> " + self.format_seconds(self.BOUNDS[-1])
+            lines.append("{:>10} {:>7} {}".format(label, count, "#" * max(1, count * width // top)))
+        return "\n".join(lines)
+
+
+@dataclass
+class Verdict:
+    # events applied for this verdict, in arrival order: (type, kind, namespace/name)
+    events: List[Tuple[str, str, str]]
+    # invariant name -> result
+    results: Dict[str, Any]
+    # invariants whose result changed since the previous verdict
+    changed: List[str] = field(default_factory=list)
+    # seconds from the arrival of each event to this verdict
+    latencies: List[float] = field(default_factory=list)
+
+    def report(self) -> str:
+        return "{} event(s), latency {}: {}".format(len(self.events),
+            LatencyHistogram.format_seconds(max(self.latencies)) if self.latencies else "-",
+            ", ".join("{}{}={}".format("*" if name in self.changed else "", name, value)
+                for name, value in self.results.items()))
+
+
+class Watcher:
+    def __init__(self,
+            invariants: Optional[Invariants] = None,
+            check_self_ingress_traffic=True,
+            check_select_by_no_policy=False,
+            lite=True):
+        """
+        invariants: evaluated on every verdict, DEFAULT_INVARIANTS if None
+        lite: keep the objects as kubesv.lite models instead of kubernetes.client ones
+        """
+        self.invariants = invariants if invariants is not None else DEFAULT_INVARIANTS
+        self.check_self_traffic = check_self_ingress_traffic
+        self.check_select_by_any = check_select_by_no_policy
+        self.lite = lite
+
+        # (namespace, name) -> adapter, in insertion order, the pod/policy/namespace indices of the model
+        self.pods: Dict[Tuple[str, str], PodAdapter] = {}
+        self.policies: Dict[Tuple[str, str], PolicyAdapter] = {}
+        self.namespaces: Dict[Tuple[str, str], NamespaceAdapter] = {}
+        # (kind, namespace, name) -> the part of the object the model depends on
+        self.signatures: Dict[Tuple[str, str, str], Any] = {}
+
+        self.ni: Optional[NativeInfo] = None
+        self.pods_changed = True
+        self.policies_changed = True
+        # (namespace, name) -> selected, ingress allowed and egress allowed pods of a policy, see NativeInfo.define_pol_facts
+        self.pol_facts: Dict[Tuple[str, str], Tuple[Any, Any, Any]] = {}
+        self.partition = PartitionState()
+        self.results: Dict[str, Any] = {}
+        self.histogram = LatencyHistogram()
+
+    @staticmethod
+    def signature(kind: str, adapter) -> Any:
+        if kind == "Pod":
+            return adapter.namespace, adapter.labels, adapter.named_ports
+        if kind == "Namespace":
+            return adapter.labels
+        return adapter.to_dict()
+
+    def apply(self, event: dict) -> bool:
+        """
+        Update the cluster state, return False if the event does not change the model
+        """
+        event_type, obj = event["type"], event["object"]
+        kind = obj["kind"]
+        if event_type not in EVENT_TYPES:
+            raise ValueError("unknown event type {}".format(event_type))
+        if kind not in parser.KINDS:
+            raise ValueError("unknown kind {}".format(kind))
+
+        adapter = {"Pod": PodAdapter, "Namespace": NamespaceAdapter, "NetworkPolicy": PolicyAdapter}[kind](
+            parser.from_dict(parser.KINDS[kind], obj, lite=self.lite))
+        key = (adapter.namespace if kind != "Namespace" else "", obj["metadata"]["name"])
+        objects = {"Pod": self.pods, "Namespace": self.namespaces, "NetworkPolicy": self.policies}[kind]
+
+        if event_type == "DELETED":
+            if key not in objects:
+                return False
+            del objects[key]
+            del self.signatures[(kind,) + key]
+        else:
+            signature = self.signature(kind, adapter)
+            objects[key] = adapter
+            if self.signatures.get((kind,) + key) == signature:
+                return False
+            self.signatures[(kind,) + key] = signature
+
+        if kind == "NetworkPolicy":
+            self.pol_facts.pop(key, None)
+            self.policies_changed = True
+        else:
+            self.pods_changed = True
+        return True
+
+    def refresh(self) -> NativeInfo:
+        """
+        Bring the model up to date with the cluster state
+        """
+        if not self.pods_changed and not self.policies_changed:
+            return self.ni
+
+        pods = list(self.pods.values())
+        policies = list(self.policies.values())
+        if self.pods_changed or self.ni is None:
+            # NOTE: objects of a namespace not seen yet are kept out of the model until it is
+            nams = list(self.namespaces.values())
+            names = {ns.name for ns in nams}
+            pods = [pod for pod in pods if pod.namespace in names]
+            ni = NativeInfo(pods, policies, nams,
+                check_self_ingress_traffic=self.check_self_traffic,
+                check_select_by_no_policy=self.check_select_by_any)
+            ni.define_pod_facts()
+            self.pol_facts.clear()
+        else:
+            ni = self.ni.with_policies(policies)
+
+        for key, pol in self.policies.items():
+            if key not in self.pol_facts:
+                self.pol_facts[key] = (ni.eval_pod_selector(pol),
+                    ni.eval_rules(pol.ingress_rules), ni.eval_rules(pol.egress_rules))
+            selected, ingress_allow, egress_allow = self.pol_facts[key]
+            ni.selected_by_pol.append(selected)
+            ni.ingress_allow_by_pol.append(ingress_allow)
+            ni.egress_allow_by_pol.append(egress_allow)
+
+        define_partitioned_model(ni, state=self.partition)
+        self.ni = ni
+        self.pods_changed = self.policies_changed = False
+        return ni
+
+    def verdict(self, events: List[Tuple[float, dict]]) -> Verdict:
+        """
+        Apply (arrival time, event) pairs and evaluate the invariants once for all of them
+        """
+        applied = []
+        changed = False
+        for _, event in events:
+            changed |= self.apply(event)
+            meta = event["object"]["metadata"]
+            name = meta["name"] if "namespace" not in meta else "{}/{}".format(meta["namespace"], meta["name"])
+            applied.append((event["type"], event["object"]["kind"], name))
+
+        result = Verdict(applied, self.results)
+        if changed or not self.results:
+            ni = self.refresh()
+            results = {name: invariant(ni) for name, invariant in self.invariants.items()}
+            result.changed = [name for name, value in results.items() if self.results.get(name) != value]
+            result.results = self.results = results
+
+        now = perf_counter()
+        for arrival, _ in events:
+            result.latencies.append(now - arrival)
+            self.histogram.record(now - arrival)
+        return result
+
+    def run(self, sources: List[Union[str, IO]],
+            on_verdict: Optional[Callable[[Verdict], None]] = None) -> LatencyHistogram:
+        """
+        Consume the event sources until all of them end
+        sources: JSON-lines files or pipes, "-" for stdin, http(s) URLs of watch endpoints
+        """
+        events: queue.Queue = queue.Queue()
+        readers = [threading.Thread(target=read_events, args=(source, events), daemon=True) for source in sources]
+        for reader in readers:
+            reader.start()
+
+        running = len(readers)
+        while running:
+            batch = []
+            item = events.get()
+            while True:
+                if item is None:
+                    running -= 1
+                else:
+                    batch.append(item)
+                try:
+                    item = events.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                result = self.verdict(batch)
+                if on_verdict is not None:
+                    on_verdict(result)
+        return self.histogram
+
+
+def open_source(source: Union[str, IO]) -> IO:
+    if not isinstance(source, str):
+        return source
+    if source == "-":
+        return sys.stdin
+    if source.startswith(("http://", "https://")):
+        return urllib.request.urlopen(source)
+    return open(source)
+
+
+def read_events(source: Union[str, IO], events: queue.Queue):
+    """
+    Put (arrival time, event) pairs of a JSON-lines source into events, then None
+    """
+    try:
+        stream = open_source(source)
+        for line in stream:
+            if isinstance(line, bytes):
+                line = line.decode()
+            if line.strip():
+                events.put((perf_counter(), json.loads(line)))
+    finally:
+        events.put(None)
+
+
+def main(argv: Optional[List[str]] = None):
+    import argparse
+    arg_parser = argparse.ArgumentParser(description="verify a cluster continuously from k8s watch events")
+    arg_parser.add_argument("sources", nargs="+", help="JSON-lines files, - for stdin, or watch URLs")
+    arg_parser.add_argument("--select-by-no-policy", action="store_true",
+        help="pods selected by no policy are not isolated")
+    arg_parser.add_argument("--invariants", help="file of name: statement lines (see invariants.py), "
+        "their violation counts are reported instead of the default invariants")
+    arg_parser.add_argument("--quiet", action="store_true", help="only print the latency histogram")
+    args = arg_parser.parse_args(argv)
+
+    invariants = None
+    if args.invariants is not None:
+        from .invariants import InvariantChecker, parse_invariants
+        with open(args.invariants) as f:
+            invariants = InvariantChecker(parse_invariants(f.read())).watch_invariants()
+    watcher = Watcher(check_select_by_no_policy=args.select_by_no_policy, invariants=invariants)
+    histogram = watcher.run(args.sources, on_verdict=None if args.quiet else lambda v: print(v.report(), flush=True))
+    print(histogram.report())
+
+
+if __name__ == "__main__":
+    main()
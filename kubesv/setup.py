@@ -20,6 +20,8 @@ setup(
     author_email='oubutong@cs.ucla.edu',
     url='https://github.com/oubotong/Kubernetes-verification',
     license=license,
-    packages=find_packages(exclude=('tests', 'docs'))
+    packages=find_packages(exclude=('tests', 'docs')),
+    # kano_py is not on PyPI, see requirements.txt
+    install_requires=['kano_py'],
 )
 
@@ -1,8 +1,34 @@
 # -*- coding: utf-8 -*-
 
 from .context import sample
+from kubesv.constraint import build
+from kubesv.explain import ExplanationIndex, SELECTED_BY_NO_POLICY
+from kubesv.exposure import IN, OUT, degree_report, pod_groups
+from kubesv.invariants import InvariantChecker, LabelIndex, parse_invariants
+from kubesv.sampling import PairSampler, build_facts, estimate, mean_estimate, t_quantile
+from kubesv.stream import IndexTable, crosscheck_chunks, read_binary, relation_chunks, shadow_chunks, write_edges
+from kubesv.model import PodAdapter, PolicyAdapter, adapt
+from kubesv.parser import from_dicts, from_yaml_all
+from kubesv.postprocess import *
+from kubesv.utils import *
+from kubesv.tuning import autotune, build_tuned
+from kubesv import lite
+from kubesv.watch import Watcher
 
+import io
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
+import z3
+
+from bitarray import bitarray
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from time import perf_counter
 
 
 class AdvancedTestSuite(unittest.TestCase):
@@ -11,6 +37,562 @@ class AdvancedTestSuite(unittest.TestCase):
     def test_thoughts(self):
         self.assertIsNone(None)
 
+    def test_native_matches_z3(self):
+        pods, pols, nams = sample.paper_example()
+
+        for flags in itertools.product([False, True], repeat=3):
+            ni = build(pods, pols, nams, *flags, mode="native")
+            gi = build(pods, pols, nams, *flags, mode="z3")
+
+            self.assertEqual(get_all_edges(ni), get_all_edges(gi))
+            self.assertEqual(get_all_paths(ni), get_all_paths(gi))
+            self.assertEqual(all_reach_isolate(ni), all_reach_isolate(gi))
+            self.assertEqual(user_crosscheck(ni, "role"), user_crosscheck(gi, "role"))
+            self.assertEqual(policy_shadow(ni), policy_shadow(gi))
+            self.assertEqual(policy_conflict(ni), policy_conflict(gi))
+
+        # z3 options are not silently dropped by the native modes
+        self.assertIsInstance(build(pods, pols, nams).fp, z3.Fixedpoint)
+        for mode in ("native", "partitioned"):
+            with self.assertRaises(TypeError):
+                build(pods, pols, nams, mode=mode, timeout=1000)
+
+    def test_bound_reachability(self):
+        pods, pols, nams = sample.paper_example()
+        n = len(pods)
+
+        for flags in itertools.product([False, True], repeat=3):
+            for mode in ("native", "z3"):
+                gi = build(pods, pols, nams, *flags, mode=mode)
+                _, edges = get_all_edges(gi)
+                # the closure of edge, one step at a time
+                paths = set(edges)
+                while True:
+                    step = {(i, k) for i, j in paths for j2, k in edges if j == j2} - paths
+                    if not step:
+                        break
+                    paths |= step
+
+                for idx in range(n):
+                    expected_from = {j for i, j in paths if i == idx}
+                    expected_to = {i for i, j in paths if j == idx}
+                    self.assertEqual(reachable_from(gi, idx)[1], expected_from)
+                    self.assertEqual(reachable_to(gi, idx)[1], expected_to)
+                    self.assertEqual(reachable_from(gi, idx)[0] == z3.sat, bool(expected_from))
+                self.assertEqual(get_all_pairs(gi, "path", src=0, dst=1)[1], {(0, 1)} & paths)
+
+    def test_fast_answer_extraction(self):
+        pods, pols, nams = sample.paper_example()
+        gi = build(pods, pols, nams, True, True, False, mode="z3")
+
+        edge = gi.get_relation_core("edge")
+        src = gi.declare_var('src', gi.pod_sort)
+        dst = gi.declare_var('dst', gi.pod_sort)
+        sat, answer = get_answer(gi.fp, [edge(src, dst)])
+
+        pairs = parse_z3_result_generic(answer)
+        self.assertEqual(parse_z3_result(answer), pairs)
+        self.assertEqual(list(zip(*get_z3_index_arrays(answer))), sorted(pairs))
+        self.assertEqual(sum(len(c[0]) for c in iter_z3_answer_chunks(answer, chunk_size=7)), len(pairs))
+
+        matrix = get_z3_bit_matrix(answer, len(pods))
+        self.assertEqual({(i, j) for i in range(len(pods)) for j in range(len(pods)) if matrix[i][j]}, pairs)
+
+        # irregular answers are rejected, not indexed blindly
+        var0, var1 = z3.Var(0, z3.BitVecSort(8)), z3.Var(1, z3.BitVecSort(8))
+        for bad in (z3.Or(z3.And(var0 == 1, var1 == 2), var0 == 3),
+                    z3.Or(var1 == 2, z3.And(var0 == 1, var1 == 2)),
+                    z3.Or(z3.And(var0 == 1, var0 == 2), z3.And(var0 == 3, var1 == 4)),
+                    z3.Or(z3.And(var0 == 1, var1 == var0), z3.And(var0 == 3, var1 == 4))):
+            with self.assertRaises(ValueError):
+                list(iter_z3_answer_chunks(bad))
+
+    def test_autotune_cache(self):
+        pods, pols, nams = sample.paper_example()
+        candidates = [
+            {"datalog.default_relation": "pentagon"},
+            {"datalog.default_relation": "hashtable"},
+        ]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cache_path = os.path.join(tmp, "tuning.json")
+            result = autotune(pods, pols, nams, candidates=candidates, cache_path=cache_path)
+            self.assertFalse(result.cached)
+            self.assertIn(result.options, candidates)
+            self.assertEqual(len(result.timings), len(candidates))
+
+            cached = autotune(pods, pols, nams, candidates=candidates, cache_path=cache_path)
+            self.assertTrue(cached.cached)
+            self.assertEqual(cached.options, result.options)
+
+            # other candidates or flags are tuned again
+            other = autotune(pods, pols, nams, candidates=candidates[:1], cache_path=cache_path)
+            self.assertFalse(other.cached)
+            self.assertEqual(other.options, candidates[0])
+            self.assertFalse(autotune(pods, pols, nams, candidates=candidates, cache_path=cache_path,
+                check_self_ingress_traffic=False).cached)
+
+            # a tuning where every candidate timed out is not remembered
+            empty_path = os.path.join(tmp, "empty.json")
+            self.assertEqual(autotune(pods, pols, nams, candidates=[], cache_path=empty_path).options, {})
+            self.assertFalse(os.path.exists(empty_path))
+
+            # bare lite models are adapted, the same cluster has the same fingerprint
+            lite_cluster = [lite.from_model(pod.pod) for pod in pods], [lite.from_model(pol.policy) for pol in pols], \
+                [lite.from_model(nam._namespace) for nam in nams]
+            self.assertEqual(autotune(*lite_cluster, candidates=candidates, cache_path=cache_path).fingerprint,
+                result.fingerprint)
+            gi = build_tuned(*lite_cluster, cache_path=os.path.join(tmp, "lite.json"))
+            self.assertEqual(get_all_edges(gi), get_all_edges(build(pods, pols, nams, mode="z3")))
+
+    def test_lite_models(self):
+        pods, pols, nams = sample.paper_example()
+        lite_pods = [lite.from_model(pod.pod) for pod in pods]
+        lite_pols = [lite.from_model(pol.policy) for pol in pols]
+        lite_nams = [lite.from_model(nam._namespace) for nam in nams]
+
+        for adapters, models in ((pods, lite_pods), (pols, lite_pols), (nams, lite_nams)):
+            adapted = adapt(models, type(adapters[0]))
+            self.assertEqual([a.to_dict() for a in adapted], [a.to_dict() for a in adapters])
+
+        for mode in ("native", "z3"):
+            gi = build(pods, pols, nams, mode=mode)
+            li = build(lite_pods, lite_pols, lite_nams, mode=mode)
+            self.assertEqual(get_all_edges(li), get_all_edges(gi))
+
+    def test_parse_manifests(self):
+        manifests = """
+apiVersion: v1
+kind: Namespace
+metadata:
+  name: prod
+  labels: {env: prod}
+---
+apiVersion: v1
+kind: Pod
+metadata:
+  name: db
+  namespace: prod
+  labels: {app: db}
+  creationTimestamp: 2021-03-01T00:00:00Z
+spec:
+  containers:
+  - name: postgres
+    ports: [{containerPort: 5432, name: pg}]
+---
+apiVersion: networking.k8s.io/v1
+kind: NetworkPolicy
+metadata:
+  name: db
+  namespace: prod
+spec:
+  podSelector: {matchLabels: {app: db}}
+  ingress:
+  - from: [{podSelector: {matchLabels: {app: web}}}]
+    ports: [{port: 5432}]
+---
+"""
+        for use_lite in (False, True):
+            nam, pod, pol = from_yaml_all(manifests, lite=use_lite)
+            self.assertEqual(nam.metadata.labels, {"env": "prod"})
+            self.assertEqual((pod.metadata.name, pod.spec.containers[0].ports[0].container_port), ("db", 5432))
+            self.assertEqual(pol.spec.ingress[0]._from[0].pod_selector.match_labels, {"app": "web"})
+            # PolicyAdapter reads both kinds of models alike
+            self.assertEqual(PolicyAdapter(pol).ingress_rules[0].port_ranges, [("TCP", 5432, 5432)])
+
+        self.assertEqual(type(from_dicts([{"kind": "Pod", "metadata": {"name": "web"}}])[0]).__name__, "V1Pod")
+        self.assertEqual(from_dicts([{"metadata": {"name": "web"}}], kind="Pod", lite=True)[0].metadata.name, "web")
+        for use_lite in (False, True):
+            with self.assertRaises(ValueError):
+                from_dicts([{"kind": "Service", "metadata": {"name": "web"}}], lite=use_lite)
+            with self.assertRaises(ValueError):
+                from_yaml_all("kind: Deployment\nmetadata: {name: web}\n", lite=use_lite)
+
+    def test_selector_semantics(self):
+        def pod(name, namespace, labels):
+            return {"kind": "Pod", "metadata": {"name": name, "namespace": namespace, "labels": labels}}
+
+        def policy(name, namespace, spec):
+            return {"kind": "NetworkPolicy", "metadata": {"name": name, "namespace": namespace}, "spec": spec}
+
+        objects = from_dicts([
+            {"kind": "Namespace", "metadata": {"name": "prod", "labels": {"env": "prod"}}},
+            {"kind": "Namespace", "metadata": {"name": "dev", "labels": {"env": "dev"}}},
+            pod("db", "prod", {"app": "db"}),
+            pod("web", "prod", {"app": "web"}),
+            pod("web", "dev", {"app": "web"}),
+            pod("tmp", "dev", {}),
+            # a podSelector alone only selects the web of prod
+            policy("db", "prod", {"podSelector": {"matchLabels": {"app": "db"}}, "ingress": [{"from": [
+                {"podSelector": {"matchLabels": {"app": "web"}}}]}]}),
+            # dev pods without app, no object has the key missing
+            policy("tmp", "dev", {"podSelector": {"matchExpressions": [
+                {"key": "app", "operator": "DoesNotExist"},
+                {"key": "missing", "operator": "NotIn", "values": ["x"]}]},
+                "ingress": [{"from": [{"namespaceSelector": {"matchLabels": {"env": "prod"}}}]}]}),
+        ], lite=True)
+        nams, pods, pols = objects[:2], objects[2:6], objects[6:]
+        for mode in ("native", "z3", "hybrid"):
+            gi = build(pods, pols, nams, True, True, mode=mode)
+            # db and tmp are isolated, also their self traffic on egress
+            self.assertEqual(get_all_pairs(gi, "edge", dst=0)[1], {1}, mode)
+            self.assertEqual(get_all_pairs(gi, "edge", dst=3)[1], {1}, mode)
+
+    def test_memoized_adapters(self):
+        pol = PolicyAdapter(lite.from_dict("NetworkPolicy", {
+            "metadata": {"name": "db", "namespace": "default"},
+            "spec": {
+                "podSelector": {"matchLabels": {"app": "db"}},
+                "ingress": [{"from": [{"podSelector": {"matchLabels": {"app": "web"}}}]}],
+            },
+        }))
+        rules = pol.ingress_rules
+        self.assertIs(pol.ingress_rules, rules)
+        self.assertIs(rules[0].peer, rules[0].peer)
+
+        pol.spec.ingress.append(lite.NetworkPolicyIngressRule())
+        self.assertEqual(len(pol.ingress_rules), 1)
+        pol.invalidate()
+        self.assertEqual(len(pol.ingress_rules), 2)
+        self.assertIsNone(pol.ingress_rules[1].peer)
+
+    def test_port_reachability(self):
+        nams = [lite.from_dict("Namespace", {"metadata": {"name": "default"}})]
+        pods = [lite.from_dict("Pod", {"metadata": {"name": name, "labels": {"app": name}}})
+            for name in ("web", "db", "cache")]
+        pols = [lite.from_dict("NetworkPolicy", {
+            "metadata": {"name": "db"},
+            "spec": {
+                "podSelector": {"matchLabels": {"app": "db"}},
+                "ingress": [
+                    {"from": [{"podSelector": {"matchLabels": {"app": "web"}}}], "ports": [{"port": 5432}]},
+                    {"ports": [{"protocol": "TCP", "port": 9000, "endPort": 9100}]},
+                ],
+            },
+        })]
+        # unselected pods are not isolated
+        ni = build(pods, pols, nams, check_select_by_no_policy=True, mode="native")
+        gi = build(pods, pols, nams, check_select_by_no_policy=True, mode="z3")
+
+        # port-agnostic edges are unchanged
+        self.assertIn((0, 1), get_all_edges(ni)[1])
+        self.assertIn((0, 1), get_port_edges(ni, "TCP", 5432)[1])
+        self.assertNotIn((2, 1), get_port_edges(ni, "TCP", 5432)[1])
+        self.assertIn((2, 1), get_port_edges(ni, "TCP", 9100)[1])
+        self.assertNotIn((0, 1), get_port_edges(ni, "UDP", 5432)[1])
+        self.assertNotIn((0, 1), get_port_edges(ni, "TCP", 80)[1])
+        self.assertEqual(allowed_ports(ni, 0, 1)[1], [("TCP", 5432, 5432), ("TCP", 9000, 9100)])
+        self.assertEqual(allowed_ports(ni, 2, 1)[1], [("TCP", 9000, 9100)])
+        with self.assertRaises(ValueError):
+            get_port_edges(gi, "TCP", 5432)
+
+    def test_named_ports(self):
+        nams = [lite.from_dict("Namespace", {"metadata": {"name": "default"}})]
+        pods = [lite.from_dict("Pod", {
+            "metadata": {"name": name, "labels": {"app": name}},
+            "spec": {"containers": [{"name": "c", "ports": ports}]},
+        }) for name, ports in (
+            ("web", [{"name": "metrics", "containerPort": 9090}]),
+            ("db", [{"name": "metrics", "containerPort": 9187}, {"name": "dns", "containerPort": 53, "protocol": "UDP"}]),
+            ("cache", []),
+        )]
+        pols = [lite.from_dict("NetworkPolicy", {
+            "metadata": {"name": "scrape"},
+            "spec": {
+                "podSelector": {},
+                "ingress": [{"from": [{"podSelector": {"matchLabels": {"app": "web"}}}], "ports": [{"port": "metrics"}]}],
+                "egress": [{}],
+            },
+        })]
+        ni = build(pods, pols, nams, mode="native")
+        self.assertEqual(PodAdapter(pods[1]).named_ports, {("TCP", "metrics"): 9187, ("UDP", "dns"): 53})
+
+        # the name resolves on each destination pod
+        self.assertEqual(allowed_ports(ni, 0, 1)[1], [("TCP", 9187, 9187)])
+        self.assertEqual(allowed_ports(ni, 0, 2)[1], [])
+        self.assertIn((0, 1), get_port_edges(ni, "TCP", 9187)[1])
+        self.assertNotIn((0, 1), get_port_edges(ni, "TCP", 9090)[1])
+        self.assertNotIn((0, 1), get_port_edges(ni, "UDP", 9187)[1])
+
+    def test_external_endpoints(self):
+        nams = [lite.from_dict("Namespace", {"metadata": {"name": "default"}})]
+        pods = [lite.from_dict("Pod", {"metadata": {"name": name, "labels": {"app": name}}})
+            for name in ("web", "db")]
+        pols = [lite.from_dict("NetworkPolicy", {
+            "metadata": {"name": "web"},
+            "spec": {
+                "podSelector": {"matchLabels": {"app": "web"}},
+                "egress": [{"to": [{"ipBlock": {"cidr": "10.0.0.0/8", "except": ["10.1.0.0/16"]}}]}],
+                "ingress": [{"from": [{"ipBlock": {"cidr": "172.16.0.0/12"}}]}],
+            },
+        })]
+        endpoints = [("dns", "10.0.0.53"), ("blocked", "10.1.2.3"), ("corp", "172.17.1.0/24"),
+            ("wide", "10.0.0.0/7"), ("v6", "2001:db8::1")]
+        ni = build(pods, pols, nams, endpoints=endpoints, mode="native")
+
+        self.assertEqual(get_external_pairs(ni)[1], {(0, 0)})
+        self.assertEqual(get_external_pairs(ni, egress=False)[1], {(2, 0)})
+        # ipBlock peers select no pod
+        self.assertEqual(get_all_edges(ni)[1], set())
+
+        ni = build(pods, pols, nams, endpoints=endpoints, check_select_by_no_policy=True, mode="native")
+        self.assertEqual({e for i, e in get_external_pairs(ni)[1] if i == 1}, set(range(len(endpoints))))
+        with self.assertRaises(ValueError):
+            build(pods, pols, nams, endpoints=endpoints, mode="z3")
+        with self.assertRaises(ValueError):
+            get_external_pairs(build(pods, pols, nams, mode="native"))
+
+    def test_partitioned_build(self):
+        nams = [lite.from_dict("Namespace", {"metadata": {"name": name, "labels": {"tenant": name}}})
+            for name in ("a", "b", "c")]
+        # pods of a namespace are not listed together
+        pods = [lite.from_dict("Pod", {"metadata": {"name": "p%d" % i, "namespace": "abc"[i % 3],
+            "labels": {"app": "web" if i % 2 else "db"}}}) for i in range(9)]
+        pols = [
+            lite.from_dict("NetworkPolicy", {"metadata": {"name": "db", "namespace": "a"}, "spec": {
+                "podSelector": {"matchLabels": {"app": "db"}},
+                "ingress": [{"from": [{"namespaceSelector": {"matchLabels": {"tenant": "b"}}}]}],
+                "egress": [{"to": [{"podSelector": {"matchLabels": {"app": "web"}}}]}],
+            }}),
+            lite.from_dict("NetworkPolicy", {"metadata": {"name": "all", "namespace": "b"}, "spec": {
+                "podSelector": {},
+                "ingress": [{}],
+                "egress": [{"to": [{"namespaceSelector": {"matchLabels": {"tenant": "a"}}}]}],
+            }}),
+        ]
+        for flags in itertools.product([False, True], repeat=2):
+            ni = build(pods, pols, nams, *flags, mode="native")
+            for workers in (None, 2):
+                pi = build(pods, pols, nams, *flags, mode="partitioned", workers=workers)
+                for rel in ("edge", "ingress_traffic", "egress_traffic"):
+                    self.assertEqual(pi.get_rows(rel), ni.get_rows(rel))
+        self.assertIn((1, 0), get_all_edges(pi)[1])
+
+    def test_hybrid_build(self):
+        pods, pols, nams = sample.paper_example()
+
+        for flags in itertools.product([False, True], repeat=3):
+            gi = build(pods, pols, nams, *flags, mode="z3")
+            hi = build(pods, pols, nams, *flags, mode="hybrid")
+
+            self.assertEqual(get_all_edges(hi), get_all_edges(gi))
+            self.assertEqual(get_all_paths(hi), get_all_paths(gi))
+            self.assertEqual(user_crosscheck(hi, "role"), user_crosscheck(gi, "role"))
+            self.assertEqual(policy_shadow(hi), policy_shadow(gi))
+            self.assertEqual(policy_conflict(hi), policy_conflict(gi))
+
+    def test_explain_edges(self):
+        pods, pols, nams = sample.paper_example()
+        n = len(pods)
+
+        for flags in itertools.product([False, True], repeat=2):
+            ni = build(pods, pols, nams, *flags, mode="native")
+            for gi in (ni, build(pods, pols, nams, *flags, mode="z3")):
+                explanations = ExplanationIndex(gi).explain_pairs(itertools.product(range(n), range(n)))
+                self.assertEqual([e.connected for e in explanations], [ni.edge[i][j] for i in range(n) for j in range(n)])
+
+        ex = ExplanationIndex(build(pods, pols, nams, mode="native"))
+        explanation = ex.explain(0, 8)
+        self.assertTrue(explanation.connected)
+        self.assertTrue(explanation.ingress.policies and explanation.egress.policies)
+        # db_2 is selected by no policy, it only accepts traffic by default with check_select_by_no_policy
+        explanation = ex.explain(0, 2)
+        self.assertFalse(explanation.ingress.allowed or explanation.ingress.isolating)
+        self.assertIn("isolated by no policy", ex.describe(0, 2))
+        self.assertEqual(ExplanationIndex(build(pods, pols, nams, True, True, mode="native")).explain(0, 2).ingress.default,
+            SELECTED_BY_NO_POLICY)
+
+    def test_exposure_report(self):
+        pods, pols, nams = sample.paper_example()
+        n = len(pods)
+        ni = build(pods, pols, nams, True, True, mode="native")
+        report = degree_report(ni)
+        self.assertEqual(report, degree_report(build(pods, pols, nams, True, True, mode="z3")))
+
+        for i in range(n):
+            self.assertEqual(report.out_degree[i], sum(ni.edge[i][j] for j in range(n) if j != i))
+            self.assertEqual(report.in_degree[i], sum(ni.edge[j][i] for j in range(n) if j != i))
+        self.assertEqual(degree_report(ni, self_edges=True).in_degree[0], report.in_degree[0] + ni.edge[0][0])
+
+        top = report.most_exposed(3)
+        self.assertEqual([d for _, d in top], sorted(report.in_degree, reverse=True)[:3])
+        self.assertEqual(sum(count for _, _, count in report.histogram(OUT)), n)
+        self.assertEqual(report.at_least(top[0][1]), [i for i, d in enumerate(report.in_degree) if d == top[0][1]])
+        by_namespace = report.top_by_group(pod_groups(pods), 1)
+        self.assertEqual(set(by_namespace), {"default", "minikube"})
+        self.assertEqual(sum(t[0] for t in report.group_totals(pod_groups(pods, "app")).values()), sum(report.in_degree))
+
+    def test_invariants(self):
+        pods, pols, nams = sample.paper_example()
+        invariants = parse_invariants("""
+            # db pods talk to tomcat only
+            db-clients: only role=tomcat -> role=db same ns
+            prod-test: deny env=prod -> env=test
+            tomcat-db: require role=tomcat -> role=db same ns
+            nginx-db: only role=nginx -> role=db
+        """)
+        checker = InvariantChecker(invariants)
+        results = checker.check(build(pods, pols, nams, mode="native"))
+        self.assertFalse(results["db-clients"])
+        self.assertEqual(results["prod-test"].pairs(), [(0, 9), (8, 1)])
+        self.assertEqual(results["tomcat-db"].pairs(), [(10, 2), (10, 3), (11, 2), (11, 3)])
+        self.assertEqual(results["nginx-db"].pairs(), [(8, 0), (8, 1), (9, 0), (9, 1)])
+        self.assertEqual(InvariantChecker(invariants).check(build(pods, pols, nams, mode="z3")), results)
+
+        truncated = InvariantChecker(invariants, max_pairs=1).check(build(pods, pols, nams, mode="native"))["tomcat-db"]
+        self.assertEqual((truncated.count, truncated.pairs()), (4, [(10, 2)]))
+        for text in ("allow * -> *", "deny role=db", "deny role==db -> *", "deny !role=db -> *"):
+            self.assertRaises(ValueError, InvariantChecker, {"bad": text})
+
+        # pods without the key are in no group, neither as source nor as destination
+        index = LabelIndex([{"team": "a"}, {"team": "b"}, {}, {"team": "a"}])
+        checker = InvariantChecker({
+            "deny": "deny * -> * different team",
+            "require": "require * -> * different team",
+            "only": "only * -> * different team",
+        })
+        full = [bitarray("1111") for _ in range(4)]
+        empty = [bitarray("0000") for _ in range(4)]
+        different = [(0, 1), (1, 0), (1, 3), (3, 1)]
+        self.assertEqual(checker.check_rows(full, index)["deny"].pairs(), different)
+        self.assertEqual(checker.check_rows(empty, index)["require"].pairs(), different)
+        self.assertEqual(checker.check_rows(full, index)["only"].pairs(),
+            [(0, 2), (0, 3), (1, 2), (2, 0), (2, 1), (2, 3), (3, 0), (3, 2)])
+
+    def test_sampled_estimate(self):
+        pods, pols, nams = sample.paper_example()
+        n = len(pods)
+        ni = build(pods, pols, nams, True, True, mode="native")
+        facts = build_facts(pods, pols, nams, True, True)
+        sampler = PairSampler(facts)
+        self.assertEqual([sampler.row(i) for i in range(n)], ni.edge)
+        self.assertEqual([sampler.column(j) for j in range(n)], [ni.get_column(ni.edge, j) for j in range(n)])
+
+        report = estimate(facts, "role", budget=60)
+        self.assertTrue(report.exact)
+        connected = sum(row.count() - row[i] for i, row in enumerate(ni.edge))
+        self.assertAlmostEqual(report.reachable_fraction.value, connected / (n * (n - 1)))
+        self.assertEqual(report.reachable_fraction.half_width, 0)
+        self.assertEqual(report.isolated.value, len(all_isolated_native(ni)[1]))
+        self.assertEqual(report.cross_user.value, len(user_crosscheck(ni, "role")[1]))
+
+        report = estimate(facts, "role", strata="env", budget=0, batch=4)
+        self.assertEqual(report.sampled, 4)
+        for e in (report.reachable_fraction, report.isolated, report.cross_user):
+            self.assertTrue(e.low <= e.value <= e.high)
+        self.assertTrue(report.isolated.high <= n)
+
+        # Student quantiles, from the tables
+        for p, dof, t in ((0.975, 1, 12.706), (0.975, 2, 4.303), (0.975, 3, 3.182), (0.995, 5, 4.032), (0.975, 120, 1.980)):
+            self.assertAlmostEqual(t_quantile(p, dof), t, places=3)
+        # a first round seeing only zeros (say 3 connected pods among 100) does not exclude the others
+        estimated = mean_estimate([[0.0] * 8, [0.0] * 2], [80, 20], 0.95)
+        self.assertEqual(estimated.low, 0.0)
+        self.assertGreater(estimated.high, 0.03)
+
+    def test_stream_output(self):
+        pods, pols, nams = sample.paper_example()
+        names = IndexTable.of_pods(pods).names
+
+        def records(chunks):
+            return {record if len(record) > 1 else record[0] for chunk in chunks for record in zip(*chunk)}
+
+        for mode in ("native", "z3"):
+            gi = build(pods, pols, nams, True, True, mode=mode)
+            edges = get_all_edges(gi)[1]
+            self.assertEqual(records(relation_chunks(gi, "edge", chunk_size=3)), edges)
+            self.assertEqual(records(relation_chunks(gi, "disconnect")), get_all_pairs(gi, "disconnect")[1])
+            self.assertEqual(records(crosscheck_chunks(gi, "role", chunk_size=2)), set(user_crosscheck(gi, "role")[1]))
+            self.assertEqual(records(shadow_chunks(gi)), set(policy_shadow(gi)[1]))
+
+            out = io.StringIO()
+            self.assertEqual(write_edges(gi, out), len(edges))
+            lines = [json.loads(line) for line in out.getvalue().splitlines()]
+            self.assertEqual({(names.index(line["src"]), names.index(line["dst"])) for line in lines}, edges)
+
+            out = io.BytesIO()
+            write_edges(gi, out, binary=True)
+            out.seek(0)
+            tables, chunks = read_binary(out)
+            self.assertEqual(tables, [names, names])
+            self.assertEqual(records(chunks), edges)
+
+    def test_watch(self):
+        def event(event_type, kind, name, namespace=None, **fields):
+            metadata = {"name": name}
+            if namespace is not None:
+                metadata["namespace"] = namespace
+            return {"type": event_type, "object": dict(kind=kind, metadata=metadata, **fields)}
+
+        def pod(event_type, name, app):
+            e = event(event_type, "Pod", name, "default")
+            e["object"]["metadata"]["labels"] = {"app": app}
+            return e
+
+        deny_db = event("ADDED", "NetworkPolicy", "db", "default", spec={
+            "podSelector": {"matchLabels": {"app": "db"}},
+            "ingress": [{"from": [{"podSelector": {"matchLabels": {"app": "web"}}}]}],
+            "egress": [{}],
+        })
+        allow_web = event("ADDED", "NetworkPolicy", "web", "default", spec={"podSelector": {"matchLabels": {"app": "web"}}, "egress": [{}], "ingress": [{}]})
+        watcher = Watcher(invariants={
+            "web->db": lambda ni: bool(ni.edge[0][1]),
+            "isolated": lambda ni: len(all_isolated_native(ni)[1]),
+        })
+
+        verdict = watcher.verdict([(perf_counter(), e) for e in [
+            event("ADDED", "Namespace", "default"), pod("ADDED", "web", "web"), pod("ADDED", "db", "db"), deny_db]])
+        self.assertEqual(verdict.results, {"web->db": False, "isolated": 1})
+        verdict = watcher.verdict([(perf_counter(), allow_web)])
+        self.assertEqual(verdict.results, {"web->db": True, "isolated": 0})
+        self.assertEqual(verdict.changed, ["web->db", "isolated"])
+        # a status update changes nothing, the model is not rebuilt
+        model = watcher.ni
+        status = pod("MODIFIED", "web", "web")
+        status["object"]["status"] = {"phase": "Running"}
+        self.assertEqual(watcher.verdict([(perf_counter(), status)]).changed, [])
+        self.assertIs(watcher.ni, model)
+
+        # the same events from a file and a watch endpoint
+        class WatchHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.end_headers()
+                for e in [pod("MODIFIED", "web", "cache"), event("DELETED", "NetworkPolicy", "web", "default")]:
+                    self.wfile.write((json.dumps(e) + "\n").encode())
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(("127.0.0.1", 0), WatchHandler)
+        threading.Thread(target=server.handle_request, daemon=True).start()
+        stream = io.StringIO("\n".join(json.dumps(e) for e in [
+            event("ADDED", "Namespace", "default"), pod("ADDED", "web", "web"), pod("ADDED", "db", "db"), deny_db, allow_web]))
+        watcher = Watcher(invariants={"edges": lambda ni: sum(row.count() for row in ni.edge)})
+        verdicts = []
+        watcher.run([stream], on_verdict=verdicts.append)
+        histogram = watcher.run(["http://127.0.0.1:{}/api/v1/pods?watch=1".format(server.server_port)], on_verdict=verdicts.append)
+        server.server_close()
+
+        self.assertEqual(sum(len(v.events) for v in verdicts), 7)
+        self.assertEqual(len(histogram), 7)
+        self.assertIn("7 events", histogram.report())
+        # web is now an unselected cache pod, only the self edge of db is left
+        self.assertEqual(verdicts[-1].results, {"edges": 1})
+
+    def test_import_time(self):
+        # heavy dependencies are lazy: importing kubesv must not execute z3, kubernetes or yaml
+        script = "\n".join([
+            "import sys",
+            "import kubesv.constraint, kubesv.postprocess, kubesv.tuning, kubesv.parser, kubesv.lite",
+            "print(' '.join(m for m in ('z3.z3', 'kubernetes.client', 'yaml.loader') if m in sys.modules))",
+        ])
+        root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+        output = subprocess.run([sys.executable, "-c", script], cwd=root,
+            check=True, capture_output=True, text=True).stdout
+
+        self.assertEqual(output.strip(), "")
+
 
 if __name__ == '__main__':
     unittest.main()
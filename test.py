@@ -1,11 +1,12 @@
+import os
 import yaml
-import kano_py.kano.algorithm as kano
+import kano.algorithm as kano
 import kubesv.kubesv.postprocess as ksv
 
 from contextlib import contextmanager
 from time import perf_counter
-from kano_py.kano.model import *
-from kano_py.kano.parser import ConfigParser
+from kano.model import *
+from kano.parser import ConfigParser
 from kano_py.tests.generate import ConfigFiles
 from kubesv.kubesv.constraint import *
 from kubesv.kubesv.postprocess import *